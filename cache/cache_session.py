@@ -1,4 +1,6 @@
+from time import time
 import redis
+import redis.asyncio as aioredis
 
 def set_check_label(user_id, db: redis.Redis):
     return db.set(f'userChecked:{user_id}', 'checked', ex=25*60*60)
@@ -6,17 +8,62 @@ def set_check_label(user_id, db: redis.Redis):
 def get_check_label(user_id, db: redis.Redis):
     return db.get(f'userChecked:{user_id}')
 
+def get_check_labels(users_id: list, db: redis.Redis):
+    if not users_id:
+        return []
+
+    return db.mget([f'userChecked:{user_id}' for user_id in users_id])
+
+def set_check_labels(users_id: list, db: redis.Redis):
+
+    pipe = db.pipeline(transaction= False)
+    for user_id in users_id:
+        pipe.set(f'userChecked:{user_id}', 'checked', ex=25*60*60)
+
+    return pipe.execute()
+
 def set_test_account_cache(user_id, username_test, ex, db: redis.Redis):
-    return db.set(f'test_ssh_account:user:{user_id}:username:{username_test}', 1, ex= ex)
+    
+    key = f'test_ssh_account:user:{user_id}'
+    pipe = db.pipeline()
+    pipe.zadd(key, {username_test: time() + ex})
+    pipe.expire(key, ex)
+    return pipe.execute()
 
 def get_test_account_number(user_id, db: redis.Redis):
-    resp = db.keys(f'test_ssh_account:user:{user_id}:*')
-    if resp:
-        return len(resp)
-    
-    else :
+
+    key = f'test_ssh_account:user:{user_id}'
+    pipe = db.pipeline()
+    pipe.zremrangebyscore(key, '-inf', time())
+    pipe.zcard(key)
+    _, number = pipe.execute()
+    return number
+
+def migrate_test_account_cache(db: redis.Redis):
+    """
+    move the old per-account keys (test_ssh_account:user:{id}:username:{username})
+    into the per-agent sorted sets, uses SCAN so it never blocks redis
+    """
+    if db.get('test_ssh_account:migrated'):
         return 0
 
+    users_ttl = {}
+    for old_key in db.scan_iter(match= 'test_ssh_account:user:*:username:*', count= 1000):
+
+        _, _, user_id, _, username_test = old_key.split(':', 4)
+        ttl = db.ttl(old_key)
+        if ttl and ttl > 0:
+            db.zadd(f'test_ssh_account:user:{user_id}', {username_test: time() + ttl})
+            users_ttl[user_id] = max(ttl, users_ttl.get(user_id, 0))
+
+        db.delete(old_key)
+
+    for user_id, ttl in users_ttl.items():
+        db.expire(f'test_ssh_account:user:{user_id}', ttl)
+
+    db.set('test_ssh_account:migrated', 'true')
+    return len(users_ttl)
+
 def set_last_domain(value, db: redis.Redis):
     return db.set('last_domain', value)
 
@@ -35,3 +82,193 @@ def get_server_proccessing(host: str, db: redis.Redis):
 def get_server_number(db: redis.Redis):
     return db.get('servernumber')
 
+
+def pop_username_number(db: redis.Redis):
+    return db.spop('username_pool')
+
+def remove_username_number(number: int, db: redis.Redis):
+    return db.srem('username_pool', number)
+
+def get_username_pool_ready(db: redis.Redis):
+    return db.get('username_pool:ready')
+
+def lock_username_pool(db: redis.Redis):
+    return db.set('username_pool:lock', 'true', nx= True, ex= 10*60)
+
+def fill_username_pool(numbers, db: redis.Redis, chunk_size= 10_000):
+
+    pipe = db.pipeline(transaction= False)
+    pipe.delete('username_pool')
+    for index in range(0, len(numbers), chunk_size):
+        pipe.sadd('username_pool', *numbers[index: index + chunk_size])
+
+    pipe.set('username_pool:ready', 'true')
+    pipe.delete('username_pool:lock')
+    return pipe.execute()
+
+def _expire_timestamp(value):
+    # expire is stored as a naive wall-clock datetime, drop the tzinfo the routes attach before converting
+    return value.replace(tzinfo=None).timestamp()
+
+def schedule_service_expire(service_id, expire, db: redis.Redis, warning_before= 24*60*60):
+
+    expire_ts = _expire_timestamp(expire)
+    actions = {f'block:{service_id}': expire_ts}
+    if warning_before:
+        actions[f'warn:{service_id}'] = expire_ts - warning_before
+
+    pipe = db.pipeline()
+    pipe.zadd('expire_schedule', actions)
+    pipe.zrem('expire_schedule', f'delete:{service_id}')
+    if not warning_before:
+        pipe.zrem('expire_schedule', f'warn:{service_id}')
+
+    pipe.rpush('expire_schedule:wakeup', 1)
+    return pipe.execute()
+
+def schedule_service_delete(service_id, due_time, db: redis.Redis):
+    return db.zadd('expire_schedule', {f'delete:{service_id}': _expire_timestamp(due_time)})
+
+def unschedule_service_expire(service_id, db: redis.Redis):
+    return db.zrem('expire_schedule', f'warn:{service_id}', f'block:{service_id}', f'delete:{service_id}')
+
+def get_due_expire_actions(now: float, limit: int, db: redis.Redis):
+    return db.zrangebyscore('expire_schedule', '-inf', now, start= 0, num= limit)
+
+def get_next_expire_action(db: redis.Redis):
+    resp = db.zrange('expire_schedule', 0, 0, withscores= True)
+    if resp:
+        return resp[0]
+
+    return None
+
+def reschedule_expire_actions(actions: dict, db: redis.Redis):
+    return db.zadd('expire_schedule', actions)
+
+def remove_expire_actions(members: list, db: redis.Redis):
+    if not members:
+        return 0
+
+    return db.zrem('expire_schedule', *members)
+
+def wait_expire_schedule(timeout: int, db: redis.Redis):
+    resp = db.blpop('expire_schedule:wakeup', timeout= timeout)
+    if resp:
+        db.delete('expire_schedule:wakeup')
+
+    return resp
+
+def get_hosts_health(hosts: list, db: redis.Redis):
+    if not hosts:
+        return []
+
+    pipe = db.pipeline()
+    for host in hosts:
+        pipe.hgetall(f'host_health:{host}')
+
+    return pipe.execute()
+
+def set_hosts_health(records: dict, ttl: int, db: redis.Redis):
+    if not records:
+        return []
+
+    pipe = db.pipeline()
+    for host, record in records.items():
+        pipe.hset(f'host_health:{host}', mapping= record)
+        pipe.expire(f'host_health:{host}', ttl)
+
+    return pipe.execute()
+
+def create_broadcast(broadcast_id, record: dict, ttl: int, db: redis.Redis):
+    pipe = db.pipeline()
+    pipe.hset(f'broadcast:{broadcast_id}', mapping= record)
+    pipe.expire(f'broadcast:{broadcast_id}', ttl)
+    pipe.rpush('broadcast:queue', broadcast_id)
+    return pipe.execute()
+
+def get_broadcast(broadcast_id, db: redis.Redis):
+    return db.hgetall(f'broadcast:{broadcast_id}')
+
+async def get_broadcast_async(broadcast_id, db: aioredis.Redis):
+    return await db.hgetall(f'broadcast:{broadcast_id}')
+
+def update_broadcast(broadcast_id, record: dict, db: redis.Redis):
+    return db.hset(f'broadcast:{broadcast_id}', mapping= record)
+
+def incr_broadcast(broadcast_id, counters: dict, db: redis.Redis):
+    pipe = db.pipeline()
+    for field, amount in counters.items():
+        pipe.hincrby(f'broadcast:{broadcast_id}', field, amount)
+
+    return pipe.execute()
+
+def pop_broadcast(timeout: int, db: redis.Redis):
+    # the id stays in broadcast:processing until ack_broadcast, so a crash cant lose it
+    return db.blmove('broadcast:queue', 'broadcast:processing', timeout, 'LEFT', 'RIGHT')
+
+def ack_broadcast(broadcast_id, db: redis.Redis):
+    return db.lrem('broadcast:processing', 0, broadcast_id)
+
+def requeue_broadcasts(db: redis.Redis):
+    """ move the ids a stopped worker left in broadcast:processing back to the head of the queue, oldest first """
+    requeued = []
+    while True:
+        broadcast_id = db.lmove('broadcast:processing', 'broadcast:queue', 'RIGHT', 'LEFT')
+        if broadcast_id is None:
+            return requeued[::-1]
+
+        requeued.append(broadcast_id)
+
+def queue_digest_events(events: list, window: int, db: redis.Redis, idempotency_ttl= 3*24*60*60):
+    """ events: [(agent_id, event, username, idempotency_key)], returns how many were new """
+    if not events:
+        return 0
+
+    pipe = db.pipeline()
+    for _, _, _, idempotency_key in events:
+        pipe.set(f'notify_event:{idempotency_key}', 1, nx= True, ex= idempotency_ttl)
+
+    claimed = pipe.execute()
+    due_at = time() + window
+
+    pipe = db.pipeline()
+    for (agent_id, event, username, _), is_new in zip(events, claimed):
+        if not is_new:
+            continue
+
+        pipe.sadd(f'notify_digest:{agent_id}:{event}', username)
+        # the window starts with the first event of the digest
+        pipe.zadd('notify_digest:due', {f'{agent_id}:{event}': due_at}, nx= True)
+
+    pipe.execute()
+    return sum(1 for is_new in claimed if is_new)
+
+def get_due_digests(now: float, db: redis.Redis):
+    return db.zrangebyscore('notify_digest:due', '-inf', now)
+
+def get_next_digest(db: redis.Redis):
+    resp = db.zrange('notify_digest:due', 0, 0, withscores= True)
+    if resp:
+        return resp[0]
+
+    return None
+
+def get_digest_usernames(agent_id, event, db: redis.Redis):
+    return db.smembers(f'notify_digest:{agent_id}:{event}')
+
+def complete_digest(agent_id, event, usernames: list, window: int, db: redis.Redis):
+    pipe = db.pipeline()
+    if usernames:
+        pipe.srem(f'notify_digest:{agent_id}:{event}', *usernames)
+
+    pipe.scard(f'notify_digest:{agent_id}:{event}')
+    remaining = pipe.execute()[-1]
+
+    # events that arrived while the digest was being sent open a new window
+    if remaining:
+        return db.zadd('notify_digest:due', {f'{agent_id}:{event}': time() + window})
+
+    return db.zrem('notify_digest:due', f'{agent_id}:{event}')
+
+def claim_digest(digest_key, ttl: int, db: redis.Redis):
+    return db.set(f'notify_digest_sent:{digest_key}', 1, nx= True, ex= ttl)
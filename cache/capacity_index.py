@@ -0,0 +1,183 @@
+from cache.database import get_redis_cache
+from bisect import insort, bisect_left
+from typing import Dict, List, Tuple
+from threading import Lock
+import logging
+import json
+import time
+import uuid
+import os
+
+CAPACITY_INDEX_CHANNEL = 'capacity_index'
+CAPACITY_INDEX_TTL = int(os.getenv('CAPACITY_INDEX_TTL', 60))
+
+logger = logging.getLogger('capacity_index.log')
+
+
+class CapacityIndex:
+    """
+    in-process placement index of the servers that accept new configs.
+    keeps (ssh_accounts_number, server_ip) in sorted order so picking the
+    k-th least loaded server needs no db round-trip; other uvicorn workers
+    and services are kept in sync through redis pub/sub.
+    """
+
+    def __init__(self, channel: str= CAPACITY_INDEX_CHANNEL, ttl: int= CAPACITY_INDEX_TTL):
+
+        self.channel = channel
+        self.ttl = ttl
+        self.worker_id = uuid.uuid4().hex
+
+        self._lock = Lock()
+        self._servers: Dict[str, Tuple[int, int, int]] = {}  # server_ip -> (ssh_accounts_number, max_users, ssh_port)
+        self._order: List[Tuple[int, str]] = []  # only servers with free capacity
+        self._loaded_at = None
+        self._listener = None
+
+    # ============= Local state =============
+
+    def _insert(self, server_ip, ssh_accounts_number, max_users, ssh_port):
+
+        self._servers[server_ip] = (ssh_accounts_number, max_users, ssh_port)
+        if ssh_accounts_number < max_users:
+            insort(self._order, (ssh_accounts_number, server_ip))
+
+    def _remove(self, server_ip):
+
+        entry = self._servers.pop(server_ip, None)
+        if entry is None:
+            return None
+
+        key = (entry[0], server_ip)
+        index = bisect_left(self._order, key)
+        if index < len(self._order) and self._order[index] == key:
+            del self._order[index]
+
+        return entry
+
+    def _apply_delta(self, server_ip, delta):
+
+        entry = self._remove(server_ip)
+        if entry is None:
+            return
+
+        ssh_accounts_number, max_users, ssh_port = entry
+        self._insert(server_ip, max(0, ssh_accounts_number + delta), max_users, ssh_port)
+
+    def load(self, db):
+
+        from db import db_server
+
+        rows = db_server.get_capacity_rows(db)
+
+        with self._lock:
+            self._servers = {}
+            self._order = []
+            for row in rows:
+                self._insert(row.server_ip, row.ssh_accounts_number, row.max_users, row.ssh_port)
+
+            self._loaded_at = time.monotonic()
+
+    def is_stale(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    def ensure_loaded(self, db):
+
+        self.start_listener()
+        if self.is_stale():
+            self.load(db)
+
+    def select(self, db, rank: int, except_servers: List[str]= []) -> Tuple[str, int, int, int]:
+        """
+        return (server_ip, ssh_port, ssh_accounts_number, max_users) of the
+        `rank`-th least loaded server, rank is clipped to the available range
+        """
+        self.ensure_loaded(db)
+
+        with self._lock:
+
+            # full servers are never in _order, only the excluded ones that are in it have to be skipped
+            excluded_positions = sorted(
+                bisect_left(self._order, (self._servers[server_ip][0], server_ip))
+                    for server_ip in set(except_servers)
+                    if server_ip in self._servers and self._servers[server_ip][0] < self._servers[server_ip][1]
+            )
+
+            candidates_number = len(self._order) - len(excluded_positions)
+            if candidates_number <= 0:
+                return None
+
+            # shift the rank past every excluded entry at or before it, O(k log n) for k excluded servers
+            index = min(max(rank, 0), candidates_number - 1)
+            for position in excluded_positions:
+                if position > index:
+                    break
+
+                index += 1
+
+            ssh_accounts_number, server_ip = self._order[index]
+            _, max_users, ssh_port = self._servers[server_ip]
+
+            return server_ip, ssh_port, ssh_accounts_number, max_users
+
+    # ============= Cross-worker sync =============
+
+    def _publish(self, message: dict):
+
+        message['sender'] = self.worker_id
+        try:
+            get_redis_cache().__next__().publish(self.channel, json.dumps(message))
+
+        except Exception as e:
+            logger.error(f'[capacity index] failed to publish (message: {message} -error: {e})')
+
+    def _on_message(self, message):
+
+        try:
+            data = json.loads(message['data'])
+
+        except (TypeError, ValueError):
+            return
+
+        if data.get('sender') == self.worker_id:
+            return
+
+        with self._lock:
+            if data.get('op') == 'adjust':
+                self._apply_delta(data['server_ip'], int(data['delta']))
+
+            else:
+                self._loaded_at = None
+
+    def start_listener(self):
+
+        if self._listener is not None:
+            return
+
+        try:
+            pubsub = get_redis_cache().__next__().pubsub(ignore_subscribe_messages= True)
+            pubsub.subscribe(**{self.channel: self._on_message})
+            self._listener = pubsub.run_in_thread(sleep_time= 1, daemon= True)
+
+        except Exception as e:
+            # without redis the index still works, it is just reloaded every ttl seconds
+            logger.error(f'[capacity index] failed to subscribe (channel: {self.channel} -error: {e})')
+            self._listener = False
+
+    def adjust(self, server_ip, delta: int):
+
+        with self._lock:
+            if self._loaded_at is not None:
+                self._apply_delta(server_ip, delta)
+
+        self._publish({'op': 'adjust', 'server_ip': server_ip, 'delta': delta})
+
+    def invalidate(self):
+
+        with self._lock:
+            self._loaded_at = None
+
+        self._publish({'op': 'invalidate'})
+
+
+capacity_index = CapacityIndex()
@@ -1,12 +1,16 @@
 import os
 from dotenv import load_dotenv
 from pathlib import Path
+import redis.asyncio as aioredis
 import redis
 
 dotenv_path = Path('.env')
 load_dotenv(dotenv_path=dotenv_path)
 
 CACHE_URL = os.getenv('CACHE_URL')
+CACHE_MAX_CONNECTIONS = int(os.getenv('CACHE_MAX_CONNECTIONS', 50))
+CACHE_HEALTH_CHECK_INTERVAL = int(os.getenv('CACHE_HEALTH_CHECK_INTERVAL', 30))
+CACHE_SOCKET_TIMEOUT = float(os.getenv('CACHE_SOCKET_TIMEOUT', 5))
 
 class RedisSingleton:
     _instance = None
@@ -18,20 +22,46 @@ class RedisSingleton:
 
     def __init__(self, url):
         if not hasattr(self, '_redis_db'):
-            self._redis_db = redis.Redis.from_url(url, decode_responses=True)
+            self._url = url
+            self._pool = redis.ConnectionPool.from_url(
+                url,
+                decode_responses=True,
+                max_connections=CACHE_MAX_CONNECTIONS,
+                health_check_interval=CACHE_HEALTH_CHECK_INTERVAL,
+                socket_timeout=CACHE_SOCKET_TIMEOUT,
+                socket_keepalive=True
+            )
+            self._redis_db = redis.Redis(connection_pool=self._pool)
+            self._async_redis_db = None
 
     @property
     def redis_db(self):
         return self._redis_db
 
+    @property
+    def async_redis_db(self):
+        # the asyncio pool is bound to the running loop, so it is created on first use inside it
+        if self._async_redis_db is None:
+            async_pool = aioredis.ConnectionPool.from_url(
+                self._url,
+                decode_responses=True,
+                max_connections=CACHE_MAX_CONNECTIONS,
+                health_check_interval=CACHE_HEALTH_CHECK_INTERVAL,
+                socket_timeout=CACHE_SOCKET_TIMEOUT,
+                socket_keepalive=True
+            )
+            self._async_redis_db = aioredis.Redis(connection_pool=async_pool)
+
+        return self._async_redis_db
+
 
 session = RedisSingleton(CACHE_URL)
 
 
 def get_redis_cache():
-    try:
-        yield session.redis_db
+    # connections go back to the shared pool after each command, the pool itself is never torn down
+    yield session.redis_db
 
-    finally:
-        session.redis_db.close()
 
+async def get_async_redis_cache():
+    yield session.async_redis_db
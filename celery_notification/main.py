@@ -2,11 +2,17 @@ import sys
 
 sys.path.append('../')
 
-from telegram import InlineKeyboardButton, Bot, KeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
 from celery_tasks.tasks import NotificationCeleryTask 
 from celery_tasks.utils import create_worker_from
+from cache.database import get_redis_cache
+from cache.cache_session import incr_broadcast
 
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from threading import Lock
+from time import monotonic, sleep
+import requests
 import logging
 import os
 
@@ -29,11 +35,16 @@ console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
 
-vpn_cluster_bot_token = os.getenv('VPN_CLUSTER_BOT_TOKEN')
-vpn_cluster_bot = Bot(token= vpn_cluster_bot_token)
+TELEGRAM_API_URL = 'https://api.telegram.org'
+# telegram allows about 30 messages per second per bot and 1 per second per chat
+TELEGRAM_BOT_RATE = float(os.getenv('TELEGRAM_BOT_RATE', 30))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_MAX_ATTEMPTS = int(os.getenv('TELEGRAM_MAX_ATTEMPTS', 5))
+NOTIFICATION_SEND_THREADS = int(os.getenv('NOTIFICATION_SEND_THREADS', 8))
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
 
+vpn_cluster_bot_token = os.getenv('VPN_CLUSTER_BOT_TOKEN')
 admin_log_bot_token = os.getenv('ADMIN_LOG_BOT_TOKEN')
-admin_log_bot = Bot(token= admin_log_bot_token)
 
 ADMIN_CHAT_ID = os.getenv('ADMIN_CHAT_ID')
 
@@ -42,63 +53,204 @@ chat_id_dic = {
 }
 
 bot_selector_dic = {
-    'vpn_cluster': vpn_cluster_bot,
-    'admin_log': admin_log_bot
+    'vpn_cluster': vpn_cluster_bot_token,
+    'admin_log': admin_log_bot_token
 }
 
+parse_mode_dic = {
+    'markdown': 'Markdown',
+    'html': 'HTML'
+}
 
-class NotificationCeleryTaskImpl(NotificationCeleryTask):
 
-    def run(self, payload):
-        
-        logger.info(f'payload: {payload}')
+class TokenBucket:
+    """ thread safe token bucket, `acquire` blocks until a token is available """
+
+    def __init__(self, rate: float, capacity: float= None):
+
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.paused_until = 0
+        self.lock = Lock()
+
+    def pause(self, seconds: float):
+
+        with self.lock:
+            self.paused_until = max(self.paused_until, monotonic() + seconds)
+            self.tokens = 0
+
+    def acquire(self):
+
+        while True:
+            with self.lock:
+                now = monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(self.capacity, self.tokens + (now - max(self.updated, self.paused_until)) * self.rate)
+                    self.updated = now
+
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+
+                    wait = (1 - self.tokens) / self.rate
+
+                else:
+                    wait = self.paused_until - now
+
+            sleep(wait)
+
+
+class TelegramSender:
+    """
+    sends through the bot api over one keep-alive session, every message takes
+    a token from the bucket of its bot and from the bucket of its chat, 429s
+    pause the bot for the `retry_after` telegram returns and are retried
+    """
+
+    def __init__(self, bots: dict, bot_rate: float= TELEGRAM_BOT_RATE, chat_rate: float= TELEGRAM_CHAT_RATE, max_attempts: int= TELEGRAM_MAX_ATTEMPTS):
+
+        self.bots = bots
+        self.chat_rate = chat_rate
+        self.max_attempts = max_attempts
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections= len(bots) or 1, pool_maxsize= NOTIFICATION_SEND_THREADS)
+        self.session.mount('https://', adapter)
+
+        self.bot_buckets = {bot: TokenBucket(bot_rate) for bot in bots}
+        self.chat_buckets = {}
+        self.lock = Lock()
+
+    def chat_bucket(self, bot, chat_id) -> TokenBucket:
+
+        with self.lock:
+            key = (bot, str(chat_id))
+            if key not in self.chat_buckets:
+                self.chat_buckets[key] = TokenBucket(self.chat_rate, capacity= 1)
+
+            return self.chat_buckets[key]
+
+    def send_message(self, bot, chat_id, text, reply_markup= None, parse_mode= None):
+
+        data = {'chat_id': chat_id, 'text': text}
+        if reply_markup:
+            data['reply_markup'] = reply_markup
+
+        if parse_mode:
+            data['parse_mode'] = parse_mode
+
+        url = f'{TELEGRAM_API_URL}/bot{self.bots[bot]}/sendMessage'
+        chat_bucket = self.chat_bucket(bot, chat_id)
+        error = None
 
-        bot_selector = payload["bot_selector"]
+        for attempt in range(self.max_attempts):
 
-        chat_id = payload["chat_id"]
+            chat_bucket.acquire()
+            self.bot_buckets[bot].acquire()
+
+            try:
+                resp = self.session.post(url, json= data, timeout= 10)
+
+            except requests.exceptions.RequestException as e:
+                error = str(e)
+                sleep(min(2 ** attempt, 30))
+                continue
+
+            if resp.status_code == 200:
+                return True, None
+
+            try:
+                body = resp.json()
+
+            except ValueError:
+                body = {}
+
+            error = f'{resp.status_code}: {body.get("description", resp.content)}'
+
+            if resp.status_code == 429:
+                retry_after = body.get('parameters', {}).get('retry_after', 1)
+                self.bot_buckets[bot].pause(retry_after)
+                continue
+
+            if resp.status_code >= 500:
+                sleep(min(2 ** attempt, 30))
+                continue
+
+            # 400 / 403 (chat not found, bot blocked by the user, bad markup) will not get better
+            break
+
+        return False, error
+
+
+sender = TelegramSender({bot: token for bot, token in bot_selector_dic.items() if token})
 
-        if chat_id in chat_id_dic:
-            chat_id = chat_id_dic[chat_id]
 
-        message = payload["message"]
+def build_keyboard(payload):
 
-        keyboards = None
-        parse_mode= None
+    if 'inline_keyboard' in payload and payload['inline_keyboard']:
+        return {'inline_keyboard': [[{'text': col[0], 'callback_data': col[1]} for col in line] for line in payload['inline_keyboard']]}
 
-        if 'parse_mode' in payload and payload["parse_mode"] in ['html', 'markdown']:
-            parse_mode = payload["parse_mode"]
+    if 'button_keyboard' in payload and payload['button_keyboard']:
+        return {'keyboard': [[{'text': col} for col in line] for line in payload['button_keyboard']]}
 
-        if 'inline_keyboard' in payload and payload['inline_keyboard']:
-            
-            inlines= [] 
-            for line in payload['inline_keyboard']:
-                tmp = []
-                for col in line:
-                    tmp.append(InlineKeyboardButton(text=col[0], callback_data=col[1]))
+    return None
 
-                inlines.append(tmp)
 
-            keyboards = InlineKeyboardMarkup(inlines)
+def send_payload(payload):
 
-        elif 'button_keyboard' in payload and payload['button_keyboard']:
-            inlines = []
-            for line in payload['button_keyboard']:
-                tmp = []
-                for col in line:
-                    tmp.append(KeyboardButton(text=col))
+    bot_selector = payload["bot_selector"]
 
-                inlines.append(tmp)     
+    chat_id = payload["chat_id"]
 
-            keyboards = ReplyKeyboardMarkup(inlines)
+    if chat_id in chat_id_dic:
+        chat_id = chat_id_dic[chat_id]
 
+    message = payload["message"]
 
-        if bot_selector in bot_selector_dic:
+    parse_mode = None
+    if 'parse_mode' in payload and payload["parse_mode"] in parse_mode_dic:
+        parse_mode = parse_mode_dic[payload["parse_mode"]]
 
+    if bot_selector not in sender.bots:
+        logger.error(f'[send notif] unknown bot (bot: {bot_selector} -chat_id: {chat_id})')
+        return False
+
+    _, err = sender.send_message(bot_selector, chat_id, message[:TELEGRAM_MAX_MESSAGE_LENGTH], reply_markup= build_keyboard(payload), parse_mode= parse_mode)
+    if err:
+        logger.error(f'[send notif] error (chat_id: {chat_id} -message: {message} -error: {err})')
+        return False
+
+    return True
+
+
+class NotificationCeleryTaskImpl(NotificationCeleryTask):
+
+    def run(self, payload):
+        """
+        payload is one message or {'messages': [...]} for a batch, the batch is
+        sent by a few threads that share the rate limits of the whole worker
+        """
+        messages = payload['messages'] if 'messages' in payload else [payload]
+
+        logger.info(f'payload: {messages[0] if len(messages) == 1 else f"batch of {len(messages)} messages"}')
+
+        if len(messages) == 1:
+            sent = [send_payload(messages[0])]
+
+        else:
+            with ThreadPoolExecutor(max_workers= NOTIFICATION_SEND_THREADS) as executor:
+                sent = list(executor.map(send_payload, messages))
+
+        if 'broadcast_id' in payload:
             try:
-                bot_selector_dic[bot_selector].send_message(chat_id= chat_id, text= message[:1000] ,reply_markup= keyboards, parse_mode= parse_mode )
-            
+                incr_broadcast(payload['broadcast_id'], {'sent': sum(sent), 'failed': len(sent) - sum(sent)}, get_redis_cache().__next__())
+
             except Exception as e:
-                logger.error(f'[send notif] error (chat_id: {chat_id} -message: {message} -error: {e})')
+                logger.error(f'[send notif] failed to update the broadcast progress (broadcast_id: {payload["broadcast_id"]} -error: {e})')
+
+        return {'sent': sum(sent), 'failed': len(sent) - sum(sent)}
 
 
 # create celery app
@@ -109,4 +261,3 @@ app, _ = create_worker_from(NotificationCeleryTaskImpl)
 if __name__ == '__main__':
     
     app.worker_main()
-
@@ -0,0 +1,120 @@
+from cache.cache_session import get_hosts_health, set_hosts_health
+from typing import Dict, List, Optional
+from time import time
+import logging
+import redis
+import os
+
+HOST_HEALTH_HISTORY = int(os.getenv('HOST_HEALTH_HISTORY', 10))
+HOST_HEALTH_FAILURE_THRESHOLD = int(os.getenv('HOST_HEALTH_FAILURE_THRESHOLD', 3))
+HOST_HEALTH_HEALTHY_INTERVAL = int(os.getenv('HOST_HEALTH_HEALTHY_INTERVAL', 300))
+HOST_HEALTH_DEGRADED_INTERVAL = int(os.getenv('HOST_HEALTH_DEGRADED_INTERVAL', 30))
+HOST_HEALTH_TTL = int(os.getenv('HOST_HEALTH_TTL', 24*60*60))
+
+logger = logging.getLogger('check_host_api.log')
+
+
+class HostHealth:
+
+    def __init__(self, host, record: dict= None):
+
+        record = record or {}
+
+        self.host = host
+        self.results = record.get('results', '')  # newest last, '1' healthy / '0' failed
+        self.consecutive_failures = int(record.get('consecutive_failures', 0))
+        self.last_probe = float(record.get('last_probe', 0))
+        self.next_probe = float(record.get('next_probe', 0))
+
+    @property
+    def success_ratio(self) -> Optional[float]:
+
+        if not self.results:
+            return None
+
+        return self.results.count('1') / len(self.results)
+
+    def to_record(self) -> dict:
+
+        return {
+            'results': self.results,
+            'consecutive_failures': self.consecutive_failures,
+            'last_probe': self.last_probe,
+            'next_probe': self.next_probe,
+            'success_ratio': self.success_ratio if self.success_ratio is not None else ''
+        }
+
+
+class HealthTracker:
+    """
+    per host health kept in redis (host_health:<ip>) between the passes:
+    the last results, the rolling success ratio and the probe timestamps.
+    healthy hosts are probed every `healthy_interval` seconds, degraded ones
+    every `degraded_interval`, and a host is reported for replacement once
+    it reaches `failure_threshold` consecutive failed probes.
+    """
+
+    def __init__(self,
+                 cache_db: redis.Redis,
+                 history: int= HOST_HEALTH_HISTORY,
+                 failure_threshold: int= HOST_HEALTH_FAILURE_THRESHOLD,
+                 healthy_interval: int= HOST_HEALTH_HEALTHY_INTERVAL,
+                 degraded_interval: int= HOST_HEALTH_DEGRADED_INTERVAL,
+                 ttl: int= HOST_HEALTH_TTL):
+
+        self.cache_db = cache_db
+        self.history = history
+        self.failure_threshold = failure_threshold
+        self.healthy_interval = healthy_interval
+        self.degraded_interval = degraded_interval
+        self.ttl = ttl
+
+    def load(self, hosts: List[str]) -> Dict[str, HostHealth]:
+
+        records = get_hosts_health(hosts, self.cache_db)
+        return {host: HostHealth(host, record) for host, record in zip(hosts, records)}
+
+    def due(self, servers: List[dict], now: float= None) -> List[dict]:
+
+        now = now or time()
+        health = self.load([server['server_ip'] for server in servers])
+
+        return [server for server in servers if health[server['server_ip']].next_probe <= now]
+
+    def interval(self, health: HostHealth) -> int:
+
+        if health.consecutive_failures == 0 and (health.success_ratio or 0) >= 0.9:
+            return self.healthy_interval
+
+        return self.degraded_interval
+
+    def record(self, statuses: Dict[str, Optional[bool]], now: float= None) -> List[str]:
+        """
+        store the new probe results, returns the hosts that have just reached
+        the failure threshold (each failure streak is reported once)
+        """
+        now = now or time()
+        health = self.load(list(statuses))
+        failed_hosts = []
+
+        for host, status in statuses.items():
+
+            item = health[host]
+
+            # an undecided probe (check-host unreachable) is neither a success nor a failure
+            if status is not None:
+                item.results = (item.results + ('1' if status else '0'))[-self.history:]
+                item.consecutive_failures = 0 if status else item.consecutive_failures + 1
+
+                if item.consecutive_failures == self.failure_threshold:
+                    failed_hosts.append(host)
+
+            item.last_probe = now
+            item.next_probe = now + self.interval(item)
+
+            if status is False:
+                logger.info(f'[health] failed probe (host: {host} -consecutive_failures: {item.consecutive_failures} -success_ratio: {item.success_ratio})')
+
+        set_hosts_health({host: item.to_record() for host, item in health.items()}, self.ttl, self.cache_db)
+
+        return failed_hosts
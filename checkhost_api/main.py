@@ -1,11 +1,14 @@
-import requests
 import sys
 
 sys.path.append('/root/ssh-master-api')
 
 from fastapi import HTTPException
-from time import sleep
+from typing import Dict, List
+import asyncio
 import logging
+import random
+import httpx
+import os
 
 logger = logging.getLogger('check_host_api.log') 
 logger.setLevel(logging.INFO)
@@ -30,68 +33,169 @@ headers = {
 nodes = ['ir1.node.check-host.net', 'ir3.node.check-host.net', 'ir4.node.check-host.net', 'ir5.node.check-host.net', 'ir6.node.check-host.net']
 
 
-def check_host(host, _try= 1):
+CHECK_HOST_URL = 'https://check-host.net'
+CHECK_HOST_MAX_TRIES = int(os.getenv('CHECK_HOST_MAX_TRIES', 10))
+CHECK_HOST_CONCURRENCY = int(os.getenv('CHECK_HOST_CONCURRENCY', 10))
+CHECK_HOST_POLL_INTERVAL = float(os.getenv('CHECK_HOST_POLL_INTERVAL', 2))
+CHECK_HOST_BASE_DELAY = float(os.getenv('CHECK_HOST_BASE_DELAY', 3))
+CHECK_HOST_MAX_DELAY = float(os.getenv('CHECK_HOST_MAX_DELAY', 60))
+# a check that has no complete result after this is counted as a failed try
+CHECK_HOST_RESULT_TIMEOUT = float(os.getenv('CHECK_HOST_RESULT_TIMEOUT', 30))
 
-    params = '&'.join([f'node={node}' for node in nodes])
-    resp = requests.get(f'https://check-host.net/check-ping?host={host}&{params}', headers= headers)
+
+def parse_check_result(result: dict):
+    """
+    True if every node pinged the host successfully, False if one of them
+    failed, None while some nodes have not reported yet
+    """
+    if any(item is None for item in result.values()):
+        return None
+
+    for node_result in result.values():
+
+        if node_result and node_result[0] is not None:
+
+            res = [1 if (res and res[0] == 'OK') else 0 for res in node_result[0]]
+            if not all(res):
+                return False
+
+    return True
+
+
+def jittered_delay(tries: int, base_delay: float= CHECK_HOST_BASE_DELAY, max_delay: float= CHECK_HOST_MAX_DELAY):
+
+    return min(max_delay, base_delay * 2 ** (tries - 1)) * random.uniform(0.5, 1.5)
+
+
+class HostProbe:
+
+    def __init__(self, host):
+
+        self.host = host
+        self.tries = 0
+        self.errors = 0
+        self.request_id = None
+        self.submitted_at = None
+        self.next_submit_at = 0
+        self.status = None
+        self.done = False
+
+
+async def _submit(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, probe: HostProbe):
+
+    params = [('host', probe.host)] + [('node', node) for node in nodes]
+
+    async with semaphore:
+        resp = await client.get(f'{CHECK_HOST_URL}/check-ping', params= params, headers= headers)
 
     if resp.status_code != 200:
-        logger.error(f'failed in send requests to check host (host: {host} -err_status: {resp.status_code} -err_msg: {resp.content})')
+        logger.error(f'failed in send requests to check host (host: {probe.host} -err_status: {resp.status_code} -err_msg: {resp.content})')
         raise HTTPException(status_code= resp.status_code, detail={'internal_code': 5101, 'detail': f'check-host (error: {resp.content})'})
 
-    request_id = resp.json()['request_id']  
-    sleep(2)      
-
-    status = request_id_worker(request_id)
-
-    if status == False:
-        if _try >= 10:   
-            return status
-    
-        sleep(3)
-        status = check_host(host , _try= _try + 1)
-        return status
-    
-    else:
-        return status
-
-
-def request_id_worker(request_id):
-
-    while True:
-
-        for _ in range(3):
-            result = requests.get(f'https://check-host.net/check-result/{request_id}', headers= headers)
-            
-            if result.status_code == 525:
-                logger.error(f'(handshake) failed in send requests to get result of check host (request_id: {request_id} -err_status: {result.status_code} -err_msg: {result.content})')
-                continue
-
-            if result.status_code != 200:
-                logger.error(f'failed in send requests to get result of check host (request_id: {request_id} -err_status: {result.status_code} -err_msg: {result.content})')
-                raise HTTPException(status_code= result.status_code, detail={'internal_code': 5102, 'detail': f'check-result (error: {result.content})'})
-            
-            check_none_result = any([item is None for item in result.json().values()])
-            
-            if check_none_result is True:
-                sleep(2)
-                continue 
-            
-            break
-        
-        if check_none_result is True:
-            continue 
-
-
-        health_status = True
-        for node_result in result.json().values():
-            
-            if node_result[0] is not None:
-                
-                res = [1 if (res and res[0] == 'OK') else 0 for res  in node_result[0] ]
-                
-                if not all(res):
-                    health_status = False
-                    break
-        
-        return health_status
\ No newline at end of file
+    return resp.json()['request_id']
+
+
+async def _poll(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, probe: HostProbe):
+
+    async with semaphore:
+        result = await client.get(f'{CHECK_HOST_URL}/check-result/{probe.request_id}', headers= headers)
+
+    if result.status_code == 525:
+        logger.error(f'(handshake) failed in send requests to get result of check host (request_id: {probe.request_id} -err_status: {result.status_code} -err_msg: {result.content})')
+        return None
+
+    if result.status_code != 200:
+        logger.error(f'failed in send requests to get result of check host (request_id: {probe.request_id} -err_status: {result.status_code} -err_msg: {result.content})')
+        raise HTTPException(status_code= result.status_code, detail={'internal_code': 5102, 'detail': f'check-result (error: {result.content})'})
+
+    return parse_check_result(result.json())
+
+
+async def _check_hosts(hosts, max_tries: int, concurrency: int, poll_interval: float):
+
+    probes = {host: HostProbe(host) for host in dict.fromkeys(hosts)}
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+
+    def failed_try(probe: HostProbe, api_error= False):
+
+        probe.request_id = None
+        if api_error:
+            probe.errors += 1
+
+        else:
+            probe.tries += 1
+
+        if probe.tries >= max_tries:
+            probe.status, probe.done = False, True
+
+        elif probe.errors >= max_tries:
+            # check-host itself is failing, the health of the host is unknown
+            probe.status, probe.done = None, True
+
+        else:
+            probe.next_submit_at = loop.time() + jittered_delay(probe.tries + probe.errors)
+
+    async with httpx.AsyncClient(timeout= httpx.Timeout(15, connect= 5)) as client:
+
+        while not all(probe.done for probe in probes.values()):
+
+            now = loop.time()
+
+            # submit a new check for every host that is idle and due
+            to_submit = [probe for probe in probes.values() if not probe.done and probe.request_id is None and probe.next_submit_at <= now]
+            results = await asyncio.gather(*[_submit(client, semaphore, probe) for probe in to_submit], return_exceptions= True)
+
+            for probe, result in zip(to_submit, results):
+
+                if isinstance(result, Exception):
+                    failed_try(probe, api_error= True)
+                    continue
+
+                probe.request_id = result
+                probe.submitted_at = loop.time()
+
+            # the results need a moment on check-host before they show up
+            await asyncio.sleep(poll_interval)
+
+            # poll every outstanding request together
+            to_poll = [probe for probe in probes.values() if probe.request_id is not None]
+            results = await asyncio.gather(*[_poll(client, semaphore, probe) for probe in to_poll], return_exceptions= True)
+
+            for probe, result in zip(to_poll, results):
+
+                if isinstance(result, Exception):
+                    failed_try(probe, api_error= True)
+
+                elif result is True:
+                    probe.status, probe.done, probe.request_id = True, True, None
+
+                elif result is False:
+                    failed_try(probe)
+
+                elif loop.time() - probe.submitted_at > CHECK_HOST_RESULT_TIMEOUT:
+                    failed_try(probe)
+
+    return {host: probe.status for host, probe in probes.items()}
+
+
+def check_hosts(hosts: List[str], max_tries: int= CHECK_HOST_MAX_TRIES, concurrency: int= CHECK_HOST_CONCURRENCY, poll_interval: float= CHECK_HOST_POLL_INTERVAL) -> Dict[str, bool]:
+    """
+    probe many hosts concurrently from the iranian check-host nodes, a host is
+    healthy as soon as one check passes and filtered (False) after `max_tries`
+    failed checks; None means check-host could not be reached.
+    must be called from a sync context.
+    """
+    if not hosts:
+        return {}
+
+    return asyncio.run(_check_hosts(hosts, max_tries, concurrency, poll_interval))
+
+
+def check_host(host):
+
+    status = check_hosts([host])[host]
+    if status is None:
+        raise HTTPException(status_code= 503, detail={'internal_code': 5101, 'detail': f'check-host is not reachable (host: {host})'})
+
+    return status
@@ -0,0 +1,164 @@
+from checkhost_api.main import check_hosts
+from typing import Dict, List, Optional, Tuple
+from time import time
+import asyncio
+import logging
+import os
+
+PROBE_SLAVE_PORT = int(os.getenv('SLAVE_PORT', 8090))
+PROBE_CONNECT_TIMEOUT = float(os.getenv('PROBE_CONNECT_TIMEOUT', 3))
+PROBE_CONCURRENCY = int(os.getenv('PROBE_CONCURRENCY', 100))
+PROBE_SECOND_STAGE_INTERVAL = int(os.getenv('PROBE_SECOND_STAGE_INTERVAL', 15*60))
+
+logger = logging.getLogger('check_host_api.log')
+
+
+class Prober:
+    """
+    a prober gets the servers ({'server_ip', 'ssh_port', ...} as returned by
+    /server/fetch) and returns {server_ip: status}, where status is True
+    (healthy), False (unreachable/filtered) or None (could not be decided)
+    """
+
+    name = 'base'
+
+    def probe(self, servers: List[dict]) -> Dict[str, Optional[bool]]:
+        raise NotImplementedError
+
+
+class TcpProber(Prober):
+    """
+    local first stage: concurrent tcp connects to the slave api port and the
+    ssh port of every server. it runs outside iran, so neither answer is
+    conclusive: a success does not prove the host is reachable from there and
+    a failure can be a restarting slave daemon or the master's own network
+    """
+
+    name = 'tcp'
+
+    def __init__(self, slave_port: int= PROBE_SLAVE_PORT, timeout: float= PROBE_CONNECT_TIMEOUT, concurrency: int= PROBE_CONCURRENCY):
+
+        self.slave_port = slave_port
+        self.timeout = timeout
+        self.concurrency = concurrency
+
+    async def _connect(self, semaphore: asyncio.Semaphore, host, port):
+
+        async with semaphore:
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout= self.timeout)
+
+            except (OSError, asyncio.TimeoutError):
+                return False
+
+            writer.close()
+            try:
+                await writer.wait_closed()
+
+            except OSError:
+                pass
+
+            return True
+
+    async def _probe(self, servers: List[dict]):
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def probe_server(server):
+            ports = {self.slave_port, server['ssh_port']}
+            results = await asyncio.gather(*[self._connect(semaphore, server['server_ip'], port) for port in ports])
+            return server['server_ip'], all(results)
+
+        return dict(await asyncio.gather(*[probe_server(server) for server in servers]))
+
+    def probe(self, servers: List[dict]) -> Dict[str, Optional[bool]]:
+
+        if not servers:
+            return {}
+
+        return asyncio.run(self._probe(servers))
+
+
+class CheckHostProber(Prober):
+    """ external stage, pings from the check-host.net nodes inside iran """
+
+    name = 'check_host'
+
+    def probe(self, servers: List[dict]) -> Dict[str, Optional[bool]]:
+        return check_hosts([server['server_ip'] for server in servers])
+
+
+class StaticProber(Prober):
+    """ stand-in for tests, answers from a fixed table and records the probed hosts """
+
+    name = 'static'
+
+    def __init__(self, results: Dict[str, Optional[bool]], default: Optional[bool]= True):
+
+        self.results = results
+        self.default = default
+        self.calls: List[List[str]] = []
+
+    def probe(self, servers: List[dict]) -> Dict[str, Optional[bool]]:
+
+        hosts = [server['server_ip'] for server in servers]
+        self.calls.append(hosts)
+
+        return {host: self.results.get(host, self.default) for host in hosts}
+
+
+class TieredProber(Prober):
+    """
+    the first (local) stage is a cheap pre-filter, only the second (in-region)
+    stage can report a host as down. a host that fails locally is suspicious
+    and goes to the second stage on every pass. a host that answers can still
+    be filtered inside iran, so it goes there too, every `second_interval`
+    seconds while that stage finds it healthy and on every pass once it did not.
+    """
+
+    name = 'tiered'
+
+    def __init__(self, first: Prober, second: Prober, second_interval: int= PROBE_SECOND_STAGE_INTERVAL):
+
+        self.first = first
+        self.second = second
+        self.second_interval = second_interval
+        self.second_results: Dict[str, Tuple[float, bool]] = {}  # host -> (probed at, last decided status)
+
+    def probe(self, servers: List[dict], now: float= None) -> Dict[str, Optional[bool]]:
+
+        now = now or time()
+        results = self.first.probe(servers)
+
+        second_servers = []
+        for server in servers:
+
+            host = server['server_ip']
+            last = self.second_results.get(host)
+
+            if results.get(host) is not True or last is None or last[1] is not True or now - last[0] >= self.second_interval:
+                second_servers.append(server)
+
+            else:
+                # reachable from here and recently healthy from inside the region
+                results[host] = True
+
+        if second_servers:
+            logger.info(f'[prober] running {self.second.name} (hosts: {[server["server_ip"] for server in second_servers]})')
+
+            statuses = self.second.probe(second_servers)
+            for server in second_servers:
+
+                # a local failure is never reported on its own, an unanswered host stays undecided
+                host = server['server_ip']
+                status = statuses.get(host)
+
+                results[host] = status
+                if status is not None:
+                    self.second_results[host] = (now, status)
+
+        return results
+
+
+def default_prober() -> Prober:
+    return TieredProber(TcpProber(), CheckHostProber())
@@ -0,0 +1,54 @@
+import sys
+
+sys.path.append('/root/ssh-master-api')
+
+from checkhost_api.prober import StaticProber, TieredProber
+
+SERVERS = [
+    {'server_ip': '10.0.0.1', 'ssh_port': 22},
+    {'server_ip': '10.0.0.2', 'ssh_port': 22},
+]
+
+
+def test_local_failure_is_checked_from_inside_the_region():
+
+    first = StaticProber({'10.0.0.1': False})
+    second = StaticProber({}, default= True)
+
+    results = TieredProber(first, second).probe(SERVERS)
+
+    assert results['10.0.0.1'] is True
+    assert '10.0.0.1' in second.calls[0]
+
+
+def test_down_only_when_the_region_says_so():
+
+    first = StaticProber({'10.0.0.1': False})
+    second = StaticProber({'10.0.0.1': False})
+
+    results = TieredProber(first, second).probe(SERVERS)
+
+    assert results['10.0.0.1'] is False
+    assert results['10.0.0.2'] is True
+
+
+def test_unanswered_local_failure_stays_undecided():
+
+    first = StaticProber({'10.0.0.1': False})
+    second = StaticProber({'10.0.0.1': None})
+
+    assert TieredProber(first, second).probe(SERVERS)['10.0.0.1'] is None
+
+
+def test_healthy_host_skips_the_region_until_the_interval():
+
+    first = StaticProber({})
+    second = StaticProber({})
+    prober = TieredProber(first, second, second_interval= 60)
+
+    prober.probe(SERVERS, now= 1000)
+    prober.probe(SERVERS, now= 1030)
+    assert len(second.calls) == 1
+
+    prober.probe(SERVERS, now= 1060)
+    assert len(second.calls) == 2
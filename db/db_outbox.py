@@ -0,0 +1,80 @@
+from sqlalchemy.orm.session import Session
+from sqlalchemy import and_
+from db.models import DbAccountOutbox
+from schemas import OutboxOperation
+from datetime import datetime
+from typing import List
+
+
+def add_operations(server_ip, usernames: List[str], operation: OutboxOperation, db: Session, commit= True):
+    # meant to be called with commit=False inside the transaction that changes the services
+    time_now = datetime.now()
+
+    db.add_all([
+        DbAccountOutbox(server_ip= server_ip, username= username, operation= operation, created= time_now)
+            for username in usernames
+    ])
+
+    if commit:
+        db.commit()
+
+
+def add_operation(server_ip, username, operation: OutboxOperation, db: Session, commit= True):
+
+    return add_operations(server_ip, [username], operation, db, commit= commit)
+
+
+def add_transfer_operations(old_server_ip, new_server_ip, usernames: List[str], blocked_usernames: List[str], delete_old_users: bool, db: Session, commit= True):
+
+    add_operations(new_server_ip, usernames, OutboxOperation.CREATE, db, commit= False)
+    add_operations(new_server_ip, blocked_usernames, OutboxOperation.BLOCK, db, commit= False)
+
+    if delete_old_users:
+        add_operations(old_server_ip, usernames, OutboxOperation.DELETE, db, commit= False)
+
+    if commit:
+        db.commit()
+
+
+def get_pending_servers(db: Session) -> List[str]:
+    """ the servers that have undelivered operations """
+
+    rows = db.query(DbAccountOutbox.server_ip)\
+        .filter(DbAccountOutbox.delivered == None)\
+        .distinct().all()
+
+    return [row.server_ip for row in rows]
+
+
+def get_operations(server_ip, limit: int, db: Session) -> List[DbAccountOutbox]:
+    # a row that commits after rows with higher ids is still pending here, nothing is skipped by an offset
+    return db.query(DbAccountOutbox)\
+        .filter(and_(DbAccountOutbox.server_ip == server_ip, DbAccountOutbox.delivered == None))\
+        .order_by(DbAccountOutbox.outbox_id).limit(limit).all()
+
+
+def mark_delivered(outbox_ids: List[int], db: Session, commit= True):
+
+    if not outbox_ids:
+        return 0
+
+    updated = db.query(DbAccountOutbox)\
+        .filter(DbAccountOutbox.outbox_id.in_(outbox_ids))\
+        .update({DbAccountOutbox.delivered: datetime.now()}, synchronize_session= False)
+
+    if commit:
+        db.commit()
+
+    return updated
+
+
+def delete_delivered_operations(before: datetime, db: Session, commit= True):
+
+    deleted = db.query(DbAccountOutbox)\
+        .filter(and_(DbAccountOutbox.delivered != None, DbAccountOutbox.delivered < before))\
+        .delete(synchronize_session= False)
+
+    if commit:
+        db.commit()
+
+    return deleted
@@ -5,8 +5,28 @@ from schemas import (
     ServerStatusDb,
     ServerType
 )
+from cache.capacity_index import capacity_index
 from typing import List
-from sqlalchemy import and_
+from sqlalchemy import and_, event
+
+
+def _queue_capacity_delta(server_ip, delta, db: Session):
+    # the index only follows committed counters, a rolled back transaction must leave it untouched
+    deltas = db.info.setdefault('capacity_deltas', {})
+    deltas[server_ip] = deltas.get(server_ip, 0) + delta
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_capacity_deltas(session: Session):
+
+    for server_ip, delta in session.info.pop('capacity_deltas', {}).items():
+        if delta:
+            capacity_index.adjust(server_ip, delta)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_capacity_deltas(session: Session):
+    session.info.pop('capacity_deltas', None)
 
 
 def __get_attrs(**kwargs):
@@ -47,6 +67,7 @@ def create_server(request: ServerRegister, db: Session) -> DbServer:
 
     db.commit()
     db.refresh(server)
+    capacity_index.invalidate()
 
     return server
 
@@ -98,6 +119,12 @@ def get_servers_by_type(type_: ServerType,
         return db.query(DbServer).filter(DbServer.server_type == type_ ).all()
 
 
+def get_capacity_rows(db: Session):
+
+    return db.query(DbServer.server_ip, DbServer.ssh_port, DbServer.ssh_accounts_number, DbServer.max_users)\
+        .filter(and_(DbServer.generate_status == ServerStatusDb.ENABLE, DbServer.status == ServerStatusDb.ENABLE)).all()
+
+
 def get_server_by_ip(ip, db: Session) -> DbServer:
 
     return db.query(DbServer).filter(DbServer.server_ip == ip ).first()
@@ -133,6 +160,7 @@ def update_max_user(server_ip, new_caps, db: Session):
 
     server.update({DbServer.max_users: new_caps })
     db.commit()
+    capacity_index.invalidate()
 
     return server
 
@@ -142,6 +170,8 @@ def increase_ssh_accounts_number(server_ip, db: Session, commit= True, number= 1
     server = db.query(DbServer).filter(DbServer.server_ip == server_ip )
     server.update({DbServer.ssh_accounts_number: server.first().ssh_accounts_number + number})
     
+    _queue_capacity_delta(server_ip, number, db)
+
     if commit:
         db.commit()
 
@@ -154,6 +184,8 @@ def decrease_ssh_accounts_number(server_ip, db: Session, commit= True, number= 1
 
     if (server.first().ssh_accounts_number - number) >= 0 :
         server.update({DbServer.ssh_accounts_number: server.first().ssh_accounts_number - number})
+        _queue_capacity_delta(server_ip, -number, db)
+
         if commit:
             db.commit()
 
@@ -184,6 +216,8 @@ def change_generate_status(server_ip, new_status: ServerStatusDb, db: Session, c
     if commit:
         db.commit()
 
+    capacity_index.invalidate()
+
     return server
 
 
@@ -206,6 +240,8 @@ def change_server_status(server_ip, new_status: ServerStatusDb, db: Session, com
     if commit:
         db.commit()
 
+    capacity_index.invalidate()
+
     return server
 
 
@@ -0,0 +1,89 @@
+from sqlalchemy.orm.session import Session
+from sqlalchemy.dialects.mysql import insert
+from db.models import DbAgentServiceCounter
+from schemas import ServiceStatusDb, ConfigType
+from typing import Dict, List, Tuple
+
+CounterKey = Tuple[int, ConfigType, ServiceStatusDb]  # (agent_id, service_type, status)
+
+
+def add_counts(deltas: Dict[CounterKey, int], db: Session, commit= False):
+    # meant to run inside the transaction that changes the services, so it never commits by default
+    rows = [
+        {'agent_id': agent_id, 'service_type': service_type, 'status': status, 'count': delta}
+            for (agent_id, service_type, status), delta in sorted(deltas.items(), key= lambda item: (item[0][0], item[0][1].value, item[0][2].value))
+            if delta
+    ]
+    if not rows:
+        return
+
+    # sorted keys keep the row lock order the same in every transaction
+    stmt = insert(DbAgentServiceCounter).values(rows)
+    stmt = stmt.on_duplicate_key_update(count= DbAgentServiceCounter.count + stmt.inserted.count)
+    db.execute(stmt)
+
+    if commit:
+        db.commit()
+
+
+def add_count(agent_id, service_type: ConfigType, status: ServiceStatusDb, delta: int, db: Session, commit= False):
+
+    return add_counts({(agent_id, service_type, status): delta}, db, commit= commit)
+
+
+def move_counts(rows: List[Tuple[int, ConfigType, ServiceStatusDb, int]], new_status: ServiceStatusDb, db: Session, commit= False):
+    """ rows are (agent_id, service_type, old_status, count) of the services that switch to new_status """
+    deltas = {}
+    for agent_id, service_type, old_status, count in rows:
+
+        if old_status == new_status:
+            continue
+
+        deltas[(agent_id, service_type, old_status)] = deltas.get((agent_id, service_type, old_status), 0) - count
+        deltas[(agent_id, service_type, new_status)] = deltas.get((agent_id, service_type, new_status), 0) + count
+
+    add_counts(deltas, db, commit= commit)
+
+
+def get_counts_by_agent(agent_id, db: Session) -> Dict[Tuple[ConfigType, ServiceStatusDb], int]:
+
+    rows = db.query(DbAgentServiceCounter).filter(DbAgentServiceCounter.agent_id == agent_id).all()
+
+    return {(row.service_type, row.status): row.count for row in rows}
+
+
+def get_all_counts(db: Session) -> Dict[int, Dict[Tuple[ConfigType, ServiceStatusDb], int]]:
+
+    counts = {}
+    for row in db.query(DbAgentServiceCounter).all():
+        counts.setdefault(row.agent_id, {})[(row.service_type, row.status)] = row.count
+
+    return counts
+
+
+def reconcile_counts(actual: Dict[int, Dict[Tuple[ConfigType, ServiceStatusDb], int]], db: Session, commit= True) -> Dict[CounterKey, int]:
+    """
+    fix the counters against `actual` (the grouped count of the services) and
+    return the drift that was applied. both reads have to come from the same
+    transaction snapshot, then the drift is added instead of overwriting the
+    counters so writes committed in the meantime are kept
+    """
+    stored = get_all_counts(db)
+
+    drift = {}
+    for agent_id in set(actual) | set(stored):
+
+        actual_counts = actual.get(agent_id, {})
+        stored_counts = stored.get(agent_id, {})
+
+        for service_type, status in set(actual_counts) | set(stored_counts):
+            delta = actual_counts.get((service_type, status), 0) - stored_counts.get((service_type, status), 0)
+            if delta:
+                drift[(agent_id, service_type, status)] = delta
+
+    add_counts(drift, db)
+
+    if commit:
+        db.commit()
+
+    return drift
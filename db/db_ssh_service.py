@@ -1,9 +1,10 @@
 from sqlalchemy.orm.session import Session
-from db.models import DbSshService
+from db.models import DbSshService, DbDomain
 from schemas import SshService, ServiceStatusDb, ConfigType
-from sqlalchemy import and_
+from sqlalchemy import and_, func, cast, Integer, BigInteger
+from db import db_service_counter
 from datetime import datetime
-from typing import List
+from typing import List, Dict
 
 
 def __get_attrs(**kwargs):
@@ -32,9 +33,18 @@ def __get_attrs(**kwargs):
             
             else:
                 prepar_attrs.append(dic_attrs[item] == value)
+
+    if 'expire' in kwargs and 'status' not in kwargs:
+        prepar_attrs.append(_any_status())
+
     return prepar_attrs
 
 
+def _any_status():
+    # a no-op filter that lets the (status, expire) index serve an expire range without a status
+    return DbSshService.status.in_(list(ServiceStatusDb))
+
+
 def create_ssh(request: SshService, db: Session, commit=True) -> DbSshService:
     
     service = DbSshService(
@@ -54,6 +64,8 @@ def create_ssh(request: SshService, db: Session, commit=True) -> DbSshService:
     )
     
     db.add(service)
+    db_service_counter.add_count(request.agent_id, request.service_type, request.status, 1, db)
+
     if commit:
         db.commit()
         db.refresh(service)
@@ -67,21 +79,39 @@ def get_services_by_attrs(db: Session, **kwargs) -> List[DbSshService]:
     return db.query(DbSshService).filter(and_(*attrs)).all()
 
 
-def get_services_by_agent_id(agent_id , db: Session, status: ServiceStatusDb= None, type_ : ConfigType = None) -> List[DbSshService]:
+def search_services(db: Session, after_service_id: int= None, limit: int= 100, **kwargs):
+    """ one page of (DbSshService, domain_name, server_ip) ordered by service_id, keyset paginated """
+    attrs = __get_attrs(**kwargs)
+    if after_service_id is not None:
+        attrs.append(DbSshService.service_id > after_service_id)
 
-    args = [DbSshService.agent_id == agent_id]
+    return db.query(DbSshService, DbDomain.domain_name, DbDomain.server_ip)\
+        .join(DbDomain, DbDomain.domain_id == DbSshService.domain_id)\
+        .filter(and_(*attrs))\
+        .order_by(DbSshService.service_id)\
+        .limit(limit).all()
 
-    if status != None:
-        args.append(DbSshService.status == status)
-    
-    if type_ != None:
-        args.append(DbSshService.service_type == type_)
 
-    return db.query(DbSshService).filter(and_(*args)).all()
+def iter_services(db: Session, chunk_size= 1000, **kwargs):
+    """ every (DbSshService, domain_name, server_ip) matching the attrs, streamed with a server side cursor """
+    attrs = __get_attrs(**kwargs)
 
-def get_services_by_chat_id(chat_id , db: Session, status: ServiceStatusDb= None, type_ : ConfigType = None) -> List[DbSshService]:
+    yield from db.query(DbSshService, DbDomain.domain_name, DbDomain.server_ip)\
+        .join(DbDomain, DbDomain.domain_id == DbSshService.domain_id)\
+        .filter(and_(*attrs))\
+        .order_by(DbSshService.service_id)\
+        .yield_per(chunk_size)
 
-    args = [DbSshService.user_chat_id == chat_id]
+
+def count_services_by_attrs(db: Session, **kwargs) -> int:
+
+    attrs = __get_attrs(**kwargs)
+    return db.query(func.count(DbSshService.service_id)).filter(and_(*attrs)).scalar()
+
+
+def get_services_by_agent_id(agent_id , db: Session, status: ServiceStatusDb= None, type_ : ConfigType = None) -> List[DbSshService]:
+
+    args = [DbSshService.agent_id == agent_id]
 
     if status != None:
         args.append(DbSshService.status == status)
@@ -154,6 +184,11 @@ def get_service_by_username(username , db: Session) -> DbSshService:
     return db.query(DbSshService).filter(DbSshService.username == username ).first()
 
 
+def get_all_usernames(db: Session) -> List[str]:
+
+    return [row.username for row in db.query(DbSshService.username).all()]
+
+
 def get_services_by_plan_id(plan_id , db: Session, status: ServiceStatusDb= None, type_ : ConfigType = None) -> List[DbSshService]:
 
     args = [DbSshService.plan_id == plan_id]
@@ -180,12 +215,96 @@ def get_services_by_domain_id(domain_id, db: Session, status: ServiceStatusDb= N
     return db.query(DbSshService).filter(and_(*args)).all()
 
 
+def count_services_by_domain_of_server(server_ip, db: Session, status: List[ServiceStatusDb]= [ServiceStatusDb.ENABLE, ServiceStatusDb.DISABLE]) -> Dict[int, int]:
+
+    rows = db.query(DbSshService.domain_id, func.count(DbSshService.service_id))\
+        .join(DbDomain, DbDomain.domain_id == DbSshService.domain_id)\
+        .filter(and_(DbDomain.server_ip == server_ip, DbSshService.status.in_(status)))\
+        .group_by(DbSshService.domain_id).all()
+
+    return {domain_id: count for domain_id, count in rows}
+
+
+def count_services_by_agents(db: Session) -> Dict[int, Dict[tuple, int]]:
+    """ agent_id -> {(service_type, status): count} in a single grouped scan """
+
+    rows = db.query(DbSshService.agent_id, DbSshService.service_type, DbSshService.status, func.count(DbSshService.service_id))\
+        .group_by(DbSshService.agent_id, DbSshService.service_type, DbSshService.status).all()
+
+    counts = {}
+    for agent_id, service_type, status, count in rows:
+        counts.setdefault(agent_id, {})[(service_type, status)] = count
+
+    return counts
+
+
+def get_usernames_by_server(server_ip, db: Session, status: List[ServiceStatusDb]= [ServiceStatusDb.ENABLE, ServiceStatusDb.DISABLE, ServiceStatusDb.EXPIRED]) -> List[str]:
+
+    rows = db.query(DbSshService.username)\
+        .join(DbDomain, DbDomain.domain_id == DbSshService.domain_id)\
+        .filter(and_(DbDomain.server_ip == server_ip, DbSshService.status.in_(status))).all()
+
+    return [row.username for row in rows]
+
+
+def _username_bucket(buckets_number: int):
+    # same hash as utils.digest.username_hash, evaluated by mysql
+    return cast(func.conv(func.substr(func.md5(DbSshService.username), 16, 4), 16, 10), Integer) % buckets_number
+
+
+def get_users_digest_by_server(server_ip, buckets_number: int, db: Session, status: List[ServiceStatusDb]= [ServiceStatusDb.ENABLE, ServiceStatusDb.DISABLE, ServiceStatusDb.EXPIRED]):
+
+    bucket = _username_bucket(buckets_number).label('bucket')
+    value = cast(func.conv(func.substr(func.md5(DbSshService.username), 1, 15), 16, 10), BigInteger)
+
+    return db.query(bucket, func.count(DbSshService.service_id).label('count'), func.bit_xor(value).label('digest'))\
+        .join(DbDomain, DbDomain.domain_id == DbSshService.domain_id)\
+        .filter(and_(DbDomain.server_ip == server_ip, DbSshService.status.in_(status)))\
+        .group_by(bucket).all()
+
+
+def get_usernames_by_server_buckets(server_ip, buckets: List[int], buckets_number: int, db: Session, status: List[ServiceStatusDb]= [ServiceStatusDb.ENABLE, ServiceStatusDb.DISABLE, ServiceStatusDb.EXPIRED]) -> List[str]:
+
+    rows = db.query(DbSshService.username)\
+        .join(DbDomain, DbDomain.domain_id == DbSshService.domain_id)\
+        .filter(and_(DbDomain.server_ip == server_ip, DbSshService.status.in_(status), _username_bucket(buckets_number).in_(buckets))).all()
+
+    return [row.username for row in rows]
+
+
+def get_credentials_by_server(server_ip, db: Session, status: List[ServiceStatusDb]= [ServiceStatusDb.ENABLE, ServiceStatusDb.DISABLE, ServiceStatusDb.EXPIRED]):
+
+    return db.query(DbSshService.username, DbSshService.password, DbSshService.status)\
+        .join(DbDomain, DbDomain.domain_id == DbSshService.domain_id)\
+        .filter(and_(DbDomain.server_ip == server_ip, DbSshService.status.in_(status))).all()
+
+
+def iter_credentials(db: Session, server_ip= None, usernames: List[str]= None, status: List[ServiceStatusDb]= [ServiceStatusDb.ENABLE, ServiceStatusDb.DISABLE, ServiceStatusDb.EXPIRED], chunk_size= 1000):
+
+    query = db.query(DbSshService.username, DbSshService.password, DbSshService.status)\
+        .filter(DbSshService.status.in_(status))
+
+    if server_ip is not None:
+        query = query.join(DbDomain, DbDomain.domain_id == DbSshService.domain_id).filter(DbDomain.server_ip == server_ip)
+
+    if usernames is None:
+        yield from query.yield_per(chunk_size)
+        return
+
+    # keep the IN list bounded
+    for index in range(0, len(usernames), chunk_size):
+        yield from query.filter(DbSshService.username.in_(usernames[index: index + chunk_size])).all()
+
+
 def get_services_by_range_time(start_time: datetime, end_time: datetime, db: Session, status: ServiceStatusDb= None, type_ : ConfigType = None) -> List[DbSshService]:
 
     args = [DbSshService.expire >= start_time, DbSshService.expire <= end_time]
 
     if status != None:
         args.append(DbSshService.status == status)
+
+    else:
+        args.append(_any_status())
     
     if type_ != None:
         args.append(DbSshService.service_type == type_)
@@ -193,6 +312,42 @@ def get_services_by_range_time(start_time: datetime, end_time: datetime, db: Ses
     return db.query(DbSshService).filter(and_(*args)).all()
 
 
+def get_services_with_server_by_expire(db: Session, status: List[ServiceStatusDb], start_time: datetime= None, end_time: datetime= None, type_ : ConfigType = None):
+
+    args = [DbSshService.status.in_(status)]
+
+    if start_time != None:
+        args.append(DbSshService.expire >= start_time)
+
+    if end_time != None:
+        args.append(DbSshService.expire <= end_time)
+
+    if type_ != None:
+        args.append(DbSshService.service_type == type_)
+
+    return db.query(DbSshService, DbDomain.server_ip)\
+        .join(DbDomain, DbDomain.domain_id == DbSshService.domain_id)\
+        .filter(and_(*args)).all()
+
+
+def get_services_with_server_by_ids(services_id: List[int], db: Session):
+    if not services_id:
+        return []
+
+    return db.query(DbSshService, DbDomain.server_ip)\
+        .join(DbDomain, DbDomain.domain_id == DbSshService.domain_id)\
+        .filter(DbSshService.service_id.in_(services_id)).all()
+
+
+def get_services_with_server_by_usernames(usernames: List[str], db: Session):
+    if not usernames:
+        return []
+
+    return db.query(DbSshService, DbDomain.server_ip)\
+        .join(DbDomain, DbDomain.domain_id == DbSshService.domain_id)\
+        .filter(DbSshService.username.in_(usernames)).all()
+
+
 def transfer_users_by_domain(old_domain_id, new_domain_id, db, commit= True, not_status: ServiceStatusDb= None):
 
     services = db.query(DbSshService).filter(and_(DbSshService.domain_id == old_domain_id, DbSshService.status != not_status))
@@ -227,11 +382,22 @@ def update_expire(service_id, new_expire, db: Session, commit= True):
     return service
 
 
+def _lock_status_counts(services_id: List[int], db: Session):
+    # the rows stay locked until commit, so a concurrent change cant move the same service twice
+    return db.query(DbSshService.agent_id, DbSshService.service_type, DbSshService.status, func.count(DbSshService.service_id))\
+        .filter(DbSshService.service_id.in_(services_id))\
+        .with_for_update()\
+        .group_by(DbSshService.agent_id, DbSshService.service_type, DbSshService.status).all()
+
+
 def change_status(service_id, new_status: ServiceStatusDb, db: Session, commit= True):
 
+    rows = _lock_status_counts([service_id], db)
+
     service = db.query(DbSshService).filter(DbSshService.service_id == service_id )
 
     service.update({DbSshService.status: new_status})
+    db_service_counter.move_counts(rows, new_status, db)
     
     if commit:
         db.commit()
@@ -239,20 +405,44 @@ def change_status(service_id, new_status: ServiceStatusDb, db: Session, commit=
     return service    
 
 
+def change_status_via_group(services_id: List[int], new_status: ServiceStatusDb, db: Session, commit= True):
+
+    if not services_id:
+        return None
+
+    rows = _lock_status_counts(services_id, db)
+
+    services = db.query(DbSshService).filter(DbSshService.service_id.in_(services_id))
+
+    services.update({DbSshService.status: new_status}, synchronize_session= False)
+    db_service_counter.move_counts(rows, new_status, db)
+
+    if commit:
+        db.commit()
+
+    return services
+
+
 def delete_service(service_id, db:Session):
 
     service = get_service_by_id(service_id, db)
     db.delete(service)
+    db_service_counter.add_count(service.agent_id, service.service_type, service.status, -1, db)
     db.commit()
 
     return True
 
 def delete_service_via_group(services, db:Session):
 
+    deltas = {}
     for service in services:
         service = get_service_by_id(service, db)
         db.delete(service)
 
+        key = (service.agent_id, service.service_type, service.status)
+        deltas[key] = deltas.get(key, 0) - 1
+
+    db_service_counter.add_counts(deltas, db)
     db.commit()
     return True
 
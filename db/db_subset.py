@@ -27,6 +27,11 @@ def get_subset_by_user(user_id: int, db: Session) -> DbSubsetProfit:
     return db.query(DbSubsetProfit).filter(DbSubsetProfit.user_id == user_id ).first()
 
 
+def get_all_subsets(db: Session) -> List[DbSubsetProfit]:
+
+    return db.query(DbSubsetProfit).all()
+
+
 def update_subset_by_user(user_id: int, new_not_released_profit: int, db: Session, commit= True) :
 
     subset = db.query(DbSubsetProfit).filter(DbSubsetProfit.user_id == user_id )
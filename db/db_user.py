@@ -1,12 +1,12 @@
 from sqlalchemy.orm.session import Session
-from sqlalchemy import and_
+from sqlalchemy import and_, func
 from schemas import (
     UserRegisterForDataBase,
     UserRole,
     UserStatusDb
 )
 from db.models import DbUser
-from typing import List
+from typing import List, Dict
 
 
 def __get_attrs(**kwargs):
@@ -80,10 +80,50 @@ def get_all_users_by_role(role: UserRole, db:Session, status: UserStatusDb= None
         return db.query(DbUser).filter(DbUser.role == role).all()
 
 
+def iter_users(db:Session, role: UserRole= None, status: UserStatusDb= None, chunk_size= 1000):
+
+    args = []
+    if role:
+        args.append(DbUser.role == role)
+
+    if status:
+        args.append(DbUser.status == status)
+
+    yield from db.query(DbUser).filter(and_(*args)).order_by(DbUser.user_id).yield_per(chunk_size)
+
+
 def get_user_by_user_id(user_id, db:Session) -> DbUser:
     return db.query(DbUser).filter(DbUser.user_id == user_id ).first()
 
 
+def get_users_by_user_ids(users_id: List[int], db:Session) -> List[DbUser]:
+    if not users_id:
+        return []
+
+    return db.query(DbUser).filter(DbUser.user_id.in_(users_id)).all()
+
+
+def get_users_by_usernames(usernames: List[str], db:Session) -> List[DbUser]:
+    if not usernames:
+        return []
+
+    return db.query(DbUser).filter(DbUser.username.in_(usernames)).all()
+
+
+def get_broadcast_recipients(db:Session, accept_usernames: List[str]= None, except_usernames: List[str]= None):
+
+    query = db.query(DbUser.username, DbUser.chat_id).filter(DbUser.status == UserStatusDb.ENABLE)
+
+    if accept_usernames:
+        query = query.filter(DbUser.username.in_(accept_usernames))
+
+    elif except_usernames:
+        query = query.filter(DbUser.username.notin_(except_usernames))
+
+    # a stable order lets an interrupted broadcast resume from its enqueued counter
+    return query.order_by(DbUser.user_id).all()
+
+
 def get_user_by_bot_token(bot_token, db:Session) -> DbUser:
     return db.query(DbUser).filter(DbUser.bot_token == bot_token ).first()
 
@@ -117,6 +157,14 @@ def get_users_by_parent_agent_id(parent_agent_id, db:Session, status: UserStatus
         return db.query(DbUser).filter(DbUser.parent_agent_id == parent_agent_id).all()
 
 
+def count_users_by_parent_agent(db:Session) -> Dict[int, int]:
+
+    rows = db.query(DbUser.parent_agent_id, func.count(DbUser.user_id))\
+        .group_by(DbUser.parent_agent_id).all()
+
+    return {parent_agent_id: count for parent_agent_id, count in rows}
+
+
 def update_role(user_id, new_role: UserRole, db:Session):
 
     user = db.query(DbUser).filter(DbUser.user_id == user_id )
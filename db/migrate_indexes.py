@@ -0,0 +1,131 @@
+import sys
+
+sys.path.append('/root/ssh-master-api')
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+from typing import Dict, List
+import logging
+
+logger = logging.getLogger('migrate_indexes.log')
+logger.setLevel(logging.INFO)
+
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s | %(message)s')
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+
+TABLE = 'ssh_service'
+
+# must stay in sync with DbSshService.__table_args__
+COMPOSITE_INDEXES = {
+    'ix_ssh_service_domain_id_status': ['domain_id', 'status'],
+    'ix_ssh_service_agent_id_service_type_status': ['agent_id', 'service_type', 'status'],
+    'ix_ssh_service_status_expire': ['status', 'expire'],
+    'ix_ssh_service_agent_id_created': ['agent_id', 'created'],
+}
+
+# single column indexes both layouts keep, the service search filters on
+# name and on a created range without an agent_id
+KEPT_INDEXES = {
+    'ix_ssh_service_name': ['name'],
+    'ix_ssh_service_created': ['created'],
+}
+
+# the single column indexes older models created and the upgrade drops, each
+# one is either a prefix of a composite index, a copy of the primary key or
+# a column no query filters on alone (expire always comes with a status)
+LEGACY_INDEXES = {
+    'ix_ssh_service_service_id': ['service_id'],
+    'ix_ssh_service_service_type': ['service_type'],
+    'ix_ssh_service_agent_id': ['agent_id'],
+    'ix_ssh_service_user_chat_id': ['user_chat_id'],
+    'ix_ssh_service_domain_id': ['domain_id'],
+    'ix_ssh_service_expire': ['expire'],
+    'ix_ssh_service_status': ['status'],
+}
+
+
+def _add_index(name, columns: List[str]):
+    # online ddl, the table stays readable and writable while the index is built
+    return f'ALTER TABLE {TABLE} ADD INDEX {name} ({", ".join(columns)}), ALGORITHM=INPLACE, LOCK=NONE'
+
+
+def _drop_index(name):
+    return f'ALTER TABLE {TABLE} DROP INDEX {name}, ALGORITHM=INPLACE, LOCK=NONE'
+
+
+def existing_indexes(engine: Engine) -> Dict[str, List[str]]:
+    """ name -> columns of the non unique indexes of the table """
+    return {index['name']: index['column_names'] for index in inspect(engine).get_indexes(TABLE) if not index['unique']}
+
+
+def plan_upgrade(existing: Dict[str, List[str]]) -> List[str]:
+    """
+    composite indexes are added before anything is dropped, the foreign keys
+    on agent_id and domain_id then always keep a usable index
+    """
+    statements = []
+    existing_columns = list(existing.values())
+
+    for name, columns in {**COMPOSITE_INDEXES, **KEPT_INDEXES}.items():
+        if name not in existing and columns not in existing_columns:
+            statements.append(_add_index(name, columns))
+
+    legacy_columns = list(LEGACY_INDEXES.values())
+    for name, columns in existing.items():
+        # matched by columns, a hand made index on the same column is just as redundant
+        if columns in legacy_columns:
+            statements.append(_drop_index(name))
+
+    return statements
+
+
+def plan_downgrade(existing: Dict[str, List[str]]) -> List[str]:
+
+    statements = []
+    existing_columns = list(existing.values())
+
+    for name, columns in {**LEGACY_INDEXES, **KEPT_INDEXES}.items():
+        if name not in existing and columns not in existing_columns:
+            statements.append(_add_index(name, columns))
+
+    for name in COMPOSITE_INDEXES:
+        if name in existing:
+            statements.append(_drop_index(name))
+
+    return statements
+
+
+def migrate(engine: Engine, direction: str= 'upgrade', dry_run: bool= False) -> List[str]:
+
+    existing = existing_indexes(engine)
+    statements = plan_upgrade(existing) if direction == 'upgrade' else plan_downgrade(existing)
+
+    for statement in statements:
+        logger.info(f'[migrate indexes] {statement}')
+
+        if dry_run:
+            continue
+
+        # every ALTER TABLE commits implicitly in mysql, so each one runs on its own
+        with engine.begin() as conn:
+            conn.execute(text(statement))
+
+    if not statements:
+        logger.info(f'[migrate indexes] {TABLE} already has the {direction} layout')
+
+    return statements
+
+
+if __name__ == '__main__':
+    # python db/migrate_indexes.py [upgrade|downgrade] [--dry-run]
+
+    from db.database import engine
+
+    args = sys.argv[1:]
+    direction = 'downgrade' if 'downgrade' in args else 'upgrade'
+
+    migrate(engine, direction, dry_run= '--dry-run' in args)
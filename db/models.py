@@ -6,7 +6,8 @@ from sqlalchemy import (
     ForeignKey,
     DateTime,
     Enum,
-    Float
+    Float,
+    Index
     )
 from schemas import (
     UserRole,
@@ -16,7 +17,8 @@ from schemas import (
     PlanStatusDb,
     UserStatusDb,
     DomainStatusDb,
-    ConfigType
+    ConfigType,
+    OutboxOperation
 )   
 
 class DbUser(Base):
@@ -91,11 +93,18 @@ class DbSshPlan(Base):
 class DbSshService(Base):
 
     __tablename__ = 'ssh_service'
+    __table_args__ = (
+        # the hot access paths, see db/migrate_indexes.py for existing databases
+        Index('ix_ssh_service_domain_id_status', 'domain_id', 'status'),
+        Index('ix_ssh_service_agent_id_service_type_status', 'agent_id', 'service_type', 'status'),
+        Index('ix_ssh_service_status_expire', 'status', 'expire'),
+        Index('ix_ssh_service_agent_id_created', 'agent_id', 'created'),
+    )
 
-    service_id = Column(Integer, index=True, primary_key=True, autoincrement=True)
-    service_type = Column(Enum(ConfigType), index=True, nullable=False)
-    agent_id = Column(Integer, ForeignKey('user.user_id'), index=True, nullable=False)
-    user_chat_id = Column(String(20), index=True, nullable=True)
+    service_id = Column(Integer, primary_key=True, autoincrement=True)
+    service_type = Column(Enum(ConfigType), nullable=False)
+    agent_id = Column(Integer, ForeignKey('user.user_id'), nullable=False)
+    user_chat_id = Column(String(20), nullable=True)
     name = Column(String(50), index=True, nullable=True)
     phone_number = Column(String(20), index=True, nullable=True)
     email = Column(String(100), index=True, nullable=True)
@@ -103,11 +112,11 @@ class DbSshService(Base):
     password = Column(String(30), nullable=False)
 
     plan_id = Column(Integer, ForeignKey('ssh_plan.plan_id'), index=True, nullable=False)
-    domain_id = Column(Integer, ForeignKey('domain.domain_id'), index=True, nullable=False)
+    domain_id = Column(Integer, ForeignKey('domain.domain_id'), nullable=False)
 
     created = Column(DateTime, index=True, nullable=False)
-    expire = Column(DateTime, index=True, nullable=False)
-    status = Column(Enum(ServiceStatusDb), index=True, nullable=False)
+    expire = Column(DateTime, nullable=False)
+    status = Column(Enum(ServiceStatusDb), nullable=False)
 
 
 class DbDomain(Base):
@@ -130,3 +139,27 @@ class DbSubsetProfit(Base):
     number_of_configs = Column(Integer, nullable= False)
 
 
+class DbAccountOutbox(Base):
+
+    __tablename__ = 'account_outbox'
+    __table_args__ = (
+        Index('ix_account_outbox_server_ip_delivered', 'server_ip', 'delivered'),
+    )
+
+    outbox_id = Column(Integer, index=True, primary_key=True, autoincrement=True)
+    server_ip = Column(String(20), nullable=False)
+    username = Column(String(30), nullable=False)
+    operation = Column(Enum(OutboxOperation), nullable=False)
+    created = Column(DateTime, index=True, nullable=False)
+    # set per row once the operation is applied (or superseded), null while pending
+    delivered = Column(DateTime, index=True, nullable=True)
+
+
+class DbAgentServiceCounter(Base):
+
+    __tablename__ = 'agent_service_counter'
+
+    agent_id = Column(Integer, ForeignKey('user.user_id'), primary_key=True)
+    service_type = Column(Enum(ConfigType), primary_key=True)
+    status = Column(Enum(ServiceStatusDb), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
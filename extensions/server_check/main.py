@@ -6,7 +6,8 @@ from celery_tasks.tasks import ReplaceServerCeleryTask, NotificationCeleryTask
 from celery_tasks.utils import create_worker_from
 from cache.database import get_redis_cache
 from cache.database import get_redis_cache
-from checkhost_api.main import check_host
+from checkhost_api.prober import Prober, default_prober
+from checkhost_api.health import HealthTracker
 from fastapi import HTTPException
 from dotenv import load_dotenv
 from time import sleep
@@ -40,7 +41,9 @@ header = {
 
 class CheckHosts:
 
-    def __init__(self, url, username, password):
+    def __init__(self, url, username, password, prober: Prober= None):
+
+        self.prober = prober or default_prober()
         
         headers = {
             'accept': 'application/json',
@@ -67,6 +70,7 @@ class CheckHosts:
         }
 
         self.db_cache = get_redis_cache().__next__()
+        self.health = HealthTracker(self.db_cache)
         logger.info('Successfully Connect.')
 
 
@@ -96,25 +100,33 @@ class CheckHosts:
             try:
                 servers = self.get_servers()
 
-                for server in servers:
-                    
-                    status = check_host(server['server_ip'])
-
-                    if status == False:
-                        payload = {
-                            'host': server['server_ip'],
-                            'task': 'CheckHostCeleryTask'
-                        }
-                        replace_server_worker.apply_async(args=(payload,))
-
-                        payload = {
-                            'parse_mode': 'markdown',
-                            'bot_selector': 'admin_log',
-                            'chat_id': 'admin',
-                            'message': 'The Server [`{0}`] is filtered'.format(server['server_ip'])
-                        }
-                        notifocaction_worker.apply_async(args=(payload,))
-                    sleep(2)
+                # only the hosts whose probe interval has passed, healthy ones are probed less often
+                due_servers = self.health.due(servers)
+
+                # the local tcp probe is a pre-filter, only check-host from inside the region can report a host down
+                statuses = self.prober.probe(due_servers)
+
+                unknown_hosts = [host for host, status in statuses.items() if status is None]
+                if unknown_hosts:
+                    logger.error(f'check-host failed for hosts (hosts: {unknown_hosts})')
+
+                # a replace buys a new server, so it needs several failed probes in a row
+                for server_ip in self.health.record(statuses):
+
+                    logger.info(f'server reached the failure threshold (server: {server_ip})')
+                    payload = {
+                        'host': server_ip,
+                        'task': 'CheckHostCeleryTask'
+                    }
+                    replace_server_worker.apply_async(args=(payload,))
+
+                    payload = {
+                        'parse_mode': 'markdown',
+                        'bot_selector': 'admin_log',
+                        'chat_id': 'admin',
+                        'message': 'The Server [`{0}`] is filtered'.format(server_ip)
+                    }
+                    notifocaction_worker.apply_async(args=(payload,))
 
             except Exception as e:
 
@@ -4,12 +4,16 @@ sys.path.append('/root/ssh-master-api')
 
 from fastapi import HTTPException
 from dotenv import load_dotenv
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Dict
+from time import sleep, time
 import traceback
 import requests
+import json
 import logging
 import os
 from slave_api.ssh import create_ssh_account_via_group, delete_ssh_account_via_group
+from utils.digest import diff_buckets
 
 logger = logging.getLogger('sync_server.log') 
 logger.setLevel(logging.INFO)
@@ -29,7 +33,16 @@ logger.addHandler(console_handler)
 
 class SyncServer:
 
-    def __init__(self, url, username, password):
+    def __init__(self, url, username, password, concurrency= 10, server_timeout= 120, buckets_number= 256):
+
+        self.concurrency = concurrency
+        self.server_timeout = server_timeout
+        self.buckets_number = buckets_number
+
+        # one pool for the whole process, a stuck sync still holds its worker in the next rounds
+        self.executor = ThreadPoolExecutor(max_workers= concurrency)
+        self.in_flight: Dict[str, Future] = {}  # server_ip -> future of its running sync
+        self.started: Dict[str, float] = {}  # server_ip -> when its current sync started
         
         headers = {
             'accept': 'application/json',
@@ -88,15 +101,19 @@ class SyncServer:
 
         return resp.json()['result']
     
-    def get_users_server(self, server_ip, source):
+    def get_users_server(self, server_ip, source, buckets= None):
         
         params = {
             'server_ip': server_ip,
             'source': source
         }
+
+        if buckets:
+            params['buckets'] = buckets
+            params['buckets_number'] = self.buckets_number
         
         for _ in range(3):
-            resp = requests.get(self.url + 'server/users', params= params, headers= self.headers)
+            resp = requests.get(self.url + 'server/users', params= params, headers= self.headers, timeout= self.server_timeout)
             
             if resp.status_code == 200:
                 break
@@ -107,15 +124,16 @@ class SyncServer:
 
         return resp.json()['result']
     
-    def get_domains_server(self, server_ip):
+    def get_users_digest(self, server_ip, source):
         
         params = {
             'server_ip': server_ip,
-            'status_': 'enable'
+            'source': source,
+            'buckets_number': self.buckets_number
         }
         
         for _ in range(3):
-            resp = requests.get(self.url + 'domain/fetch', params= params, headers= self.headers)
+            resp = requests.get(self.url + 'server/users/digest', params= params, headers= self.headers, timeout= self.server_timeout)
             
             if resp.status_code == 200:
                 break
@@ -123,25 +141,52 @@ class SyncServer:
         if resp.status_code != 200:
             raise HTTPException(status_code= resp.status_code, detail={'internal_code': 5103, 'detail': f'cant fetch server data from api (error: {resp.content})'})
 
-        return resp.json()['result']
-    
-    def user_detail(self, username):
+        return resp.json()
 
+    def get_domains_server(self, server_ip):
+        
         params = {
-            'username': username
+            'server_ip': server_ip,
+            'status_': 'enable'
         }
         
         for _ in range(3):
-            
-            resp = requests.get(self.url + 'service/search', params= params, headers= self.headers)
+            resp = requests.get(self.url + 'domain/fetch', params= params, headers= self.headers, timeout= self.server_timeout)
             
             if resp.status_code == 200:
                 break
         
         if resp.status_code != 200:
-            raise HTTPException(status_code= resp.status_code, detail={'internal_code': 5103, 'detail': f'cant detch user detail (username: {username} -error: {resp.content})'})
+            raise HTTPException(status_code= resp.status_code, detail={'internal_code': 5103, 'detail': f'cant fetch server data from api (error: {resp.content})'})
 
-        return resp.json()
+        return resp.json()['result']
+    
+    def users_credentials(self, server_ip= None, usernames= None):
+        """
+        fetch username/password of many accounts in one streamed request
+        instead of one /service/search call per user
+        """
+        data = {
+            'server_ip': server_ip,
+            'usernames': list(usernames) if usernames is not None else None
+        }
+
+        status_code, error = None, None
+        for _ in range(3):
+
+            try:
+                with requests.post(self.url + 'server/credentials', json= data, headers= self.headers, stream= True, timeout= self.server_timeout) as resp:
+
+                    if resp.status_code == 200:
+                        return [json.loads(line) for line in resp.iter_lines() if line]
+
+                    status_code, error = resp.status_code, resp.content
+
+            except requests.exceptions.ChunkedEncodingError as e:
+                # the stream was cut in the middle, fetch it again from the beginning
+                status_code, error = 502, str(e)
+
+        raise HTTPException(status_code= status_code, detail={'internal_code': 5103, 'detail': f'cant fetch users credentials (server_ip: {server_ip} -error: {error})'})
 
     def push_notif(self, message):
 
@@ -165,51 +210,146 @@ class SyncServer:
 
         return resp.json()
 
-    def worker(self):
+    def sync_server(self, server_ip):
 
-        while True:
+        # compare the digests first and only fetch the buckets that differ
+        database_digest = self.get_users_digest(server_ip, 'database')
+        server_digest = self.get_users_digest(server_ip, 'slave_server')
+
+        if database_digest['count'] == server_digest['count'] and database_digest['digest'] == server_digest['digest']:
+            return {'created': 0, 'deleted': 0, 'buckets': 0}
+
+        buckets = diff_buckets(database_digest, server_digest)
+        if not buckets:
+            return {'created': 0, 'deleted': 0, 'buckets': 0}
+
+        database_users = self.get_users_server(server_ip, 'database', buckets= buckets)
+        server_users = self.get_users_server(server_ip, 'slave_server', buckets= buckets)
+
+        create_users = set(database_users) - set(server_users)  
+        delete_users = set(server_users) - set(database_users)
+        deleted_users_listed = [user for user in delete_users if user.startswith('user_')]
+
+        if create_users:
+
+            logger.info('creating users [server: {0} -users: {1}]'.format(server_ip, create_users))
             
-            try:
-                servers = self.get_servers()
+            list_create_users = [
+                {'username': user['username'], 'password': user['password']}
+                    for user in self.users_credentials(usernames= create_users)
+            ]
+
+            resp, err = create_ssh_account_via_group(server_ip, list_create_users, ignore_exists_users= True)
+            if err: 
+                raise err
+            
+            logger.info('successfuly creating users [server: {0} -resp: {1}]'.format(server_ip, resp))
+
+
+        if deleted_users_listed:
+
+            logger.info('deleting users [server: {0} -users: {1}]'.format(server_ip, deleted_users_listed))
+
+            resp ,err = delete_ssh_account_via_group(server_ip, deleted_users_listed, ignore_not_exists_users= True)
+            if err:
+                raise err
+            
+            logger.info('successfuly deleting users [server: {0} -resp: {1}]'.format(server_ip, resp))
+
+        return {'created': len(create_users), 'deleted': len(deleted_users_listed), 'buckets': len(buckets)}
+
+    def _run_sync(self, server_ip):
+
+        self.started[server_ip] = time()
+        return self.sync_server(server_ip)
+
+    def _sync_result(self, server_ip, future):
+
+        try:
+            return future.result(), None
+
+        except Exception as e:
+            if hasattr(e, 'detail'):
+                return None, f'[err_status: {e.status_code} -err_msg: {e.detail}]'
+
+            logger.critical(f'error in sync server [server: {server_ip} -traceback: {traceback.format_exception(type(e), e, e.__traceback__)}]')
+            return None, f'[exception: {e!r}]'
+
+    def sync_servers(self, servers_ip):
+        """
+        reconcile the servers through a bounded thread pool, a round takes about
+        as long as the slowest server; returns {server_ip: (result, error)}.
+        every server gets `server_timeout` seconds from the moment its sync
+        starts, a sync that overruns keeps running in the background and the
+        server is skipped by the next rounds until it finishes
+        """
+        results = {}
 
-                for server in servers:
-                    
-                    database_users = self.get_users_server(server['server_ip'], 'database')
-                    server_users = self.get_users_server(server['server_ip'], 'slave_server')
+        self.in_flight = {server_ip: future for server_ip, future in self.in_flight.items() if not future.done()}
 
-                    create_users = set(database_users) - set(server_users)  
-                    delete_users = set(server_users) - set(database_users)
-                    deleted_users_listed = [user for user in delete_users if user.startswith('user_')]
+        futures = {}
+        for server_ip in servers_ip:
 
-                    if create_users:
+            if server_ip in self.in_flight:
+                results[server_ip] = (None, 'Skipped, the sync of an earlier round is still running')
+                continue
+
+            self.started.pop(server_ip, None)
+            future = self.executor.submit(self._run_sync, server_ip)
+
+            self.in_flight[server_ip] = future
+            futures[future] = server_ip
+
+        # a server waits in the queue for at most (len / concurrency) rounds before it starts
+        rounds = -(-len(futures) // self.concurrency)
+        queue_deadline = time() + self.server_timeout * max(rounds, 1)
+
+        pending = set(futures)
+        while pending:
+
+            done, pending = wait(pending, timeout= 1, return_when= FIRST_COMPLETED)
+            for future in done:
+                results[futures[future]] = self._sync_result(futures[future], future)
+
+            now = time()
+            for future in list(pending):
+
+                server_ip = futures[future]
+                started = self.started.get(server_ip)
+
+                if started is not None and now - started >= self.server_timeout:
+                    results[server_ip] = (None, 'Deadline Exceeded')
+                    pending.discard(future)
 
-                        logger.info('creating users [server: {0} -users: {1}]'.format(server['server_ip'], create_users))
-                        
-                        list_create_users = []
-                        
-                        for user in create_users:
-                            resp = self.user_detail(user)
-                            list_create_users.append({
-                                'username': resp['result'][0]['username'],
-                                'password': resp['result'][0]['password']
-                            })
+                elif started is None and now >= queue_deadline and future.cancel():
+                    results[server_ip] = (None, 'Deadline Exceeded, never started')
+                    pending.discard(future)
+
+        return results
+
+    def worker(self):
+
+        while True:
+            
+            try:
+                servers = self.get_servers()
 
-                        resp, err = create_ssh_account_via_group(server['server_ip'], list_create_users, ignore_exists_users= True)
-                        if err: 
-                            raise err
-                        
-                        logger.info('successfuly creating users [server: {0} -resp: {1}]'.format(server['server_ip'], resp))
+                start = time()
+                results = self.sync_servers([server['server_ip'] for server in servers])
 
+                failed_servers = {server_ip: err for server_ip, (_, err) in results.items() if err}
+                for server_ip, (resp, err) in results.items():
+                    if err:
+                        logger.error(f'occur an error in sync server [server: {server_ip} -error: {err}]')
 
-                    if deleted_users_listed:
+                    else:
+                        logger.info(f'server synced [server: {server_ip} -buckets: {resp["buckets"]} -created: {resp["created"]} -deleted: {resp["deleted"]}]')
 
-                        logger.info('deleting users [server: {0} -users: {1}]'.format(server['server_ip'], deleted_users_listed))
+                logger.info(f'sync round done [servers: {len(results)} -failed: {len(failed_servers)} -duration: {time() - start:.1f}s]')
 
-                        resp ,err = delete_ssh_account_via_group(server['server_ip'], deleted_users_listed, ignore_not_exists_users= True)
-                        if err:
-                            raise err
-                        
-                        logger.info('successfuly deleting users [server: {0} -resp: {1}]'.format(server['server_ip'], resp))
+                if failed_servers:
+                    error_msg = '\n'.join(f'{server_ip}: {err}' for server_ip, err in failed_servers.items())
+                    self.push_notif(f'❗ Error\nFile: sync_servers/server.py\nMessage: failed servers in sync round\n{error_msg}')
 
             except Exception as e:
 
@@ -242,8 +382,11 @@ if __name__ == '__main__':
     ADMIN_USERNAME = os.getenv('ADMIN_USERNAME')
     ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD')
     MAIN_URL = os.getenv('MAIN_URL')
+    SYNC_CONCURRENCY = int(os.getenv('SYNC_CONCURRENCY', 10))
+    SYNC_SERVER_TIMEOUT = int(os.getenv('SYNC_SERVER_TIMEOUT', 120))
+    DIGEST_BUCKETS = int(os.getenv('DIGEST_BUCKETS', 256))
 
-    SyncServer(MAIN_URL, ADMIN_USERNAME, ADMIN_PASSWORD).worker()
+    SyncServer(MAIN_URL, ADMIN_USERNAME, ADMIN_PASSWORD, concurrency= SYNC_CONCURRENCY, server_timeout= SYNC_SERVER_TIMEOUT, buckets_number= DIGEST_BUCKETS).worker()
 
 
 
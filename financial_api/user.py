@@ -1,8 +1,12 @@
 from requests.exceptions import ConnectTimeout, ConnectionError, ReadTimeout
 from fastapi import HTTPException, status
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 import requests
 import os
 
+BALANCE_FALLBACK_CONCURRENCY = int(os.getenv('BALANCE_FALLBACK_CONCURRENCY', 10))
+
 def header():
 
     header = os.getenv('FINANCIAL_TOKEN')
@@ -68,6 +72,58 @@ def get_balance(user_id):
         return None, HTTPException(status_code=status.HTTP_408_REQUEST_TIMEOUT, detail={'message': 'ReadTimeout', 'internal_code': 2419})
 
 
+def get_balances(users_id: List[int]):
+    """
+    balances of many users with one call to `POST /user/balances`, returns
+    ({user_id: balance}, None); users missing from the reply are left out.
+    financial services without the bulk endpoint answer 404/405, then the
+    single balance endpoint is queried with a bounded thread pool instead
+    """
+    if not users_id:
+        return {}, None
+
+    try:
+        data = {
+            'users_id': list(users_id)
+        }
+
+        for _ in range(2):
+            resp = requests.post('http://localhost:8050/user/balances', json= data, headers=header(), timeout=10)
+            if resp.status_code == 200:
+                break
+
+        if resp.status_code in (status.HTTP_404_NOT_FOUND, status.HTTP_405_METHOD_NOT_ALLOWED):
+            return _get_balances_one_by_one(users_id), None
+
+        if resp.status_code != 200:
+            return None, HTTPException(status_code=resp.status_code, detail= resp.content.decode())
+
+        return {int(item['user_id']): item['balance'] for item in resp.json()}, None
+
+    except ConnectTimeout:
+
+        return None, HTTPException(status_code=status.HTTP_408_REQUEST_TIMEOUT, detail={'message': 'Connection Timeout', 'internal_code': 2419})
+    
+    except ConnectionError:
+
+        return None, HTTPException(status_code=status.HTTP_408_REQUEST_TIMEOUT, detail={'message': 'ConnectionError', 'internal_code': 2419})
+
+    except ReadTimeout:
+
+        return None, HTTPException(status_code=status.HTTP_408_REQUEST_TIMEOUT, detail={'message': 'ReadTimeout', 'internal_code': 2419})
+
+
+def _get_balances_one_by_one(users_id: List[int]):
+
+    balances = {}
+    with ThreadPoolExecutor(max_workers= BALANCE_FALLBACK_CONCURRENCY) as executor:
+        for user_id, (resp, err) in zip(users_id, executor.map(get_balance, users_id)):
+            if err is None:
+                balances[user_id] = resp['balance']
+
+    return balances
+
+
 def set_balance(user_id, new_balance):
     
     try:
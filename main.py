@@ -12,10 +12,11 @@ from router import (
     auth
 )
 from schemas import UserRegisterForDataBase, UserRole, Status, CreateSubsetProfit
-from cache.cache_session import get_last_domain, set_last_domain
+from cache.cache_session import get_last_domain, set_last_domain, migrate_test_account_cache, get_username_pool_ready
 from cache.database import get_redis_cache
 from db import models, db_user, db_subset, db_domain
 from db.database import engine, get_db
+from utils.username import start_username_pool_fill
 from dotenv import load_dotenv
 import os 
 import logging
@@ -89,4 +90,8 @@ if get_last_domain(get_redis_cache().__next__()) is None:
 
     set_last_domain(last_domain, get_redis_cache().__next__())
 
+migrate_test_account_cache(get_redis_cache().__next__())
 
+# the pool of free usernames is filled off the request path
+if get_username_pool_ready(get_redis_cache().__next__()) is None:
+    start_username_pool_fill()
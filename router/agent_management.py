@@ -4,6 +4,7 @@ from fastapi import (
     HTTPException,
     status
 )
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm.session import Session
 from schemas import (
     HTTPError,
@@ -18,13 +19,15 @@ from schemas import (
     UpdateSubsetLimit,
     CreateSubsetProfit,
     NewAgentResponse,
-    ConfigType
+    ConfigType,
+    ExportFormat
 )
-from db import db_user, db_ssh_service, db_subset
+from db import db_user, db_subset, db_service_counter
 from db.database import get_db
 from financial_api.user import  create_user_if_not_exist
 from auth.auth import get_admin_user
-from financial_api.user import get_balance
+from utils.export import export_lines, EXPORT_MEDIA_TYPES
+from financial_api.user import get_balances
 from typing import List
 import logging
 import string
@@ -146,60 +149,42 @@ def disable_or_enable_agent(request: ChangeAgentStatus, current_user: TokenUser=
 def get_list_agents(current_user: TokenUser= Depends(get_admin_user), db: Session=Depends(get_db)):
 
     agents = db_user.get_all_users( db)
-    
-    ls_resp = []
-    for agent in agents:
-
-        services = db_ssh_service.get_services_by_agent_id(agent.user_id, db, type_= ConfigType.MAIN)
-        test_services = db_ssh_service.get_services_by_agent_id(agent.user_id, db, type_= ConfigType.TEST)
-        
-        all_services = 0
-        enable_services = 0
-        disable_services = 0
-        expired_services = 0
-        deleted_services = 0
-
-        if services :
-            all_services = len(services) 
 
-            for service in services:
-                if service.status == ServiceStatusDb.ENABLE:
-                    enable_services += 1
+    services_count = db_service_counter.get_all_counts(db)
+    subsets_count = db_user.count_users_by_parent_agent(db)
+    subsets_profit = {subset.user_id: subset for subset in db_subset.get_all_subsets(db)}
 
-                elif service.status == ServiceStatusDb.DISABLE:
-                    disable_services += 1
+    balances, err = get_balances([agent.user_id for agent in agents])
+    if err:
+        logger.error(f'[agent list] get balances (error: {err.detail})')
+        balances = {}
 
-                elif service.status == ServiceStatusDb.DELETED:
-                    deleted_services += 1
+    ls_resp = []
+    for agent in agents:
 
-                elif service.status == ServiceStatusDb.EXPIRED:
-                    expired_services += 1
+        counts = services_count.get(agent.user_id, {})
+        main_services = {status_: count for (type_, status_), count in counts.items() if type_ == ConfigType.MAIN}
+        test_services = {status_: count for (type_, status_), count in counts.items() if type_ == ConfigType.TEST}
 
-        resp_balance, err = get_balance(agent.user_id)
-        if err:
-            logger.error(f'[subset profit] get balance (username: {agent.username} -error: {err.detail})')
-            resp_balance = {'balance': '***'}
+        agent_subset = subsets_profit.get(agent.user_id)
 
-        agent_subset = db_subset.get_subset_by_user(agent.user_id, db)
-        number_of_subsets = len(db_user.get_users_by_parent_agent_id(agent.user_id, db))
-        
         data = {
             'agent_id': agent.user_id,
             'username': agent.username,
             'parent_agent_id': agent.parent_agent_id,
             'referal_link': agent.referal_link,
-            'balance': resp_balance['balance'],
+            'balance': balances.get(agent.user_id, '***'),
             'subset_limit': agent.subset_limit,
-            'subset_not_released_profit': agent_subset.not_released_profit,
-            'subset_total_profit': agent_subset.total_profit,
-            'subset_number_of_configs': agent_subset.number_of_configs,
-            'number_of_subsets': number_of_subsets,
-            'total_ssh_user': all_services,
-            'enable_ssh_services': enable_services,
-            'disable_ssh_services': disable_services,
-            'expired_ssh_services': expired_services,
-            'deleted_ssh_services': deleted_services,
-            'test_ssh_services': len(test_services),
+            'subset_not_released_profit': agent_subset.not_released_profit if agent_subset else 0,
+            'subset_total_profit': agent_subset.total_profit if agent_subset else 0,
+            'subset_number_of_configs': agent_subset.number_of_configs if agent_subset else 0,
+            'number_of_subsets': subsets_count.get(agent.user_id, 0),
+            'total_ssh_user': sum(main_services.values()),
+            'enable_ssh_services': main_services.get(ServiceStatusDb.ENABLE, 0),
+            'disable_ssh_services': main_services.get(ServiceStatusDb.DISABLE, 0),
+            'expired_ssh_services': main_services.get(ServiceStatusDb.EXPIRED, 0),
+            'deleted_ssh_services': main_services.get(ServiceStatusDb.DELETED, 0),
+            'test_ssh_services': sum(test_services.values()),
             'status': agent.status
         }
 
@@ -208,6 +193,50 @@ def get_list_agents(current_user: TokenUser= Depends(get_admin_user), db: Sessio
     return FetchAgentListResponse(count= len(ls_resp), result= ls_resp) 
 
 
+AGENT_EXPORT_FIELDS = [
+    'agent_id', 'username', 'name', 'phone_number', 'email', 'chat_id', 'parent_agent_id', 'referal_link', 'subset_limit', 'role', 'status',
+    'total_ssh_user', 'enable_ssh_services', 'disable_ssh_services', 'expired_ssh_services', 'deleted_ssh_services', 'test_ssh_services'
+]
+
+
+@router.get('/export', response_class= StreamingResponse)
+def export_agents(format_: ExportFormat= ExportFormat.NDJSON, role: UserRole= None, current_user: TokenUser= Depends(get_admin_user), db: Session=Depends(get_db)):
+    """
+    stream the agents with their service counters as ndjson or csv,
+    the users are read through a server side cursor so memory stays flat
+    """
+    # loaded before the cursor is opened, it holds a few rows per agent
+    services_count = db_service_counter.get_all_counts(db)
+
+    def rows():
+        for agent in db_user.iter_users(db, role= role):
+
+            counts = services_count.get(agent.user_id, {})
+            main_services = {status_: count for (type_, status_), count in counts.items() if type_ == ConfigType.MAIN}
+
+            yield {
+                'agent_id': agent.user_id,
+                'username': agent.username,
+                'name': agent.name,
+                'phone_number': agent.phone_number,
+                'email': agent.email,
+                'chat_id': agent.chat_id,
+                'parent_agent_id': agent.parent_agent_id,
+                'referal_link': agent.referal_link,
+                'subset_limit': agent.subset_limit,
+                'role': agent.role,
+                'status': agent.status,
+                'total_ssh_user': sum(main_services.values()),
+                'enable_ssh_services': main_services.get(ServiceStatusDb.ENABLE, 0),
+                'disable_ssh_services': main_services.get(ServiceStatusDb.DISABLE, 0),
+                'expired_ssh_services': main_services.get(ServiceStatusDb.EXPIRED, 0),
+                'deleted_ssh_services': main_services.get(ServiceStatusDb.DELETED, 0),
+                'test_ssh_services': sum(count for (type_, _), count in counts.items() if type_ == ConfigType.TEST)
+            }
+
+    return StreamingResponse(export_lines(rows(), format_.value, AGENT_EXPORT_FIELDS), media_type= EXPORT_MEDIA_TYPES[format_.value])
+
+
 @router.get('/subset/list', response_model= List[ListSubsetResponse],responses={status.HTTP_409_CONFLICT:{'model':HTTPError}, status.HTTP_404_NOT_FOUND:{'model':HTTPError}})
 def get_subset_via_agent(username: str, current_user: TokenUser= Depends(get_admin_user), db: Session=Depends(get_db)):
 
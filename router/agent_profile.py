@@ -19,7 +19,7 @@ from schemas import (
     ClaimPartnerShipProfit,
     PaymentMeothodPartnerShip
 )
-from db import db_user, db_ssh_service, db_subset
+from db import db_user, db_subset, db_service_counter
 from db.database import get_db
 from auth.auth import  get_agent_user
 from financial_api.user import get_balance, set_balance
@@ -68,33 +68,15 @@ def get_agent_information(username: str= Query(None,description='This filed (age
         logger.error(f'[agent info] get balance (user_id: {user_id} -error: {err.detail})')
         raise err
 
-    services = db_ssh_service.get_services_by_agent_id(user_id, db, type_= ConfigType.MAIN) 
-    enable_services_test = db_ssh_service.get_services_by_agent_id(user_id, db, type_= ConfigType.TEST, status= ServiceStatusDb.ENABLE) 
-    expired_services_test = db_ssh_service.get_services_by_agent_id(user_id, db, type_= ConfigType.TEST, status= ServiceStatusDb.EXPIRED) 
-    disable_services_test = db_ssh_service.get_services_by_agent_id(user_id, db, type_= ConfigType.TEST, status= ServiceStatusDb.DISABLE) 
-    services_test = len(enable_services_test) + len(expired_services_test) + len(disable_services_test)
+    counts = db_service_counter.get_counts_by_agent(user_id, db)
+    main_services = {status_: count for (type_, status_), count in counts.items() if type_ == ConfigType.MAIN}
+    services_test = sum(count for (type_, status_), count in counts.items() if type_ == ConfigType.TEST and status_ != ServiceStatusDb.DELETED)
 
-    all_services = 0
-    enable_services = 0
-    disable_services = 0
-    expired_services = 0
-    deleted_services = 0
-
-    if services :
-        all_services = len(services) 
-
-        for service in services:
-            if service.status == ServiceStatusDb.ENABLE:
-                enable_services += 1
-
-            elif service.status == ServiceStatusDb.DISABLE:
-                disable_services += 1
-
-            elif service.status == ServiceStatusDb.DELETED:
-                deleted_services += 1
-
-            elif service.status == ServiceStatusDb.EXPIRED:
-                expired_services += 1
+    all_services = sum(main_services.values())
+    enable_services = main_services.get(ServiceStatusDb.ENABLE, 0)
+    disable_services = main_services.get(ServiceStatusDb.DISABLE, 0)
+    expired_services = main_services.get(ServiceStatusDb.EXPIRED, 0)
+    deleted_services = main_services.get(ServiceStatusDb.DELETED, 0)
 
     user = db_user.get_user_by_user_id(user_id, db) 
     user_subset = db_subset.get_subset_by_user(user.user_id, db)
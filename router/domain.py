@@ -22,7 +22,7 @@ from schemas import (
     UpdateServerInDomainResponse
 )
 from db.database import get_db
-from db import db_domain, db_server, db_ssh_service
+from db import db_domain, db_server, db_ssh_service, db_outbox
 
 from slave_api.ssh import block_ssh_account_via_groups, create_ssh_account_via_group, delete_ssh_account_via_group
 from cloudflare_api.subdomain import new_subdomain, update_subdomain
@@ -263,6 +263,7 @@ def transfer_configs_via_domain(request: DomainTransfer, current_user: TokenUser
             db_server.decrease_ssh_accounts_number(old_server_ip, db, commit= False, number= len(set(resp_del['success_users']))) 
         
         db_server.increase_ssh_accounts_number(request.new_server_ip, db, commit= False, number= len(resp_create['success_users']))
+        db_outbox.add_transfer_operations(old_server_ip, request.new_server_ip, [user['username'] for user in listed_new_users], [user['username'] for user in listed_block_users], request.delete_old_users, db, commit= False)
         db.commit()
         
         db_domain.update_server_ip(old_domain.domain_id, request.new_server_ip, db)
@@ -291,6 +292,7 @@ def transfer_configs_via_domain(request: DomainTransfer, current_user: TokenUser
                 db_domain.change_status(old_domain.domain_id, DomainStatusDb.DISABLE, db, commit= False)
 
             db_server.increase_ssh_accounts_number(new_domain.server_ip, db, commit= False, number= len(resp_create['success_users']) )
+            db_outbox.add_transfer_operations(old_domain.server_ip, new_domain.server_ip, [user['username'] for user in listed_new_users], [user['username'] for user in listed_block_users], request.delete_old_users, db, commit= False)
             db.commit()
 
         except Exception as e: 
@@ -5,22 +5,29 @@ from fastapi import (
     HTTPException
 )
 from sqlalchemy.orm.session import Session
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
 from schemas import (
     TokenUser,
     HTTPError,
     UserStatusDb,
     PublishNotification,
     PublishNotificationResponse,
-    NotificationStatus
+    NotificationStatus,
+    BroadcastStatus,
+    BroadcastStatusResponse
 )
 from db.database import get_db
 from db import db_user
 
-from celery_tasks.tasks import NotificationCeleryTask 
-from celery_tasks.utils import create_worker_from
+from cache.database import get_redis_cache, get_async_redis_cache
+from cache.cache_session import create_broadcast, get_broadcast_async
 
 from auth.auth import get_admin_user
+from datetime import datetime
 import logging
+import json
+import uuid
 
 # Create a file handler to save logs to a file
 logger = logging.getLogger('notification_router.log') 
@@ -38,64 +45,83 @@ formatter = logging.Formatter('%(asctime)s - %(levelname)s | %(message)s')
 console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
-_, notification_worker = create_worker_from(NotificationCeleryTask)
+BROADCAST_TTL = 7*24*60*60
 
 
 router = APIRouter(prefix='/notif', tags=['Notifications'])
 
 @router.post('/publish', response_model= PublishNotificationResponse, responses={status.HTTP_409_CONFLICT:{'model':HTTPError}})
-def new_notif(request: PublishNotification, current_user: TokenUser= Depends(get_admin_user), db: Session=Depends(get_db)):
-    
-    failed_users = []
-    list_chat_id = []
+def new_notif(request: PublishNotification, current_user: TokenUser= Depends(get_admin_user), db: Session=Depends(get_db), cache_db: Redis=Depends(get_redis_cache)):
+    """
+    store the broadcast and return, the broadcast worker expands the
+    recipients and enqueues the messages; see /notif/broadcast/{id}
+    """
     except_agents = request.except_agents
     
     if request.except_agents is None:
         except_agents = []
     
     if request.accept_agents:
-        
-        for username in request.accept_agents:
-            user = db_user.get_user_by_username(username, db)
-            if user and user.status == UserStatusDb.ENABLE and user.chat_id:
-                list_chat_id.append(user.chat_id)
 
-            else:
-                failed_users.append(username)
+        users = {user.username: user for user in db_user.get_users_by_usernames(request.accept_agents, db)}
+        failed_users = [
+            username for username in request.accept_agents
+                if username not in users or users[username].status != UserStatusDb.ENABLE or not users[username].chat_id
+        ]
 
         if failed_users:
             raise HTTPException(status_code= status.HTTP_409_CONFLICT, detail= PublishNotificationResponse(status= NotificationStatus.FAILED, failed_users= failed_users))
 
-    else:
-
-        all_users = db_user.get_all_users(db, status= UserStatusDb.ENABLE)
-
-        for user in all_users:
-            if user.username not in except_agents:
-                if user.chat_id:
-                    list_chat_id.append(user.chat_id)
-                
-                else: 
-                    failed_users.append(user.chat_id)
-
     bot = 'vpn_cluster'
     if request.bot :
         bot = request.bot
 
-    for user_chat_id in list_chat_id:
-        parse_mode = None
-        if request.parse_mode:
-            parse_mode = 'markdown'
-
-        payload = {
-            'chat_id': user_chat_id,
-            'message': request.message,
-            'bot_selector': bot,
-            'parse_mode': parse_mode,
-            'inline_keyboard': [[['👍 مشاهده کردم', 'notif_click']]]
-        }
-        notification_worker.apply_async(args=(payload,))
-
-
-    return PublishNotificationResponse(status= NotificationStatus.SUCCESSFULL, failed_users= failed_users)
-
+    parse_mode = ''
+    if request.parse_mode:
+        parse_mode = 'markdown'
+
+    broadcast_id = uuid.uuid4().hex
+    record = {
+        'message': request.message,
+        'bot_selector': bot,
+        'parse_mode': parse_mode,
+        'accept_agents': json.dumps(request.accept_agents or []),
+        'except_agents': json.dumps(except_agents),
+        'status': BroadcastStatus.PENDING.value,
+        'total': 0,
+        'enqueued': 0,
+        'sent': 0,
+        'failed': 0,
+        'skipped': 0,
+        'created': datetime.now().isoformat()
+    }
+    create_broadcast(broadcast_id, record, BROADCAST_TTL, cache_db)
+
+    logger.info(f'[broadcast] new broadcast (broadcast_id: {broadcast_id} -bot: {bot} -accept_agents: {request.accept_agents} -except_agents: {except_agents})')
+
+    return PublishNotificationResponse(status= NotificationStatus.SUCCESSFULL, failed_users= [], broadcast_id= broadcast_id)
+
+
+@router.get('/broadcast/{broadcast_id}', response_model= BroadcastStatusResponse, responses={status.HTTP_404_NOT_FOUND:{'model':HTTPError}})
+async def get_broadcast_status(broadcast_id: str, current_user: TokenUser= Depends(get_admin_user), cache_db: AsyncRedis=Depends(get_async_redis_cache)):
+
+    # redis only, so it runs on the event loop instead of taking a threadpool slot while it polls
+    record = await get_broadcast_async(broadcast_id, cache_db)
+
+    if not record:
+        raise HTTPException(status_code= status.HTTP_404_NOT_FOUND, detail={'message': 'broadcast not found', 'internal_code': 2475})
+
+    broadcast_status = record['status']
+    if broadcast_status == BroadcastStatus.SENDING and int(record['sent']) + int(record['failed']) >= int(record['total']):
+        broadcast_status = BroadcastStatus.DONE
+
+    return BroadcastStatusResponse(
+        broadcast_id= broadcast_id,
+        status= broadcast_status,
+        total= record['total'],
+        enqueued= record['enqueued'],
+        sent= record['sent'],
+        failed= record['failed'],
+        skipped= record['skipped'],
+        created= record['created']
+    )
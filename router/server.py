@@ -32,13 +32,17 @@ from schemas import (
     NodesStatusResponse,
     NodesCommand,
     SourceUsersServer,
-    NodesCommandResponse
+    NodesCommandResponse,
+    ServerCredentials,
+    UsersDigestResponse
 )
+from fastapi.responses import StreamingResponse
 from db.database import get_db
-from db import db_server, db_domain, db_ssh_service
+from db import db_server, db_domain, db_ssh_service, db_outbox
 
 from utils.server import find_best_server
-from slave_api.server import get_users, init_server, active_users
+from utils.digest import DIGEST_BUCKETS, users_digest as compute_users_digest, filter_by_buckets
+from slave_api.server import get_users, init_server, active_users, active_users_via_group, users_digest
 from auth.auth import get_admin_user
 import paramiko
 from paramiko import AuthenticationException
@@ -51,6 +55,7 @@ from slave_api.ssh import create_ssh_account_via_group, block_ssh_account_via_gr
 from typing import List
 from time import sleep
 import logging
+import json
 import os   
 # Create a file handler to save logs to a file
 logger = logging.getLogger('server_route.log') 
@@ -376,11 +381,15 @@ def update_server_status(request: UpdateServerStatus, current_user: TokenUser= D
 def get_nodes_status( current_user: TokenUser= Depends(get_admin_user), db: Session=Depends(get_db)):
 
     servers = db_server.get_all_server(db)
+    results = active_users_via_group([server.server_ip for server in servers])
 
     response = []
     for server in servers:
-        _, err = active_users(server.server_ip)
-        if err:
+        _, err = results[server.server_ip]
+        if err and err.status_code == status.HTTP_504_GATEWAY_TIMEOUT:
+            response.append( NodesStatusDetail(ip= server.server_ip, status= server.status, connection= ServerConnection.TIMEOUT) )
+
+        elif err:
             response.append( NodesStatusDetail(ip= server.server_ip, status= server.status, connection= ServerConnection.DISCONNECT) )
         
         else:
@@ -390,29 +399,20 @@ def get_nodes_status( current_user: TokenUser= Depends(get_admin_user), db: Sess
 
 
 @router.get('/users', response_model= UsersResponse, responses={status.HTTP_404_NOT_FOUND:{'model':HTTPError}, status.HTTP_408_REQUEST_TIMEOUT:{'model':HTTPError}})
-def get_server_users(server_ip: str, source: SourceUsersServer= SourceUsersServer.DATABASE ,current_user: TokenUser= Depends(get_admin_user), db: Session=Depends(get_db)):
+def get_server_users(server_ip: str,
+                     source: SourceUsersServer= SourceUsersServer.DATABASE,
+                     buckets: List[int]= Query(None),
+                     buckets_number: int= Query(DIGEST_BUCKETS, gt= 0),
+                     current_user: TokenUser= Depends(get_admin_user),
+                     db: Session=Depends(get_db)):
 
     if source == SourceUsersServer.DATABASE:
 
-        domains = db_domain.get_domains_by_server_ip(server_ip, db)
-
-        users = []
-
-        for domain in domains:
-
-            user_domains = []
+        if buckets:
+            users = db_ssh_service.get_usernames_by_server_buckets(server_ip, buckets, buckets_number, db, status= [ServiceStatusDb.ENABLE, ServiceStatusDb.DISABLE, ServiceStatusDb.EXPIRED])
 
-            user_domain_enable = db_ssh_service.get_services_by_domain_id(domain.domain_id, db, status= ServiceStatusDb.ENABLE)
-            cl_enables = [user.username for user in user_domain_enable]
-
-            user_domain_expire = db_ssh_service.get_services_by_domain_id(domain.domain_id, db, status= ServiceStatusDb.EXPIRED)
-            cl_expires = [user.username for user in user_domain_expire]
-
-            user_domain_disable = db_ssh_service.get_services_by_domain_id(domain.domain_id, db, status= ServiceStatusDb.DISABLE)
-            cl_disables = [user.username for user in user_domain_disable]
-
-            user_domains = cl_expires + cl_enables + cl_disables
-            users.extend(user_domains)
+        else:
+            users = db_ssh_service.get_usernames_by_server(server_ip, db, status= [ServiceStatusDb.ENABLE, ServiceStatusDb.DISABLE, ServiceStatusDb.EXPIRED])
 
         return UsersResponse(result= users, count= len(users))
 
@@ -427,10 +427,74 @@ def get_server_users(server_ip: str, source: SourceUsersServer= SourceUsersServe
         if err:
             logger.error(f'[get users] error (server_ip: {server_ip}) -detail: {err.detail})')
             raise err
+
+        if buckets:
+            resp = filter_by_buckets(resp, buckets, buckets_number)
         
         return UsersResponse(result= resp, count= len(resp))
 
 
+@router.get('/users/digest', response_model= UsersDigestResponse, responses={status.HTTP_404_NOT_FOUND:{'model':HTTPError}, status.HTTP_408_REQUEST_TIMEOUT:{'model':HTTPError}})
+def get_server_users_digest(server_ip: str,
+                            source: SourceUsersServer= SourceUsersServer.DATABASE,
+                            buckets_number: int= Query(DIGEST_BUCKETS, gt= 0),
+                            current_user: TokenUser= Depends(get_admin_user),
+                            db: Session=Depends(get_db)):
+
+    if source == SourceUsersServer.DATABASE:
+
+        # the hashing and xor are done by the database, only one row per bucket comes back
+        rows = db_ssh_service.get_users_digest_by_server(server_ip, buckets_number, db, status= [ServiceStatusDb.ENABLE, ServiceStatusDb.DISABLE, ServiceStatusDb.EXPIRED])
+
+        digest = {'count': 0, 'digest': 0, 'buckets': [0] * buckets_number}
+        for row in rows:
+            digest['buckets'][int(row.bucket)] = int(row.digest)
+            digest['count'] += row.count
+            digest['digest'] ^= int(row.digest)
+
+        return UsersDigestResponse(**digest)
+
+    server = db_server.get_server_by_ip(server_ip, db)
+
+    if server is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND ,detail={'internal_code':2406, 'message':'Server not exists'})
+
+    resp, err = users_digest(server_ip, buckets_number)
+    if err is None:
+        return UsersDigestResponse(**resp)
+
+    if err.status_code != status.HTTP_404_NOT_FOUND:
+        logger.error(f'[users digest] error (server_ip: {server_ip}) -detail: {err.detail})')
+        raise err
+
+    # the slave does not serve digests yet, build it from the full list
+    resp, err = get_users(server_ip)
+    if err:
+        logger.error(f'[users digest] error (server_ip: {server_ip}) -detail: {err.detail})')
+        raise err
+
+    # only the accounts managed by the master (user_*) take part, not the system users of the node
+    return UsersDigestResponse(**compute_users_digest([user for user in resp if user.startswith('user_')], buckets_number))
+
+
+@router.post('/credentials', response_class= StreamingResponse, responses={status.HTTP_422_UNPROCESSABLE_ENTITY:{'model':HTTPError}})
+def get_server_credentials(request: ServerCredentials, current_user: TokenUser= Depends(get_admin_user), db: Session=Depends(get_db)):
+    """
+    stream the credentials of the accounts of a server and/or of a list of usernames
+    as ndjson, one {"username", "password", "status"} object per line
+    """
+    if request.server_ip is None and not request.usernames:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY ,detail={'internal_code':2474, 'message':'server_ip or usernames is required'})
+
+    usernames = [username.lower() for username in request.usernames] if request.usernames else None
+
+    def generate():
+        for row in db_ssh_service.iter_credentials(db, server_ip= request.server_ip, usernames= usernames):
+            yield json.dumps({'username': row.username, 'password': row.password, 'status': row.status}) + '\n'
+
+    return StreamingResponse(generate(), media_type= 'application/x-ndjson')
+
+
 @router.get('/best', response_model= BestServerForNewConfig, responses={status.HTTP_404_NOT_FOUND:{'model':HTTPError}, status.HTTP_408_REQUEST_TIMEOUT:{'model':HTTPError}})
 def get_best_server(current_user: TokenUser= Depends(get_admin_user), db: Session=Depends(get_db)):
 
@@ -467,14 +531,22 @@ def get_active_users(server_ip: str= Query(None) ,current_user: TokenUser= Depen
     else:
 
         servers = db_server.get_all_server(db, status= ServerStatusDb.ENABLE)
+        results = active_users_via_group([server.server_ip for server in servers])
 
         response = []
+        timeout_servers = []
         total_active_users= 0
         total_sessions= 0
         for server in servers:
-            resp, err = active_users(server.server_ip)
+            resp, err = results[server.server_ip]
+            connection = ServerConnection.CONNECTED
             if err:
                 resp = []
+                connection = ServerConnection.DISCONNECT
+                if err.status_code == status.HTTP_504_GATEWAY_TIMEOUT:
+                    connection = ServerConnection.TIMEOUT
+                    timeout_servers.append(server.server_ip)
+
                 logger.error(f'[active users] error (server_ip: {server.server_ip}) -detail: {err.detail})')
 
             number_active_users = len(resp)
@@ -487,10 +559,11 @@ def get_active_users(server_ip: str= Query(None) ,current_user: TokenUser= Depen
                 ip= server.server_ip,
                 detail= resp,
                 active_users= number_active_users,
-                active_sessions= number_active_sessions
+                active_sessions= number_active_sessions,
+                connection= connection
             ))
 
-        return ActiveUsersResponse(server_number= len(servers), total_active_users= total_active_users, total_sessions= total_sessions, detail= response)
+        return ActiveUsersResponse(server_number= len(servers), total_active_users= total_active_users, total_sessions= total_sessions, timeout_servers= timeout_servers, detail= response)
 
 
 @router.put('/max_users', response_model= str, responses={status.HTTP_404_NOT_FOUND:{'model':HTTPError}})
@@ -524,20 +597,11 @@ def transfer_configs_via_server(request: ServerTransfer, update_domains: Service
 
     old_server_domains = db_domain.get_domains_by_server_ip(request.old_server_ip, db)
     
-    enable_old_users = []
-    disable_old_users = []
-    expired_old_users = []
-
-    for domain in old_server_domains:
-
-        enable_tmp_users = db_ssh_service.get_services_by_domain_id(domain.domain_id, db, status= ServiceStatusDb.ENABLE)
-        disable_tmp_users = db_ssh_service.get_services_by_domain_id(domain.domain_id, db, status= ServiceStatusDb.DISABLE)
-        expired_tmp_users = db_ssh_service.get_services_by_domain_id(domain.domain_id, db, status= ServiceStatusDb.EXPIRED)
-
-        enable_old_users.extend(enable_tmp_users)
-        disable_old_users.extend(disable_tmp_users)
-        expired_old_users.extend(expired_tmp_users)
+    old_users = db_ssh_service.get_credentials_by_server(request.old_server_ip, db, status= [ServiceStatusDb.ENABLE, ServiceStatusDb.DISABLE, ServiceStatusDb.EXPIRED])
 
+    enable_old_users = [user for user in old_users if user.status == ServiceStatusDb.ENABLE]
+    disable_old_users = [user for user in old_users if user.status == ServiceStatusDb.DISABLE]
+    expired_old_users = [user for user in old_users if user.status == ServiceStatusDb.EXPIRED]
 
     listed_enable_old_users = [{'username': user.username, 'password': user.password} for user in enable_old_users]
     listed_disable_old_users = [{'username': user.username, 'password': user.password} for user in disable_old_users]
@@ -603,6 +667,7 @@ def transfer_configs_via_server(request: ServerTransfer, update_domains: Service
         db_server.change_server_status(request.old_server_ip, ServerStatusDb.DISABLE, db)
         db_server.change_generate_status(request.old_server_ip, ServerStatusDb.DISABLE, db)
 
+    db_outbox.add_transfer_operations(request.old_server_ip, request.new_server_ip, [user['username'] for user in listed_new_users], [user['username'] for user in listed_blocked_users], request.delete_old_users, db, commit= False)
     db_server.increase_ssh_accounts_number(request.new_server_ip, db, number= len(resp_create['success_users']) )
 
     logger.info(f'[transfer server] successfully transfer server (from_server_ip: {request.old_server_ip} -to_server_ip: {request.new_server_ip} -updated_domains: {updated_domains})')
@@ -5,6 +5,7 @@ from fastapi import (
     HTTPException,
     Query
 )
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm.session import Session
 from schemas import (
     HTTPError,
@@ -14,14 +15,19 @@ from schemas import (
     EmailStr,
     PhoneNumberStr,
     ServiceStatusDb,
-    SearchResponse
+    SearchResponse,
+    UserSShServiceDisplay,
+    ExportFormat
 )
 from db import db_ssh_service, db_domain, db_user, db_ssh_plan
 from db.database import get_db
 from utils.port import generate_port
+from utils.export import export_lines, EXPORT_MEDIA_TYPES
 from auth.auth import get_agent_user
 from datetime import datetime
+from typing import Dict
 import logging
+import os
 
 # Create a file handler to save logs to a file
 logger = logging.getLogger('service_route.log')
@@ -40,15 +46,13 @@ console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
 
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 100))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv('SEARCH_MAX_PAGE_SIZE', 1000))
+
 router = APIRouter(prefix='/service', tags=['Service'])
 
 
-@router.get('/search', response_model= SearchResponse, responses={
-    status.HTTP_404_NOT_FOUND:{'model':HTTPError},
-    status.HTTP_408_REQUEST_TIMEOUT:{'model':HTTPError}, 
-    status.HTTP_409_CONFLICT:{'model':HTTPError}},
-    tags=['Agent-Profile'] )
-def get_services_by_search(
+def search_filters(
     service_type: ConfigType= None,
     agent_username: str= Query(None,description='Only admin has access to this field'),
     username: str= None,
@@ -61,8 +65,8 @@ def get_services_by_search(
     end_expire_time: datetime= None,
     status_:  ServiceStatusDb= None,
     current_user: TokenUser= Depends(get_agent_user),
-    db: Session=Depends(get_db)):
-
+    db: Session=Depends(get_db)) -> Dict:
+    """ validated filters of the service search, shared by /search and /export """
     
     if current_user.role == UserRole.AGENT and agent_username:
         raise HTTPException(status_code= status.HTTP_409_CONFLICT, detail={'message': 'Only admin has access to agent_username field', 'internal_code': 2470})
@@ -121,34 +125,71 @@ def get_services_by_search(
 
     if end_expire_time is not None:
         prepar_dict['expire'] = end_expire_time
-    
-    resp_services = db_ssh_service.get_services_by_attrs(db, **prepar_dict)
-    prepar_services = []
-
-    for refrence_service in resp_services:
-        domain_name_service = db_domain.get_domain_by_id(refrence_service.domain_id, db)
-        prepar_services.append(
-            {
-                'service_id': refrence_service.service_id,
-                'service_type': refrence_service.service_type,
-                'domain_id': refrence_service.domain_id,
-                'domain_name': domain_name_service.domain_name,
-                'server_ip': domain_name_service.server_ip,
-                'ssh_port': generate_port(refrence_service.username),
-                'plan_id': refrence_service.plan_id,
-                'name': refrence_service.name,
-                'email': refrence_service.email,
-                'phone_number': refrence_service.phone_number,
-                'agent_id': refrence_service.agent_id,
-                'password': refrence_service.password,
-                'username': refrence_service.username,
-                'created': refrence_service.created,
-                'expire': refrence_service.expire,
-                'status': refrence_service.status
-            }
-        )
-
-    return SearchResponse(count= len(prepar_services), result= prepar_services)
+
+    return prepar_dict
+
+
+def service_row(refrence_service, service_domain_name, service_server_ip) -> Dict:
+
+    return {
+        'service_id': refrence_service.service_id,
+        'service_type': refrence_service.service_type,
+        'domain_id': refrence_service.domain_id,
+        'domain_name': service_domain_name,
+        'server_ip': service_server_ip,
+        'ssh_port': generate_port(refrence_service.username),
+        'plan_id': refrence_service.plan_id,
+        'name': refrence_service.name,
+        'email': refrence_service.email,
+        'phone_number': refrence_service.phone_number,
+        'agent_id': refrence_service.agent_id,
+        'password': refrence_service.password,
+        'username': refrence_service.username,
+        'created': refrence_service.created,
+        'expire': refrence_service.expire,
+        'status': refrence_service.status
+    }
+
+
+@router.get('/search', response_model= SearchResponse, responses={
+    status.HTTP_404_NOT_FOUND:{'model':HTTPError},
+    status.HTTP_408_REQUEST_TIMEOUT:{'model':HTTPError}, 
+    status.HTTP_409_CONFLICT:{'model':HTTPError}},
+    tags=['Agent-Profile'] )
+def get_services_by_search(
+    after_service_id: int= Query(None, ge= 0, description='service_id of the last row of the previous page'),
+    limit: int= Query(SEARCH_PAGE_SIZE, gt= 0, le= SEARCH_MAX_PAGE_SIZE),
+    with_total: bool= Query(False, description='Also count every matching service'),
+    prepar_dict: Dict= Depends(search_filters),
+    db: Session=Depends(get_db)):
+
+    resp_services = db_ssh_service.search_services(db, after_service_id= after_service_id, limit= limit, **prepar_dict)
+    prepar_services = [service_row(*row) for row in resp_services]
+
+    total = None
+    if with_total:
+        total = db_ssh_service.count_services_by_attrs(db, **prepar_dict)
+
+    # a short page is the last one
+    next_after_service_id = None
+    if len(prepar_services) == limit:
+        next_after_service_id = prepar_services[-1]['service_id']
+
+    return SearchResponse(count= len(prepar_services), total= total, next_after_service_id= next_after_service_id, result= prepar_services)
+
+
+@router.get('/export', response_class= StreamingResponse, responses={
+    status.HTTP_404_NOT_FOUND:{'model':HTTPError},
+    status.HTTP_409_CONFLICT:{'model':HTTPError}},
+    tags=['Agent-Profile'] )
+def export_services(format_: ExportFormat= ExportFormat.NDJSON, prepar_dict: Dict= Depends(search_filters), db: Session=Depends(get_db)):
+    """
+    stream every service matching the search filters as ndjson or csv,
+    rows are read through a server side cursor so memory stays flat
+    """
+    rows = (service_row(*row) for row in db_ssh_service.iter_services(db, **prepar_dict))
+
+    return StreamingResponse(export_lines(rows, format_.value, list(UserSShServiceDisplay.__fields__)), media_type= EXPORT_MEDIA_TYPES[format_.value])
 
 
 
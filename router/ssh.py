@@ -5,6 +5,8 @@ from fastapi import (
     HTTPException
 )
 from sqlalchemy.orm.session import Session
+from sqlalchemy.exc import IntegrityError
+from redis import Redis
 from schemas import (
     NewSsh, 
     UserRole, 
@@ -24,6 +26,7 @@ from schemas import (
     RenewSsh,
     TokenUser,
     ConfigType,
+    OutboxOperation,
 )
 from db import (
     db_server,
@@ -31,16 +34,21 @@ from db import (
     db_ssh_service,
     db_domain,
     db_subset,
-    db_user
+    db_user,
+    db_outbox
 )
 import pytz 
 
-from cache.cache_session import set_test_account_cache, get_test_account_number
+from cache.cache_session import (
+    set_test_account_cache,
+    get_test_account_number,
+    schedule_service_expire,
+    unschedule_service_expire
+)
 from cache.database import get_redis_cache
 from db.database import get_db
 from auth.auth import get_agent_user
 
-from random import randint
 from datetime import datetime, timedelta
 from slave_api.ssh import (
     create_ssh_account,
@@ -50,6 +58,7 @@ from slave_api.ssh import (
 )
 from utils.port import generate_port
 from utils.password import generate_password
+from utils.username import generate_username
 from utils.domain import get_server_via_domain
 from utils.financial import check_balance
 from utils.server import find_server_and_domain
@@ -76,10 +85,37 @@ logger.addHandler(console_handler)
 PERCENT_PARTNERSHIP_PROFIT = float(os.getenv('PERCENT_PARTNERSHIP_PROFIT'))
 ADMID_ID_FOR_FINANCIAL = 1 
 MAX_TEST_ACCOUNT = 3
+USERNAME_RETRIES = 3
 
 router = APIRouter(prefix='/agent/ssh', tags=['Ssh-Agent'])
 
 
+def update_expire_schedule(service_id, expire, service_type, cache_db: Redis, remove= False):
+    # the expire worker sweeps the database periodically, so a missed schedule update only delays the action
+    try:
+        if remove:
+            unschedule_service_expire(service_id, cache_db)
+
+        else:
+            warning_before = 24*60*60 if service_type == ConfigType.MAIN else None
+            schedule_service_expire(service_id, expire, cache_db, warning_before= warning_before)
+
+    except Exception as e:
+        logger.error(f'[expire schedule] failed to update the schedule (service_id: {service_id} -error: {e})')
+
+
+def replace_taken_username(server_ip, username, password, db: Session, cache_db: Redis):
+    """ the username was stored by another request meanwhile, move the slave account to a fresh one """
+    _, err = delete_ssh_account(server_ip, username)
+    if err:
+        logger.error(f'[username] failed to delete the account of a taken username (username: {username} -server_ip: {server_ip} -resp_code: {err.status_code} -detail: {err.detail})')
+
+    new_username = generate_username(db, cache_db)
+    _, err = create_ssh_account(server_ip, new_username, password)
+
+    return new_username, err
+
+
 @router.post('/test', response_model= NewSshResponse, responses= {
     status.HTTP_409_CONFLICT:{'model': HTTPError},
     status.HTTP_408_REQUEST_TIMEOUT:{'model': HTTPError},
@@ -89,7 +125,7 @@ router = APIRouter(prefix='/agent/ssh', tags=['Ssh-Agent'])
     status.HTTP_423_LOCKED:{'model':HTTPError},
     status.HTTP_500_INTERNAL_SERVER_ERROR:{'model':HTTPError},
     })
-def create_test_ssh_via_agent(request: NewSsh, current_user: TokenUser= Depends(get_agent_user), db: Session=Depends(get_db)):
+def create_test_ssh_via_agent(request: NewSsh, current_user: TokenUser= Depends(get_agent_user), db: Session=Depends(get_db), cache_db: Redis=Depends(get_redis_cache)):
 
     plan = db_ssh_plan.get_plan_by_id(request.plan_id, db)
     
@@ -99,7 +135,7 @@ def create_test_ssh_via_agent(request: NewSsh, current_user: TokenUser= Depends(
     elif plan.status == PlanStatusDb.DISABLE:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail={'message':'plan_id is disable', 'internal_code': 2426})
 
-    test_account_number = get_test_account_number(current_user.user_id, get_redis_cache().__next__())
+    test_account_number = get_test_account_number(current_user.user_id, cache_db)
     if current_user.role != UserRole.ADMIN and test_account_number >= MAX_TEST_ACCOUNT:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail={'message':"you'r reach to max test account'", 'internal_code': 2459})
 
@@ -121,11 +157,7 @@ def create_test_ssh_via_agent(request: NewSsh, current_user: TokenUser= Depends(
             raise err
         
     password = generate_password()
-    while True:
-
-        username = 'user_' + str(randint(100_000, 999_000))
-        if db_ssh_service.get_service_by_username(username, db) == None:
-            break
+    username = generate_username(db, cache_db)
 
     _, err = create_ssh_account(selected_server.server_ip, username, password)
     if err:
@@ -152,20 +184,35 @@ def create_test_ssh_via_agent(request: NewSsh, current_user: TokenUser= Depends(
     }
 
     # ================= Begin =================
-    try:
-        service = db_ssh_service.create_ssh(SshService(**service_data), db, commit=False)
-        db_server.increase_ssh_accounts_number(selected_server.server_ip, db, commit=False)
-        db.commit()
-        db.refresh(service)
+    for attempt in range(1, USERNAME_RETRIES + 1):
+        try:
+            service = db_ssh_service.create_ssh(SshService(**service_data), db, commit=False)
+            db_server.increase_ssh_accounts_number(selected_server.server_ip, db, commit=False)
+            db_outbox.add_operation(selected_server.server_ip, username, OutboxOperation.CREATE, db, commit=False)
+            db.commit()
+            db.refresh(service)
+            break
 
-    except Exception as e:
-        logger.error(f'[new test ssh] error in database (agent: {current_user.user_id} -username: {username} -error: {e})')
-        db.rollback()
-        _, err = delete_ssh_account(selected_server.server_ip, username)
-        if err:
-            logger.error(f'[new test ssh] error in delete account (agent: {current_user.user_id} -username: {username} -server_ip: {selected_server.server_ip} -domain: {selected_domain.domain_name} -resp_code: {err.status_code} -detail: {err.detail})')
+        except Exception as e:
+            db.rollback()
+
+            if isinstance(e, IntegrityError) and attempt < USERNAME_RETRIES and db_ssh_service.get_service_by_username(username, db):
+                logger.warning(f'[new test ssh] username was taken meanwhile, retrying with a new one (agent: {current_user.user_id} -username: {username} -attempt: {attempt})')
+
+                username, err = replace_taken_username(selected_server.server_ip, username, password, db, cache_db)
+                if err:
+                    logger.error(f'[new test ssh] ssh account creation failed (agent: {current_user.user_id} -username: {username} -server_ip: {selected_server.server_ip} -resp_code: {err.status_code} -error: {err.detail})')
+                    raise err
+
+                service_data['username'] = username
+                continue
+
+            logger.error(f'[new test ssh] error in database (agent: {current_user.user_id} -username: {username} -error: {e})')
+            _, err = delete_ssh_account(selected_server.server_ip, username)
+            if err:
+                logger.error(f'[new test ssh] error in delete account (agent: {current_user.user_id} -username: {username} -server_ip: {selected_server.server_ip} -domain: {selected_domain.domain_name} -resp_code: {err.status_code} -detail: {err.detail})')
         
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail='check the logs for more info')
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail='check the logs for more info')
     # ================= Commit =================
 
     response_message = {
@@ -175,7 +222,8 @@ def create_test_ssh_via_agent(request: NewSsh, current_user: TokenUser= Depends(
         'port': generate_port(username),
     }
 
-    set_test_account_cache(current_user.user_id, username, 24*60*60, get_redis_cache().__next__())
+    set_test_account_cache(current_user.user_id, username, 24*60*60, cache_db)
+    update_expire_schedule(service.service_id, service.expire, ConfigType.TEST, cache_db)
     logger.info(f'[new test ssh] the ssh account was created successfully (agent: {current_user.user_id} -username: {username} -server_ip: {selected_server.server_ip} -domain: {selected_domain.domain_name} -plan_id: {plan.plan_id})')
     
     return NewSshResponse(**response_message)
@@ -190,7 +238,7 @@ def create_test_ssh_via_agent(request: NewSsh, current_user: TokenUser= Depends(
     status.HTTP_423_LOCKED:{'model':HTTPError},
     status.HTTP_500_INTERNAL_SERVER_ERROR:{'model':HTTPError},
     })
-def create_new_ssh_via_agent(request: NewSsh, current_user: TokenUser= Depends(get_agent_user), db: Session=Depends(get_db)):
+def create_new_ssh_via_agent(request: NewSsh, current_user: TokenUser= Depends(get_agent_user), db: Session=Depends(get_db), cache_db: Redis=Depends(get_redis_cache)):
     
     plan = db_ssh_plan.get_plan_by_id(request.plan_id, db)
     
@@ -218,11 +266,7 @@ def create_new_ssh_via_agent(request: NewSsh, current_user: TokenUser= Depends(g
             raise err
 
     password = generate_password()
-    while True:
-
-        username = 'user_' + str(randint(100_000, 999_000))
-        if db_ssh_service.get_service_by_username(username, db) == None:
-            break
+    username = generate_username(db, cache_db)
         
     user_financial = UserFinancial(user_id= current_user.user_id, username= username, password= password)
     
@@ -272,20 +316,35 @@ def create_new_ssh_via_agent(request: NewSsh, current_user: TokenUser= Depends(g
     }
 
     # ================= Begin =================
-    try:
-        service = db_ssh_service.create_ssh(SshService(**service_data), db, commit=False)
-        db_server.increase_ssh_accounts_number(selected_server.server_ip, db, commit=False)
-        db.commit()
-        db.refresh(service)
-    
-    except Exception as e:
-        logger.error(f'[new ssh] error in database (agent: {current_user.user_id} -username: {username} -error: {e})')
-        db.rollback()
-        _, err = delete_ssh_account(selected_server.server_ip, username)
-        if err:
-            logger.error(f'[new ssh] error (agent: {current_user.user_id} -username: {username} -server_ip: {selected_server.server_ip} -domain: {selected_domain.domain_name} -resp_code: {err.status_code} -detail: {err.detail})')
+    for attempt in range(1, USERNAME_RETRIES + 1):
+        try:
+            service = db_ssh_service.create_ssh(SshService(**service_data), db, commit=False)
+            db_server.increase_ssh_accounts_number(selected_server.server_ip, db, commit=False)
+            db_outbox.add_operation(selected_server.server_ip, username, OutboxOperation.CREATE, db, commit=False)
+            db.commit()
+            db.refresh(service)
+            break
+
+        except Exception as e:
+            db.rollback()
+
+            if isinstance(e, IntegrityError) and attempt < USERNAME_RETRIES and db_ssh_service.get_service_by_username(username, db):
+                logger.warning(f'[new ssh] username was taken meanwhile, retrying with a new one (agent: {current_user.user_id} -username: {username} -attempt: {attempt})')
+
+                username, err = replace_taken_username(selected_server.server_ip, username, password, db, cache_db)
+                if err:
+                    logger.error(f'[new ssh] ssh account creation failed (agent: {current_user.user_id} -username: {username} -server_ip: {selected_server.server_ip} -resp_code: {err.status_code} -error: {err.detail})')
+                    raise err
+
+                service_data['username'] = username
+                continue
+
+            logger.error(f'[new ssh] error in database (agent: {current_user.user_id} -username: {username} -error: {e})')
+            _, err = delete_ssh_account(selected_server.server_ip, username)
+            if err:
+                logger.error(f'[new ssh] error (agent: {current_user.user_id} -username: {username} -server_ip: {selected_server.server_ip} -domain: {selected_domain.domain_name} -resp_code: {err.status_code} -detail: {err.detail})')
         
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail='check the logs for more info')
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail='check the logs for more info')
     # ================= Commit =================
 
     agent = db_user.get_user_by_user_id(current_user.user_id, db)
@@ -293,6 +352,8 @@ def create_new_ssh_via_agent(request: NewSsh, current_user: TokenUser= Depends(g
     db_subset.increase_number_of_configs_by_user(agent.parent_agent_id, db, commit= False)
     db.commit()
 
+    update_expire_schedule(service.service_id, service.expire, ConfigType.MAIN, cache_db)
+
     logger.info(f'[new ssh] increase the parent agent profit (agent: {current_user.user_id} -parent_agent: {agent.parent_agent_id} -profit_value: {plan.price * PERCENT_PARTNERSHIP_PROFIT} -percent: {PERCENT_PARTNERSHIP_PROFIT} -value: {plan.price})')
     
     response_message = {
@@ -314,7 +375,7 @@ def create_new_ssh_via_agent(request: NewSsh, current_user: TokenUser= Depends(g
     status.HTTP_400_BAD_REQUEST:{'model':HTTPError},
     status.HTTP_423_LOCKED:{'model':HTTPError},
     status.HTTP_409_CONFLICT:{'model':HTTPError}} )
-def update_ssh_account_expire(request: UpdateSshExpire, current_user: TokenUser= Depends(get_agent_user), db: Session=Depends(get_db)):
+def update_ssh_account_expire(request: UpdateSshExpire, current_user: TokenUser= Depends(get_agent_user), db: Session=Depends(get_db), cache_db: Redis=Depends(get_redis_cache)):
 
     username = request.username.lower()    
     service = db_ssh_service.get_service_by_username(username, db)
@@ -403,10 +464,13 @@ def update_ssh_account_expire(request: UpdateSshExpire, current_user: TokenUser=
     # =================== Begin ===================
     db_ssh_service.update_expire(service.service_id, request_new_expire, db, commit= False)
     db_ssh_service.change_status(service.service_id, ServiceStatusDb.ENABLE, db, commit=False)
+    if request.unblock == True:
+        db_outbox.add_operation(domain.server_ip, username, OutboxOperation.UNBLOCK, db, commit=False)
 
     db.commit()
 
     # =================== Commit ===================
+    update_expire_schedule(service.service_id, request_new_expire, service.service_type, cache_db)
     logger.info(f'[expire] successfully update expire (agent: {current_user.user_id} -username:{username} -new_expire: {request.new_expire})')
     
     return UpdateSshExpireResponse(**{'username': service.username, 'expire': request_new_expire})
@@ -437,6 +501,7 @@ def block_ssh_account_via_agent(request: BlockSsh, current_user: TokenUser= Depe
         logger.error(f'[block] error (agent: {current_user.user_id} -username: {username} -resp_code: {err.status_code} -detail: {err.detail})')
         raise err
     
+    db_outbox.add_operation(domain.server_ip, username, OutboxOperation.BLOCK, db, commit=False)
     db_ssh_service.change_status(service.service_id, ServiceStatusDb.DISABLE, db)
     logger.info(f'[block] successfully blocked (agent: {current_user.user_id} -username: {username})')
 
@@ -476,6 +541,7 @@ def unblock_ssh_account_via_agent(request: UnBlockSsh, current_user: TokenUser=
         logger.error(f'[unblock] error (agent: {current_user.user_id} -username: {username} -resp_code: {err.status_code} -detail: {err.detail})')
         raise err
     
+    db_outbox.add_operation(domain.server_ip, username, OutboxOperation.UNBLOCK, db, commit=False)
     db_ssh_service.change_status(service.service_id, ServiceStatusDb.ENABLE, db)
     logger.info(f'[unblock] successfully unblocked (agent: {current_user.user_id} -username: {username})')
 
@@ -486,7 +552,7 @@ def unblock_ssh_account_via_agent(request: UnBlockSsh, current_user: TokenUser=
     status.HTTP_404_NOT_FOUND:{'model': HTTPError},
     status.HTTP_500_INTERNAL_SERVER_ERROR:{'model': HTTPError},
     status.HTTP_408_REQUEST_TIMEOUT:{'model': HTTPError}})
-def delete_ssh_account_via_agent(request: DeleteSsh, current_user: TokenUser= Depends(get_agent_user), db: Session=Depends(get_db)):
+def delete_ssh_account_via_agent(request: DeleteSsh, current_user: TokenUser= Depends(get_agent_user), db: Session=Depends(get_db), cache_db: Redis=Depends(get_redis_cache)):
 
     username = request.username.lower()
     service = db_ssh_service.get_service_by_username(username, db)
@@ -510,6 +576,7 @@ def delete_ssh_account_via_agent(request: DeleteSsh, current_user: TokenUser= De
     try:
         db_server.decrease_ssh_accounts_number(domain.server_ip, db, commit=False) 
         db_ssh_service.change_status(service.service_id, ServiceStatusDb.DELETED, db, commit=False)
+        db_outbox.add_operation(domain.server_ip, username, OutboxOperation.DELETE, db, commit=False)
         db.commit()
 
     except Exception as e:
@@ -517,6 +584,7 @@ def delete_ssh_account_via_agent(request: DeleteSsh, current_user: TokenUser= De
         db.rollback()
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail='check the logs for more info')
 
+    update_expire_schedule(service.service_id, None, service.service_type, cache_db, remove= True)
     logger.info(f'[delete] successfully deleted (agent: {current_user.user_id} -username: {username})')
     return f'Successfully delete user [{username}]'
 
@@ -526,7 +594,7 @@ def delete_ssh_account_via_agent(request: DeleteSsh, current_user: TokenUser= De
     status.HTTP_500_INTERNAL_SERVER_ERROR:{'model': HTTPError},
     status.HTTP_408_REQUEST_TIMEOUT:{'model': HTTPError},
     status.HTTP_409_CONFLICT:{'model':HTTPError}})
-def renew_config(request: RenewSsh, current_user: TokenUser= Depends(get_agent_user), db: Session=Depends(get_db)):
+def renew_config(request: RenewSsh, current_user: TokenUser= Depends(get_agent_user), db: Session=Depends(get_db), cache_db: Redis=Depends(get_redis_cache)):
 
     username = request.username.lower()
     service = db_ssh_service.get_service_by_username(username, db)
@@ -589,6 +657,11 @@ def renew_config(request: RenewSsh, current_user: TokenUser= Depends(get_agent_u
         db_server.decrease_ssh_accounts_number(old_domain.server_ip, db, commit= False) 
         db_ssh_service.transfer_user_by_domain(service.username, selected_domain.domain_id, db, commit=False)
         db_server.increase_ssh_accounts_number(selected_server.server_ip, db, commit= False)
+        db_outbox.add_operation(selected_server.server_ip, username, OutboxOperation.CREATE, db, commit=False)
+        if service.status == ServiceStatusDb.DISABLE or service.status == ServiceStatusDb.EXPIRED:
+            db_outbox.add_operation(selected_server.server_ip, username, OutboxOperation.BLOCK, db, commit=False)
+
+        db_outbox.add_operation(old_domain.server_ip, username, OutboxOperation.DELETE, db, commit=False)
         db.commit()
 
     except Exception as e: 
@@ -596,6 +669,9 @@ def renew_config(request: RenewSsh, current_user: TokenUser= Depends(get_agent_u
         db.rollback()
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail='check the logs for more info')
     
+    if service.status in [ServiceStatusDb.ENABLE, ServiceStatusDb.DISABLE]:
+        update_expire_schedule(service.service_id, service.expire, service.service_type, cache_db)
+
     response_message = {
         'username': username, 
         'password': service.password, 
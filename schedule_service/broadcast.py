@@ -0,0 +1,112 @@
+import sys
+
+sys.path.append('/root/ssh-master-api')
+
+from db import db_user
+from db.database import get_db
+from celery_tasks.tasks import NotificationCeleryTask
+from celery_tasks.utils import create_worker_from
+from cache.database import get_redis_cache
+from cache.cache_session import get_broadcast, update_broadcast, pop_broadcast, ack_broadcast, requeue_broadcasts
+from schemas import BroadcastStatus
+from sqlalchemy.orm.session import Session
+from time import sleep
+import logging
+import redis
+import json
+
+logger = logging.getLogger('broadcast.log')
+logger.setLevel(logging.INFO)
+
+# Create a file handler to save logs to a file
+file_handler = logging.FileHandler('broadcast.log')
+file_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s | %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s | %(message)s')
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+
+_, notification_worker = create_worker_from(NotificationCeleryTask)
+
+NOTIFICATION_BATCH_SIZE = 100
+# blmove has to return before the socket timeout of the shared redis pool
+WAKEUP_STEP = 4
+# a requeued broadcast may have stopped in any of these
+RUNNABLE_STATUSES = (BroadcastStatus.PENDING, BroadcastStatus.EXPANDING, BroadcastStatus.SENDING)
+
+
+def run_broadcast(broadcast_id, db: Session, cache_db: redis.Redis):
+
+    record = get_broadcast(broadcast_id, cache_db)
+    if not record or record['status'] not in RUNNABLE_STATUSES:
+        return
+
+    # an interrupted broadcast continues after its last enqueued batch instead of sending twice
+    start = int(record['enqueued']) if record['status'] == BroadcastStatus.SENDING else 0
+
+    update_broadcast(broadcast_id, {'status': BroadcastStatus.EXPANDING.value}, cache_db)
+
+    # one query for every recipient
+    rows = db_user.get_broadcast_recipients(db, accept_usernames= json.loads(record['accept_agents']), except_usernames= json.loads(record['except_agents']))
+    chat_ids = [row.chat_id for row in rows if row.chat_id]
+
+    update_broadcast(broadcast_id, {'total': len(chat_ids), 'skipped': len(rows) - len(chat_ids), 'status': BroadcastStatus.SENDING.value}, cache_db)
+
+    messages = [
+        {
+            'chat_id': chat_id,
+            'message': record['message'],
+            'bot_selector': record['bot_selector'],
+            'parse_mode': record['parse_mode'] or None,
+            'inline_keyboard': [[['👍 مشاهده کردم', 'notif_click']]]
+        } for chat_id in chat_ids
+    ]
+
+    for index in range(start, len(messages), NOTIFICATION_BATCH_SIZE):
+
+        batch = messages[index: index + NOTIFICATION_BATCH_SIZE]
+        notification_worker.apply_async(args=({'messages': batch, 'broadcast_id': broadcast_id},))
+        update_broadcast(broadcast_id, {'enqueued': index + len(batch)}, cache_db)
+
+    if not messages:
+        update_broadcast(broadcast_id, {'status': BroadcastStatus.DONE.value}, cache_db)
+
+    logger.info(f'[broadcast] enqueued (broadcast_id: {broadcast_id} -recipients: {len(chat_ids)} -skipped: {len(rows) - len(chat_ids)} -resumed_from: {start})')
+
+
+if __name__ == '__main__':
+
+    for broadcast_id in requeue_broadcasts(get_redis_cache().__next__()):
+        logger.warning(f'[broadcast] requeued an interrupted broadcast (broadcast_id: {broadcast_id})')
+
+    while True:
+        broadcast_id = None
+        try:
+            cache_db = get_redis_cache().__next__()
+            db = get_db().__next__()
+
+            broadcast_id = pop_broadcast(WAKEUP_STEP, cache_db)
+            if broadcast_id:
+                run_broadcast(broadcast_id, db, cache_db)
+                ack_broadcast(broadcast_id, cache_db)
+
+            db.close()
+
+        except Exception as e:
+            logger.error(f'[exception]  [broadcast_id: {broadcast_id} -error: {e}]')
+            if broadcast_id:
+                try:
+                    update_broadcast(broadcast_id, {'status': BroadcastStatus.FAILED.value}, cache_db)
+                    ack_broadcast(broadcast_id, cache_db)
+
+                except Exception as e:
+                    # still in broadcast:processing, the next start requeues it
+                    logger.error(f'[exception]  [broadcast_id: {broadcast_id} -error: {e}]')
+
+            sleep(5)
@@ -2,19 +2,37 @@ import sys
 
 sys.path.append('/root/ssh-master-api')
 
-from db import db_ssh_service, db_server, db_domain, db_user
+from db import db_ssh_service, db_server, db_user, db_outbox
 from db.models import DbSshService
 from db.database import get_db
 from datetime import datetime, timedelta
 from celery_tasks.tasks import NotificationCeleryTask
 from celery_tasks.utils import create_worker_from
 from cache.database import get_redis_cache
-from cache.cache_session import get_check_label, set_check_label
-from slave_api.ssh import block_ssh_account, delete_ssh_account
-from schemas import ServiceStatusDb, ConfigType
-from time import sleep
-import pytz
-from typing import List
+from cache.cache_session import (
+    get_check_labels,
+    set_check_labels,
+    schedule_service_delete,
+    get_due_expire_actions,
+    get_next_expire_action,
+    reschedule_expire_actions,
+    remove_expire_actions,
+    wait_expire_schedule,
+    queue_digest_events,
+    get_due_digests,
+    get_next_digest,
+    get_digest_usernames,
+    complete_digest,
+    claim_digest
+)
+from slave_api.ssh import block_ssh_account_via_groups, delete_ssh_account_via_group
+from schemas import ServiceStatusDb, ConfigType, OutboxOperation
+from sqlalchemy.orm.session import Session
+from time import sleep, time
+from typing import Dict, List, Tuple
+import hashlib
+import redis
+import os
 
 import logging
 
@@ -39,132 +57,396 @@ _, notification_worker = create_worker_from(NotificationCeleryTask)
 
 timedelta_1 = timedelta(days=1)
 
+BATCH_SIZE = 500
+DELETE_AFTER_DAYS = 2
+LONG_DELETE_AFTER_DAYS = 7
+LONG_DELETE_AGENTS = [1, 3, 10, 11, 12, 14, 21]
 
-def check_active_users(active_services: List[DbSshService]):
+# the full range scan backs up the schedule (accounts created before it or lost updates),
+# it keeps the old polling interval so those accounts are never handled later than before
+SWEEP_INTERVAL = 5 * 60
+RETRY_DELAY = 60
+# blpop has to return before the socket timeout of the shared redis pool
+WAKEUP_STEP = 4
 
-    for service in active_services:
+# the notifications of one agent are collected per event for this long and sent as one digest
+NOTIFICATION_DIGEST_WINDOW = int(os.getenv('NOTIFICATION_DIGEST_WINDOW', 600))
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
 
-        time_now = datetime.now().replace(tzinfo=pytz.utc)
-        service_expire = service.expire.replace(tzinfo=pytz.utc)
+# event -> (message for one username, title of the digest)
+digest_messages = {
+    'warn': ('📩 نام کاربری `{0}` فردا منقضی میشه', '📩 این نام کاربری‌ها فردا منقضی میشن:'),
+    'expired': ('📩 نام کاربری `{0}` منقضی و دسترسیش مسدود شد', '📩 این نام کاربری‌ها منقضی و دسترسیشون مسدود شد:'),
+    'deleted': ('📩 نام کاربری `{0}` به  دلیل تمدید نکردن حذف شد', '📩 این نام کاربری‌ها به دلیل تمدید نکردن حذف شدن:')
+}
 
-        if not get_check_label(service.service_id, cache_db) and service_expire - time_now < timedelta_1:
 
-            user = db_user.get_user_by_user_id(service.agent_id, db)
-            if user.chat_id and service.service_type == ConfigType.MAIN:
-                payload = {
-                    'chat_id': user.chat_id,
-                    'message': f'📩 نام کاربری `{service.username}` فردا منقضی میشه',
-                    'bot_selector': 'vpn_cluster',
-                    'inline_keyboard': [[['👍 مشاهده کردم', 'notif_click']]],
-                    'parse_mode': 'markdown'
-                }
-                notification_worker.apply_async(args=(payload,))
-                
-            set_check_label(service.service_id, cache_db)
+def chunks(items: list, size: int= BATCH_SIZE):
 
-        if time_now > service_expire :
-            
-            domain = db_domain.get_domain_by_id(service.domain_id, db)
-            _ , err = block_ssh_account(domain.server_ip, service.username)
-            if err:
-                logger.error(f'[expire] failed account blocking [server: {domain.server_ip} -username: {service.username} -resp_code: {err.status_code} -detail: {err.detail}]')
-                continue
-        
-            db_ssh_service.change_status(service.service_id, ServiceStatusDb.EXPIRED, db)
-            logger.info(f'[expire] successfully account blocked  [server: {domain.server_ip} -username: {service.username}]')
+    for index in range(0, len(items), size):
+        yield items[index: index + size]
+
+
+def group_by_server(rows: List[Tuple[DbSshService, str]]) -> Dict[str, List[DbSshService]]:
+
+    servers = {}
+    for service, server_ip in rows:
+        servers.setdefault(server_ip, []).append(service)
+
+    return servers
+
+
+def send_notification(chat_id, message):
+
+    payload = {
+        'chat_id': chat_id,
+        'message': message,
+        'bot_selector': 'vpn_cluster',
+        'inline_keyboard': [[['👍 مشاهده کردم', 'notif_click']]],
+        'parse_mode': 'markdown'
+    }
+    notification_worker.apply_async(args=(payload,))
+
+
+def queue_notifications(services: List[DbSshService], event: str, cache_db: redis.Redis):
+
+    # the expire time is part of the key, so a renewed account is notified again on its next expiry
+    events = [
+        (service.agent_id, event, service.username, f'{event}:{service.service_id}:{int(service.expire.timestamp())}')
+            for service in services
+    ]
+    queue_digest_events(events, NOTIFICATION_DIGEST_WINDOW, cache_db)
+
+
+def digest_chunks(title: str, usernames: List[str], limit: int= TELEGRAM_MAX_MESSAGE_LENGTH) -> List[str]:
+
+    messages = []
+    message = title
+    for username in usernames:
+
+        line = f'\n`{username}`'
+        if len(message) + len(line) > limit:
+            messages.append(message)
+            message = title
+
+        message += line
+
+    messages.append(message)
+    return messages
+
+
+def flush_digests(db: Session, cache_db: redis.Redis):
+
+    due_digests = [member.split(':', 1) for member in get_due_digests(time(), cache_db)]
+    if not due_digests:
+        return
+
+    agents = {agent.user_id: agent for agent in db_user.get_users_by_user_ids(list({int(agent_id) for agent_id, _ in due_digests}), db)}
+
+    for agent_id, event in due_digests:
+
+        usernames = sorted(get_digest_usernames(agent_id, event, cache_db))
+        user = agents.get(int(agent_id))
+
+        if usernames and user and user.chat_id:
 
-            user = db_user.get_user_by_user_id(service.agent_id, db)
+            single_message, title = digest_messages[event]
+            messages = [single_message.format(usernames[0])] if len(usernames) == 1 else digest_chunks(title, usernames)
 
-            if user.chat_id and service.service_type == ConfigType.MAIN:
-                payload = {
-                    'chat_id': user.chat_id,
-                    'message': f'📩 نام کاربری `{service.username}` منقضی و دسترسیش مسدود شد',
-                    'bot_selector': 'vpn_cluster',
-                    'inline_keyboard': [[['👍 مشاهده کردم', 'notif_click']]],
-                    'parse_mode': 'markdown'
-                }
-                notification_worker.apply_async(args=(payload,))
+            for index, message in enumerate(messages):
 
+                # a restart between sending and completing the digest must not send it again
+                digest_key = hashlib.sha1(f'{agent_id}:{event}:{index}:{",".join(usernames)}'.encode()).hexdigest()
+                if claim_digest(digest_key, 24*60*60, cache_db):
+                    send_notification(user.chat_id, message)
 
-def check_expired_users(expired_services: List[DbSshService]):
+            logger.info(f'[digest] sent (agent: {agent_id} -event: {event} -users: {len(usernames)} -messages: {len(messages)})')
 
-    for service in expired_services:
+        complete_digest(agent_id, event, usernames, NOTIFICATION_DIGEST_WINDOW, cache_db)
 
-        time_now = datetime.now().replace(tzinfo=pytz.utc)
-        service_expire = service.expire.replace(tzinfo=pytz.utc)
 
-        day= 2
-        if service.agent_id in [1, 3, 10, 11,12,14,21]:
-            day = 7
+def delete_deadline(service: DbSshService) -> datetime:
 
-        if service.service_type == ConfigType.TEST:
+    if service.service_type == ConfigType.TEST:
+        return service.expire
 
-            domain = db_domain.get_domain_by_id(service.domain_id, db)
+    if service.agent_id in LONG_DELETE_AGENTS:
+        return service.expire + timedelta(days= LONG_DELETE_AFTER_DAYS)
 
-            _ ,err = delete_ssh_account(domain.server_ip, service.username)
+    return service.expire + timedelta(days= DELETE_AFTER_DAYS)
+
+
+def warn_services(rows: List[Tuple[DbSshService, str]], cache_db: redis.Redis):
+
+    # once per account, the labels are read and written in batches
+    for batch in chunks([service for service, _ in rows]):
+
+        labels = get_check_labels([service.service_id for service in batch], cache_db)
+        checked_services = [service for service, label in zip(batch, labels) if not label]
+
+        if checked_services:
+            queue_notifications(checked_services, 'warn', cache_db)
+            set_check_labels([service.service_id for service in checked_services], cache_db)
+
+
+def split_slave_result(batch: List[DbSshService], resp: dict) -> Tuple[List[DbSshService], List[DbSshService]]:
+    """
+    (applied, missing) services of a batch from a slave group response.
+    applied ones were changed on the node, missing ones do not exist there
+    any more; the rest failed and stay in the schedule to be retried
+    """
+    success_users = set(resp.get('success_users', []))
+    not_exists_users = set(resp.get('not_exists_users', []))
+
+    applied = [service for service in batch if service.username in success_users]
+    missing = [service for service in batch if service.username in not_exists_users and service.username not in success_users]
+
+    return applied, missing
+
+
+def block_services(rows: List[Tuple[DbSshService, str]], db: Session, cache_db: redis.Redis) -> List[DbSshService]:
+
+    blocked_services = []
+
+    # one slave call per server batch
+    for server_ip, services in group_by_server(rows).items():
+
+        for batch in chunks(services):
+
+            usernames = [service.username for service in batch]
+
+            resp, err = block_ssh_account_via_groups(server_ip, usernames, ignore_not_exists_users= True)
             if err:
-                logger.error(f'[delete] failed account deleted (server: {domain.server_ip} -username: {service.username} -resp_code: {err.status_code} -detail: {err.detail})')
+                logger.error(f'[expire] failed accounts blocking [server: {server_ip} -users: {len(usernames)} -resp_code: {err.status_code} -detail: {err.detail}]')
+                continue
+
+            applied, missing = split_slave_result(batch, resp)
+            failed_users = set(usernames) - {service.username for service in applied + missing}
+            if failed_users:
+                logger.error(f'[expire] some accounts were not blocked [server: {server_ip} -users: {sorted(failed_users)}]')
+
+            # an account that is not on the node has nothing left to block, so it is marked too
+            changed = applied + missing
+            if not changed:
                 continue
-                
+
             try:
-                db_server.decrease_ssh_accounts_number(domain.server_ip, db) 
-                db_ssh_service.change_status(service.service_id, ServiceStatusDb.DELETED, db)
+                db_ssh_service.change_status_via_group([service.service_id for service in changed], ServiceStatusDb.EXPIRED, db, commit= False)
+                db_outbox.add_operations(server_ip, [service.username for service in applied], OutboxOperation.BLOCK, db, commit= False)
+                db.commit()
 
             except Exception as e:
-                logger.error(f'[delete] error in database (username: {service.username} -error: {e})')
-                continue                    
+                db.rollback()
+                logger.error(f'[expire] error in database [server: {server_ip} -users: {usernames} -error: {e}]')
+                continue
+
+            logger.info(f'[expire] successfully accounts blocked [server: {server_ip} -users: {[service.username for service in applied]} -not_exists: {[service.username for service in missing]}]')
+            blocked_services.extend(changed)
+
+            queue_notifications([service for service in applied if service.service_type == ConfigType.MAIN], 'expired', cache_db)
+
+    return blocked_services
 
-            logger.info(f'[delete] successfully account deleted [server: {domain.server_ip} -username: {service.username}]')
 
-        elif time_now - service_expire > timedelta(days= day):
-            domain = db_domain.get_domain_by_id(service.domain_id, db)
+def delete_services(rows: List[Tuple[DbSshService, str]], db: Session, cache_db: redis.Redis) -> List[DbSshService]:
 
-            _ ,err = delete_ssh_account(domain.server_ip, service.username)
+    deleted_services = []
+
+    for server_ip, services in group_by_server(rows).items():
+
+        for batch in chunks(services):
+
+            usernames = [service.username for service in batch]
+
+            resp ,err = delete_ssh_account_via_group(server_ip, usernames, ignore_not_exists_users= True)
             if err:
-                logger.error(f'[delete] failed account deleted (server: {domain.server_ip} -username: {service.username} -resp_code: {err.status_code} -detail: {err.detail})')
+                logger.error(f'[delete] failed accounts deleted (server: {server_ip} -users: {len(usernames)} -resp_code: {err.status_code} -detail: {err.detail})')
+                continue
+
+            applied, missing = split_slave_result(batch, resp)
+            failed_users = set(usernames) - {service.username for service in applied + missing}
+            if failed_users:
+                logger.error(f'[delete] some accounts were not deleted (server: {server_ip} -users: {sorted(failed_users)})')
+
+            changed = applied + missing
+            if not changed:
                 continue
-                
+
             try:
-                db_server.decrease_ssh_accounts_number(domain.server_ip, db) 
-                db_ssh_service.change_status(service.service_id, ServiceStatusDb.DELETED, db)
+                # only the accounts removed from the node were counted on it
+                db_server.decrease_ssh_accounts_number(server_ip, db, commit= False, number= len(applied))
+                db_ssh_service.change_status_via_group([service.service_id for service in changed], ServiceStatusDb.DELETED, db, commit= False)
+                db_outbox.add_operations(server_ip, [service.username for service in applied], OutboxOperation.DELETE, db, commit= False)
+                db.commit()
 
             except Exception as e:
-                logger.error(f'[delete] error in database (username: {service.username} -error: {e})')
-                continue                    
+                db.rollback()
+                logger.error(f'[delete] error in database (server: {server_ip} -users: {usernames} -error: {e})')
+                continue
+
+            logger.info(f'[delete] successfully accounts deleted [server: {server_ip} -users: {[service.username for service in applied]} -not_exists: {[service.username for service in missing]}]')
+            deleted_services.extend(changed)
+
+            queue_notifications([service for service in applied if service.service_type == ConfigType.MAIN], 'deleted', cache_db)
+
+    return deleted_services
+
+
+def check_active_users(db: Session, cache_db: redis.Redis):
+
+    time_now = datetime.now()
+
+    # the accounts that expire in the next 24h
+    warning_rows = db_ssh_service.get_services_with_server_by_expire(
+        db,
+        status= [ServiceStatusDb.ENABLE, ServiceStatusDb.DISABLE],
+        start_time= time_now,
+        end_time= time_now + timedelta_1,
+        type_= ConfigType.MAIN
+    )
+
+    # the accounts that have expired and are still active
+    expired_rows = db_ssh_service.get_services_with_server_by_expire(
+        db,
+        status= [ServiceStatusDb.ENABLE, ServiceStatusDb.DISABLE],
+        end_time= time_now
+    )
+
+    warn_services(warning_rows, cache_db)
+    for service in block_services(expired_rows, db, cache_db):
+        schedule_service_delete(service.service_id, delete_deadline(service), cache_db)
+
+
+def check_expired_users(db: Session, cache_db: redis.Redis):
+
+    time_now = datetime.now()
+
+    # all the expired test accounts and the main accounts that passed the shortest grace period
+    test_rows = db_ssh_service.get_services_with_server_by_expire(db, status= [ServiceStatusDb.EXPIRED], type_= ConfigType.TEST)
+    main_rows = db_ssh_service.get_services_with_server_by_expire(db, status= [ServiceStatusDb.EXPIRED], end_time= time_now - timedelta(days= DELETE_AFTER_DAYS), type_= ConfigType.MAIN)
+
+    main_rows = [(service, server_ip) for service, server_ip in main_rows if delete_deadline(service) <= time_now]
+
+    delete_services(test_rows + main_rows, db, cache_db)
 
-            logger.info(f'[delete] successfully account deleted [server: {domain.server_ip} -username: {service.username}]')
 
-            user = db_user.get_user_by_user_id(service.agent_id, db)
-            if user.chat_id:
-                payload = {
-                    'chat_id': user.chat_id,
-                    'message': f'📩 نام کاربری `{service.username}` به  دلیل تمدید نکردن حذف شد',
-                    'bot_selector': 'vpn_cluster',
-                    'inline_keyboard': [[['👍 مشاهده کردم', 'notif_click']]],
-                    'parse_mode': 'markdown'
-                }
-                notification_worker.apply_async(args=(payload,))
+def process_due_actions(db: Session, cache_db: redis.Redis) -> int:
+    """
+    pop one batch of due actions (warn:<id>, block:<id>, delete:<id>) from the
+    schedule and apply them; the db row is the source of truth, so actions
+    whose account was renewed or removed in the meantime are dropped or moved
+    to their new due time.
+    """
+    members = get_due_expire_actions(time(), BATCH_SIZE, cache_db)
+    if not members:
+        return 0
 
+    actions = {}
+    for member in members:
+        action, service_id = member.split(':', 1)
+        actions.setdefault(int(service_id), set()).add(action)
+
+    rows = db_ssh_service.get_services_with_server_by_ids(list(actions), db)
+
+    time_now = datetime.now()
+    active_status = [ServiceStatusDb.ENABLE, ServiceStatusDb.DISABLE]
+
+    warning_rows, expired_rows, delete_rows = [], [], []
+    for service, server_ip in rows:
+
+        service_actions = actions[service.service_id]
+
+        if service.status in active_status and service.expire <= time_now:
+            if 'block' in service_actions or 'warn' in service_actions:
+                expired_rows.append((service, server_ip))
+
+        elif service.status in active_status:
+            if 'warn' in service_actions and service.service_type == ConfigType.MAIN and service.expire <= time_now + timedelta_1:
+                warning_rows.append((service, server_ip))
+
+        elif service.status == ServiceStatusDb.EXPIRED and 'delete' in service_actions:
+            if delete_deadline(service) <= time_now:
+                delete_rows.append((service, server_ip))
+
+    warn_services(warning_rows, cache_db)
+    blocked_services = block_services(expired_rows, db, cache_db)
+    deleted_services = delete_services(delete_rows, db, cache_db)
+
+    for service in blocked_services:
+        schedule_service_delete(service.service_id, delete_deadline(service), cache_db)
+
+    # the slave or the db failed for these accounts (or only for some users of a batch), try again later instead of waiting for the sweep
+    blocked_id = {service.service_id for service in blocked_services}
+    deleted_id = {service.service_id for service in deleted_services}
+    retry_at = time() + RETRY_DELAY
+
+    retry_actions = {f'block:{service.service_id}': retry_at for service, _ in expired_rows if service.service_id not in blocked_id}
+    retry_actions.update({f'delete:{service.service_id}': retry_at for service, _ in delete_rows if service.service_id not in deleted_id})
+
+    # the expire time was changed after the action had been queued, only the actions that are not due yet go back
+    for service, _ in rows:
+        if service.status in active_status and service.expire > time_now:
+            expire_ts = service.expire.timestamp()
+            retry_actions[f'block:{service.service_id}'] = expire_ts
+            if service.service_type == ConfigType.MAIN and service.expire - timedelta_1 > time_now:
+                retry_actions[f'warn:{service.service_id}'] = expire_ts - timedelta_1.total_seconds()
+
+        elif service.status == ServiceStatusDb.EXPIRED and 'delete' in actions[service.service_id] and delete_deadline(service) > time_now:
+            schedule_service_delete(service.service_id, delete_deadline(service), cache_db)
+
+    # failed actions are not removed, they only get a later score
+    if retry_actions:
+        reschedule_expire_actions(retry_actions, cache_db)
+
+    done_members = [member for member in members if member not in retry_actions]
+    if done_members:
+        remove_expire_actions(done_members, cache_db)
+
+    logger.info(f'[schedule] processed due actions (actions: {len(members)} -warned: {len(warning_rows)} -blocked: {len(blocked_services)} -deleted: {len(deleted_services)} -retry: {len(retry_actions)})')
+
+    return len(members)
+
+
+def wait_for_next_action(cache_db: redis.Redis, until: float):
+    """
+    sleep until the next scheduled action or digest is due (but not past `until`),
+    routes push to the wakeup list when they schedule something earlier
+    """
+    while True:
+
+        next_action = get_next_expire_action(cache_db)
+        next_digest = get_next_digest(cache_db)
+        due_at = min(next_action[1] if next_action else until, next_digest[1] if next_digest else until)
+
+        remaining = min(due_at, until) - time()
+        if remaining <= 0:
+            return
+
+        wait_expire_schedule(max(1, min(int(remaining + 0.5), WAKEUP_STEP)), cache_db)
 
 
 if __name__ == '__main__':
 
+    last_sweep = 0
+
     while True:
         try:
             cache_db = get_redis_cache().__next__()
             db = get_db().__next__()
 
-            enable_services = db_ssh_service.get_all_services(db, status= ServiceStatusDb.ENABLE)
-            disable_services = db_ssh_service.get_all_services(db, status= ServiceStatusDb.DISABLE)
-            active_services = enable_services + disable_services
+            if time() - last_sweep >= SWEEP_INTERVAL:
+                check_active_users(db, cache_db)
+                check_expired_users(db, cache_db)
+                last_sweep = time()
 
-            check_active_users(active_services)
+            # drain everything that is due before going back to sleep
+            while process_due_actions(db, cache_db):
+                pass
 
-            expired_services = db_ssh_service.get_all_services(db, status= ServiceStatusDb.EXPIRED)
+            flush_digests(db, cache_db)
 
-            check_expired_users(expired_services)
+            wait_for_next_action(cache_db, last_sweep + SWEEP_INTERVAL)
 
         except Exception as e:
             logger.error(f'[exception]  [{e}]')
-        
-        sleep(300)
+            sleep(RETRY_DELAY)
@@ -0,0 +1,201 @@
+import sys
+
+sys.path.append('/root/ssh-master-api')
+
+from db import db_outbox, db_ssh_service
+from db.models import DbAccountOutbox
+from db.database import get_db, sessionlocal
+from slave_api.ssh import (
+    create_ssh_account_via_group,
+    delete_ssh_account_via_group,
+    block_ssh_account_via_groups,
+    unblock_ssh_account_via_groups
+)
+from schemas import OutboxOperation, ServiceStatusDb
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy.orm.session import Session
+from time import sleep, time
+from typing import List, Tuple
+import logging
+import os
+
+logger = logging.getLogger('outbox_delivery.log')
+logger.setLevel(logging.INFO)
+
+# Create a file handler to save logs to a file
+file_handler = logging.FileHandler('outbox_delivery.log')
+file_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s | %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s | %(message)s')
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 500))
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', 10))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 2))
+OUTBOX_MAX_BACKOFF = 300
+OUTBOX_RETENTION = timedelta(days= 3)
+PRUNE_INTERVAL = 60 * 60
+
+
+def consecutive_runs(operations: List[DbAccountOutbox]) -> List[Tuple[OutboxOperation, List[DbAccountOutbox]]]:
+    """ split the ordered operations into runs of the same type, each run is one slave call """
+    runs = []
+    for operation in operations:
+
+        if runs and runs[-1][0] == operation.operation:
+            runs[-1][1].append(operation)
+
+        else:
+            runs.append((operation.operation, [operation]))
+
+    return runs
+
+
+def still_wanted(operation: OutboxOperation, server_ip, usernames: List[str], db: Session) -> List[str]:
+    """
+    the usernames for which the operation still matches the current db state.
+    the routes already applied it synchronously, so the outbox only repairs
+    missed calls: a create of an account that has been deleted or moved since,
+    or an unblock of an account that is blocked again, is superseded and
+    must not be applied again whatever order the rows are read in
+    """
+    services = {service.username: (service, service_server_ip) for service, service_server_ip in db_ssh_service.get_services_with_server_by_usernames(usernames, db)}
+
+    wanted = []
+    for username in usernames:
+
+        service, service_server_ip = services.get(username, (None, None))
+        on_server = service is not None and service_server_ip == server_ip
+
+        if operation == OutboxOperation.DELETE:
+            keep = not on_server or service.status == ServiceStatusDb.DELETED
+
+        elif operation == OutboxOperation.CREATE:
+            keep = on_server and service.status != ServiceStatusDb.DELETED
+
+        elif operation == OutboxOperation.BLOCK:
+            keep = on_server and service.status in (ServiceStatusDb.DISABLE, ServiceStatusDb.EXPIRED)
+
+        else:
+            keep = on_server and service.status == ServiceStatusDb.ENABLE
+
+        if keep:
+            wanted.append(username)
+
+    return wanted
+
+
+def apply_run(server_ip, operation: OutboxOperation, usernames: List[str], db: Session):
+
+    usernames = still_wanted(operation, server_ip, usernames, db)
+    if not usernames:
+        return None, None
+
+    # every call ignores the accounts that are already in the wanted state, so a run can be replayed safely
+    if operation == OutboxOperation.CREATE:
+
+        users = [
+            {'username': row.username, 'password': row.password}
+                for row in db_ssh_service.iter_credentials(db, usernames= usernames, status= list(ServiceStatusDb))
+        ]
+        if not users:
+            return None, None
+
+        return create_ssh_account_via_group(server_ip, users, ignore_exists_users= True)
+
+    if operation == OutboxOperation.DELETE:
+        return delete_ssh_account_via_group(server_ip, usernames, ignore_not_exists_users= True)
+
+    if operation == OutboxOperation.BLOCK:
+        return block_ssh_account_via_groups(server_ip, usernames, ignore_not_exists_users= True)
+
+    return unblock_ssh_account_via_groups(server_ip, usernames, ignore_not_exists_users= True)
+
+
+def deliver_server(server_ip) -> Tuple[int, Exception]:
+    """
+    apply the pending operations of one server in order, the rows of a run
+    are marked delivered after it succeeds so a failure only replays that run
+    """
+    db = sessionlocal()
+    delivered = 0
+
+    try:
+        operations = db_outbox.get_operations(server_ip, OUTBOX_BATCH_SIZE, db)
+
+        for operation, rows in consecutive_runs(operations):
+
+            usernames = list(dict.fromkeys(row.username for row in rows))
+
+            _, err = apply_run(server_ip, operation, usernames, db)
+            if err:
+                logger.error(f'[outbox] failed to apply operations (server: {server_ip} -operation: {operation.value} -users: {len(usernames)} -resp_code: {err.status_code} -detail: {err.detail})')
+                return delivered, err
+
+            db_outbox.mark_delivered([row.outbox_id for row in rows], db)
+            delivered += len(rows)
+
+            logger.info(f'[outbox] operations applied (server: {server_ip} -operation: {operation.value} -users: {usernames})')
+
+        return delivered, None
+
+    except Exception as e:
+        db.rollback()
+        logger.error(f'[outbox] error in delivery (server: {server_ip} -error: {e})')
+        return delivered, e
+
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+
+    executor = ThreadPoolExecutor(max_workers= OUTBOX_CONCURRENCY)
+    backoff = {}  # server_ip -> (retry_at, failures)
+    last_prune = 0
+
+    while True:
+
+        busy = False
+
+        try:
+            db = get_db().__next__()
+
+            pending_servers = db_outbox.get_pending_servers(db)
+
+            if time() - last_prune >= PRUNE_INTERVAL:
+                deleted = db_outbox.delete_delivered_operations(datetime.now() - OUTBOX_RETENTION, db)
+                logger.info(f'[outbox] pruned delivered operations (deleted: {deleted})')
+                last_prune = time()
+
+            db.close()
+
+            due_servers = [server_ip for server_ip in pending_servers if backoff.get(server_ip, (0, 0))[0] <= time()]
+            futures = {server_ip: executor.submit(deliver_server, server_ip) for server_ip in due_servers}
+
+            for server_ip, future in futures.items():
+
+                delivered, err = future.result()
+
+                if err:
+                    failures = backoff.get(server_ip, (0, 0))[1] + 1
+                    backoff[server_ip] = (time() + min(OUTBOX_MAX_BACKOFF, 2 ** failures), failures)
+                    continue
+
+                backoff.pop(server_ip, None)
+                if delivered >= OUTBOX_BATCH_SIZE:
+                    busy = True
+
+        except Exception as e:
+            logger.error(f'[exception]  [{e}]')
+
+        if not busy:
+            sleep(OUTBOX_POLL_INTERVAL)
@@ -0,0 +1,74 @@
+import sys
+
+sys.path.append('/root/ssh-master-api')
+
+from db import db_ssh_service, db_service_counter
+from db.database import get_db
+from datetime import datetime, timedelta
+from time import sleep
+import logging
+import os
+
+logger = logging.getLogger('reconcile_counters.log')
+logger.setLevel(logging.INFO)
+
+# Create a file handler to save logs to a file
+file_handler = logging.FileHandler('reconcile_counters.log')
+file_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s | %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s | %(message)s')
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+
+COUNTER_RECONCILE_HOUR = int(os.getenv('COUNTER_RECONCILE_HOUR', 4))
+RETRY_DELAY = 5 * 60
+
+
+def next_run(now: datetime, hour: int= COUNTER_RECONCILE_HOUR) -> datetime:
+
+    run_at = now.replace(hour= hour, minute= 0, second= 0, microsecond= 0)
+    if run_at <= now:
+        run_at += timedelta(days= 1)
+
+    return run_at
+
+
+def reconcile():
+
+    db = get_db().__next__()
+    try:
+        # the grouped count and the counters are read in one transaction, so they share a snapshot
+        actual = db_ssh_service.count_services_by_agents(db)
+        drift = db_service_counter.reconcile_counts(actual, db)
+
+    finally:
+        db.close()
+
+    for (agent_id, service_type, status), delta in drift.items():
+        logger.warning(f'[reconcile] counter drift fixed (agent_id: {agent_id} -type: {service_type} -status: {status} -delta: {delta})')
+
+    logger.info(f'[reconcile] done (agents: {len(actual)} -drifted counters: {len(drift)})')
+
+
+if __name__ == '__main__':
+
+    # the first pass also fills the table on a fresh deploy
+    run_at = datetime.now()
+
+    while True:
+
+        try:
+            sleep(max(0, (run_at - datetime.now()).total_seconds()))
+
+            reconcile()
+            run_at = next_run(datetime.now())
+
+        except Exception as e:
+            logger.error(f'[exception]  [{e}]')
+            run_at = datetime.now() + timedelta(seconds= RETRY_DELAY)
@@ -47,6 +47,13 @@ class ServiceStatusDb(str, Enum):
     EXPIRED= 'expired'
     DELETED= 'deleted'
 
+class OutboxOperation(str, Enum):
+
+    CREATE= 'create'
+    DELETE= 'delete'
+    BLOCK= 'block'
+    UNBLOCK= 'unblock'
+
 class ConfigType(str, Enum):
 
     MAIN= 'main'
@@ -123,6 +130,7 @@ class ServerConnection(str, Enum):
 
     CONNECTED= 'connected'
     DISCONNECT= 'disconnect'
+    TIMEOUT= 'timeout'
 
 class NodesStatusDetail(BaseModel):
 
@@ -147,6 +155,17 @@ class UsersResponse(BaseModel):
     count: int
     result: List[str]
 
+class ServerCredentials(BaseModel):
+
+    server_ip: Optional[str] = None
+    usernames: Optional[List[str]] = None
+
+class UsersDigestResponse(BaseModel):
+
+    count: int
+    digest: int
+    buckets: List[int]
+
 class SourceUsersServer(str, Enum):
 
     DATABASE = 'database'
@@ -163,12 +182,14 @@ class ActiveUsersDetail(BaseModel):
     detail: List[Dict]
     active_sessions: int
     active_users: int
+    connection: ServerConnection = ServerConnection.CONNECTED
     
 class ActiveUsersResponse(BaseModel):
 
     server_number: Optional[int]
     total_active_users: int
     total_sessions: int
+    timeout_servers: List[str] = []
     detail: List[ActiveUsersDetail]
     
 class ServerCaps(BaseModel):
@@ -458,9 +479,16 @@ class UserSShServiceDisplay(BaseModel):
     class Config:
         orm_mode= True
 
+class ExportFormat(str, Enum):
+
+    NDJSON= 'ndjson'
+    CSV= 'csv'
+
 class SearchResponse(BaseModel):
 
     count: int
+    total: Optional[int]
+    next_after_service_id: Optional[int]
     result: List[UserSShServiceDisplay] 
 
 # ============= V2ray =============
@@ -863,3 +891,23 @@ class PublishNotificationResponse(BaseModel):
 
     status: NotificationStatus
     failed_users: List[str]
+    broadcast_id: Optional[str] = None
+
+class BroadcastStatus(str, Enum):
+
+    PENDING= 'pending'
+    EXPANDING= 'expanding'
+    SENDING= 'sending'
+    DONE= 'done'
+    FAILED= 'failed'
+
+class BroadcastStatusResponse(BaseModel):
+
+    broadcast_id: str
+    status: BroadcastStatus
+    total: int
+    enqueued: int
+    sent: int
+    failed: int
+    skipped: int
+    created: datetime
@@ -0,0 +1,259 @@
+from requests.exceptions import ConnectTimeout, ConnectionError, ReadTimeout
+from requests.adapters import HTTPAdapter
+from fastapi import HTTPException, status
+from time import sleep
+import requests
+import asyncio
+import httpx
+import os
+
+SLAVE_PORT = int(os.getenv('SLAVE_PORT', 8090))
+SLAVE_POOL_CONNECTIONS = int(os.getenv('SLAVE_POOL_CONNECTIONS', 100))
+SLAVE_POOL_MAXSIZE = int(os.getenv('SLAVE_POOL_MAXSIZE', 10))
+SLAVE_CONNECT_TIMEOUT = float(os.getenv('SLAVE_CONNECT_TIMEOUT', 5))
+SLAVE_READ_TIMEOUT = float(os.getenv('SLAVE_READ_TIMEOUT', 20))
+SLAVE_RETRIES = int(os.getenv('SLAVE_RETRIES', 2))
+SLAVE_BACKOFF_FACTOR = float(os.getenv('SLAVE_BACKOFF_FACTOR', 0.5))
+
+
+def header():
+
+    header = os.getenv('SLAVE_TOKEN')
+    return {
+        'token': header,
+        'accept': 'application/json'
+        }
+
+
+class BaseSlaveClient:
+    """
+    Shared endpoint definitions of the slave api (port 8090).
+    subclasses only implement `request`, so every endpoint method returns
+    (resp, None) or (None, HTTPException) in the sync client and a coroutine
+    of the same tuple in the async one.
+    """
+
+    def __init__(self,
+                 port: int= SLAVE_PORT,
+                 pool_connections: int= SLAVE_POOL_CONNECTIONS,
+                 pool_maxsize: int= SLAVE_POOL_MAXSIZE,
+                 connect_timeout: float= SLAVE_CONNECT_TIMEOUT,
+                 read_timeout: float= SLAVE_READ_TIMEOUT,
+                 retries: int= SLAVE_RETRIES,
+                 backoff_factor: float= SLAVE_BACKOFF_FACTOR):
+
+        self.port = port
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = max(1, retries)
+        self.backoff_factor = backoff_factor
+
+    def url(self, server_ip, path):
+        return f'http://{server_ip}:{self.port}{path}'
+
+    def backoff(self, attempt):
+        return self.backoff_factor * (2 ** attempt)
+
+    @staticmethod
+    def should_retry(status_code):
+        return status_code >= 500
+
+    @staticmethod
+    def error_from_response(status_code, content: bytes, json_body):
+
+        if isinstance(json_body, dict) and 'detail' in json_body:
+            return HTTPException(status_code=status_code ,detail= json_body['detail'])
+
+        return HTTPException(status_code=status_code ,detail= content.decode())
+
+    @staticmethod
+    def connection_error(message):
+        return HTTPException(status_code=status.HTTP_408_REQUEST_TIMEOUT, detail={'message': message, 'internal_code': 2419})
+
+    def request(self, method, server_ip, path, json= None, read_timeout= None):
+        raise NotImplementedError
+
+    # ============= Ssh =============
+
+    def create_ssh_account(self, server_ip, users: list, ignore_exists_users= False):
+
+        data = {
+            'ignore_exists_users': ignore_exists_users,
+            'users': users
+        }
+        return self.request('POST', server_ip, '/ssh/create', json= data)
+
+    def delete_ssh_account(self, server_ip, users: list, ignore_not_exists_users= False):
+
+        data = {
+            'ignore_not_exists_users': ignore_not_exists_users,
+            'users': users
+        }
+        return self.request('DELETE', server_ip, '/ssh/delete', json= data)
+
+    def block_ssh_account(self, server_ip, users: list, ignore_not_exists_users= False):
+
+        data = {
+            'ignore_not_exists_users': ignore_not_exists_users,
+            'users': users
+        }
+        return self.request('POST', server_ip, '/ssh/block', json= data)
+
+    def unblock_ssh_account(self, server_ip, users: list, ignore_not_exists_users= False):
+
+        data = {
+            'ignore_not_exists_users': ignore_not_exists_users,
+            'users': users
+        }
+        return self.request('POST', server_ip, '/ssh/unblock', json= data)
+
+    # ============= Server =============
+
+    def get_users(self, server_ip):
+        return self.request('GET', server_ip, '/server/users', read_timeout= 10)
+
+    def users_digest(self, server_ip, buckets_number: int):
+        return self.request('GET', server_ip, f'/server/users/digest?buckets_number={buckets_number}', read_timeout= 10)
+
+    def active_users(self, server_ip):
+        return self.request('GET', server_ip, '/server/activeusers', read_timeout= 10)
+
+    def init_server(self, server_ip, ssh_port, manager_password):
+
+        data = {
+            'ssh_port': ssh_port,
+            'manager_password': manager_password
+        }
+        return self.request('POST', server_ip, '/server/init', json= data)
+
+
+class SlaveClient(BaseSlaveClient):
+    """
+    Blocking client, one keep-alive pool per slave node (requests/urllib3).
+    safe to share between the threads of the fastapi threadpool.
+    """
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections= self.pool_connections, pool_maxsize= self.pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, server_ip, path, json= None, read_timeout= None):
+
+        timeout = (self.connect_timeout, read_timeout or self.read_timeout)
+        error = None
+
+        for attempt in range(self.retries):
+
+            if attempt:
+                sleep(self.backoff(attempt - 1))
+
+            try:
+                resp = self.session.request(method, self.url(server_ip, path), json= json, headers= header(), timeout= timeout)
+
+            except ConnectTimeout:
+                error = self.connection_error('Connection Timeout')
+                continue
+
+            except ConnectionError:
+                error = self.connection_error('ConnectionError')
+                continue
+
+            except ReadTimeout:
+                # the slave may have already applied the command, so dont send it again
+                return None, self.connection_error('ReadTimeout')
+
+            if resp.status_code == 200:
+                return resp.json(), None
+
+            try:
+                json_body = resp.json()
+
+            except ValueError:
+                json_body = None
+
+            error = self.error_from_response(resp.status_code, resp.content, json_body)
+            if not self.should_retry(resp.status_code):
+                break
+
+        return None, error
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncSlaveClient(BaseSlaveClient):
+    """
+    Asyncio client (httpx), the connection pool is bound to the running loop
+    so create it inside the loop, preferably with `async with`.
+    """
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+
+        self.client = httpx.AsyncClient(
+            limits= httpx.Limits(max_connections= self.pool_connections * self.pool_maxsize, max_keepalive_connections= self.pool_connections),
+            timeout= httpx.Timeout(self.read_timeout, connect= self.connect_timeout)
+        )
+
+    async def request(self, method, server_ip, path, json= None, read_timeout= None):
+
+        timeout = httpx.Timeout(read_timeout or self.read_timeout, connect= self.connect_timeout)
+        error = None
+
+        for attempt in range(self.retries):
+
+            if attempt:
+                await asyncio.sleep(self.backoff(attempt - 1))
+
+            try:
+                resp = await self.client.request(method, self.url(server_ip, path), json= json, headers= header(), timeout= timeout)
+
+            except httpx.ConnectTimeout:
+                error = self.connection_error('Connection Timeout')
+                continue
+
+            except (httpx.ConnectError, httpx.PoolTimeout):
+                error = self.connection_error('ConnectionError')
+                continue
+
+            except httpx.TimeoutException:
+                return None, self.connection_error('ReadTimeout')
+
+            except httpx.TransportError:
+                error = self.connection_error('ConnectionError')
+                continue
+
+            if resp.status_code == 200:
+                return resp.json(), None
+
+            try:
+                json_body = resp.json()
+
+            except ValueError:
+                json_body = None
+
+            error = self.error_from_response(resp.status_code, resp.content, json_body)
+            if not self.should_retry(resp.status_code):
+                break
+
+        return None, error
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+slave_client = SlaveClient()
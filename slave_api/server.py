@@ -1,92 +1,80 @@
-from requests import ConnectionError, ConnectTimeout, ReadTimeout
+from slave_api.client import slave_client, AsyncSlaveClient
 from fastapi import HTTPException, status
-import requests
+from typing import Dict, List, Tuple
+import asyncio
 import os
 
-def header():
+SLAVE_FANOUT_CONCURRENCY = int(os.getenv('SLAVE_FANOUT_CONCURRENCY', 20))
+SLAVE_FANOUT_DEADLINE = float(os.getenv('SLAVE_FANOUT_DEADLINE', 8))
 
-    header = os.getenv('SLAVE_TOKEN')
-    return {
-        'token': header,
-        'accept': 'application/json'
-        }
 
 def get_users(server_ip):
 
-    try:
-        for _ in range(2):
-            resp = requests.get(url=f'http://{server_ip}:8090/server/users', headers= header(), timeout=10)
-            if resp.status_code == 200:
-                break
+    return slave_client.get_users(server_ip)
 
-        if resp.status_code != 200:
-            return None, HTTPException(status_code=resp.status_code ,detail= resp.content.decode())
-        
-        return resp.json(), None
 
-    except ConnectTimeout:
+def users_digest(server_ip, buckets_number: int):
 
-        return None, HTTPException(status_code=status.HTTP_408_REQUEST_TIMEOUT, detail={'message': 'Connection Timeout', 'internal_code': 2419})
-    
-    except ConnectionError:
+    return slave_client.users_digest(server_ip, buckets_number)
 
-        return None, HTTPException(status_code=status.HTTP_408_REQUEST_TIMEOUT, detail={'message': 'ConnectionError', 'internal_code': 2419})
 
-    except ReadTimeout:
+def active_users(server_ip):
 
-        return None, HTTPException(status_code=status.HTTP_408_REQUEST_TIMEOUT, detail={'message': 'ReadTimeout', 'internal_code': 2419})
+    return slave_client.active_users(server_ip)
 
-def active_users(server_ip):
 
-    try:
-        for _ in range(2):
-            resp = requests.get(url=f'http://{server_ip}:8090/server/activeusers', headers= header(), timeout=10)
-            if resp.status_code == 200:
-                break
+def init_server(server_ip, ssh_port, manager_password):
 
-        if resp.status_code != 200:
-            return None, HTTPException(status_code=resp.status_code ,detail= resp.content.decode())
-        
-        return resp.json(), None
+    return slave_client.init_server(server_ip, ssh_port, manager_password)
 
-    except ConnectTimeout:
 
-        return None, HTTPException(status_code=status.HTTP_408_REQUEST_TIMEOUT, detail={'message': 'Connection Timeout', 'internal_code': 2419})
-    
-    except ConnectionError:
+async def _active_users_fanout(servers_ip: List[str], concurrency: int, deadline: float):
 
-        return None, HTTPException(status_code=status.HTTP_408_REQUEST_TIMEOUT, detail={'message': 'ConnectionError', 'internal_code': 2419})
+    semaphore = asyncio.Semaphore(concurrency)
 
-    except ReadTimeout:
+    async with AsyncSlaveClient() as client:
 
-        return None, HTTPException(status_code=status.HTTP_408_REQUEST_TIMEOUT, detail={'message': 'ReadTimeout', 'internal_code': 2419})
+        async def fetch(server_ip):
+            async with semaphore:
+                return await client.active_users(server_ip)
 
-def init_server(server_ip, ssh_port, manager_password):
+        tasks = {server_ip: asyncio.ensure_future(fetch(server_ip)) for server_ip in servers_ip}
+        done, pending = await asyncio.wait(tasks.values(), timeout= deadline)
+
+        for task in pending:
+            task.cancel()
+
+        if pending:
+            await asyncio.gather(*pending, return_exceptions= True)
+
+    results = {}
+    for server_ip, task in tasks.items():
 
-    try:
-        data = {
-            'ssh_port': ssh_port,
-            'manager_password': manager_password
-        }
-        for _ in range(2):
-            resp = requests.post(url=f'http://{server_ip}:8090/server/init', json= data, headers= header(), timeout=20)
-            if resp.status_code == 200:
-                break
+        if task not in done:
+            results[server_ip] = (None, HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail={'message': 'Deadline Exceeded', 'internal_code': 2419}))
 
-        if resp.status_code != 200:
-            return None, HTTPException(status_code=resp.status_code ,detail= resp.content.decode())
-        
-        return resp.json(), None
+        elif task.exception() is not None:
+            # one failing node must not take down the results of the others
+            error = task.exception()
+            if not isinstance(error, HTTPException):
+                error = HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail={'message': f'Slave Request Failed ({type(error).__name__}: {error})', 'internal_code': 2419})
 
-    except ConnectTimeout:
+            results[server_ip] = (None, error)
 
-        return None, HTTPException(status_code=status.HTTP_408_REQUEST_TIMEOUT, detail={'message': 'Connection Timeout', 'internal_code': 2419})
-    
-    except ConnectionError:
+        else:
+            results[server_ip] = task.result()
 
-        return None, HTTPException(status_code=status.HTTP_408_REQUEST_TIMEOUT, detail={'message': 'ConnectionError', 'internal_code': 2419})
+    return results
 
-    except ReadTimeout:
 
-        return None, HTTPException(status_code=status.HTTP_408_REQUEST_TIMEOUT, detail={'message': 'ReadTimeout', 'internal_code': 2419})
+def active_users_via_group(servers_ip: List[str], concurrency: int= SLAVE_FANOUT_CONCURRENCY, deadline: float= SLAVE_FANOUT_DEADLINE) -> Dict[str, Tuple[list, HTTPException]]:
+    """
+    query all nodes concurrently (at most `concurrency` in flight), nodes that
+    miss the global `deadline` come back with a 504 error instead of blocking
+    and a node whose request raised comes back with that error.
+    must be called from a sync context (fastapi threadpool or a plain script).
+    """
+    if not servers_ip:
+        return {}
 
+    return asyncio.run(_active_users_fanout(servers_ip, concurrency, deadline))
@@ -15,13 +15,28 @@ tmux send-keys -t master:0.1 'cd /root/ssh-master-api;source venv/bin/activate;p
 
 # notif
 tmux new-session -d -s notif
-tmux send-keys -t notif 'cd /root/ssh-master-api;source venv/bin/activate;celery -A celery_notification.main worker --concurrency=4 --loglevel=info -n notification_worker.%h' Enter
+tmux send-keys -t notif 'cd /root/ssh-master-api;source venv/bin/activate;celery -A celery_notification.main worker --pool=threads --concurrency=4 --loglevel=info -n notification_worker.%h' Enter
 
 # sync
 tmux new-session -d -s sync
 tmux send-keys -t sync 'cd /root/ssh-master-api;source venv/bin/activate;python extensions/sync_servers/server.py' Enter
 
 
+# broadcast
+tmux new-session -d -s broadcast
+tmux send-keys -t broadcast 'cd /root/ssh-master-api;source venv/bin/activate;python schedule_service/broadcast.py' Enter
+
+
+# outbox
+tmux new-session -d -s outbox
+tmux send-keys -t outbox 'cd /root/ssh-master-api;source venv/bin/activate;python schedule_service/outbox_delivery.py' Enter
+
+
+# counters
+tmux new-session -d -s counters
+tmux send-keys -t counters 'cd /root/ssh-master-api;source venv/bin/activate;python schedule_service/reconcile_counters.py' Enter
+
+
 # backup
 tmux new-session -d -s backup
 tmux send-keys -t backup 'cd /root/ssh-master-api;source venv/bin/activate;python backup_service/main.py' Enter
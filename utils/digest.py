@@ -0,0 +1,47 @@
+from typing import Dict, Iterable, List
+import hashlib
+import os
+
+DIGEST_BUCKETS = int(os.getenv('DIGEST_BUCKETS', 256))
+
+# must stay in sync with the sql expressions in db_ssh_service.get_users_digest_by_server:
+# value  = first 15 hex digits of md5(username)  (60 bits)
+# bucket = hex digits 16..19 of md5(username) % buckets_number
+
+
+def username_hash(username: str, buckets_number: int= DIGEST_BUCKETS):
+
+    hex_digest = hashlib.md5(username.encode()).hexdigest()
+    return int(hex_digest[15:19], 16) % buckets_number, int(hex_digest[:15], 16)
+
+
+def users_digest(usernames: Iterable[str], buckets_number: int= DIGEST_BUCKETS) -> Dict:
+    """
+    order independent digest of a set of usernames: the xor of the username
+    hashes, overall and per bucket, so two sides can compare the digest first
+    and then exchange only the buckets that differ
+    """
+    buckets = [0] * buckets_number
+    count = 0
+
+    for username in set(usernames):
+        bucket, value = username_hash(username, buckets_number)
+        buckets[bucket] ^= value
+        count += 1
+
+    digest = 0
+    for value in buckets:
+        digest ^= value
+
+    return {'count': count, 'digest': digest, 'buckets': buckets}
+
+
+def filter_by_buckets(usernames: Iterable[str], buckets: List[int], buckets_number: int= DIGEST_BUCKETS) -> List[str]:
+
+    buckets = set(buckets)
+    return [username for username in usernames if username_hash(username, buckets_number)[0] in buckets]
+
+
+def diff_buckets(first: Dict, second: Dict) -> List[int]:
+
+    return [index for index, (a, b) in enumerate(zip(first['buckets'], second['buckets'])) if a != b]
@@ -65,19 +65,19 @@ def get_domain_via_server(server: BestServerForNewConfig, db: Session, logger: l
     if domains_server == []:
         return None, HTTPException(status_code=status.HTTP_404_NOT_FOUND ,detail={'internal_code':2461, 'message':'this server have no any domain for used it'})
     
+    domains_users_number = db_ssh_service.count_services_by_domain_of_server(server.server_ip, db, status= [ServiceStatusDb.ENABLE, ServiceStatusDb.DISABLE])
+
     min_domain_number = 100_000_00
     selected_domain = None
     total_user_domains_number = 0
     for domain in domains_server:
         if domain.status == DomainStatusDb.ENABLE:
             
-            enable_users_domain = db_ssh_service.get_services_by_domain_id(domain.domain_id, db, status= ServiceStatusDb.ENABLE)
-            disable_users_domain = db_ssh_service.get_services_by_domain_id(domain.domain_id, db, status= ServiceStatusDb.DISABLE)
-            users_domain = enable_users_domain + disable_users_domain
-            total_user_domains_number += len(users_domain)
-            if len(users_domain) < MAX_USER_NUMBER_IN_DOMAIN and len(users_domain) < min_domain_number:
+            users_domain_number = domains_users_number.get(domain.domain_id, 0)
+            total_user_domains_number += users_domain_number
+            if users_domain_number < MAX_USER_NUMBER_IN_DOMAIN and users_domain_number < min_domain_number:
 
-                min_domain_number = len(users_domain)
+                min_domain_number = users_domain_number
                 selected_domain = domain
 
     if selected_domain is None and total_user_domains_number < server.max_users:
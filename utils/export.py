@@ -0,0 +1,54 @@
+from typing import Dict, Iterable, Iterator, List
+from datetime import datetime
+from enum import Enum
+import json
+import csv
+import io
+
+EXPORT_MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+
+def _plain(value):
+
+    if isinstance(value, Enum):
+        return value.value
+
+    if isinstance(value, datetime):
+        return value.isoformat()
+
+    return value
+
+
+def ndjson_lines(rows: Iterable[Dict]) -> Iterator[str]:
+
+    for row in rows:
+        yield json.dumps({key: _plain(value) for key, value in row.items()}) + '\n'
+
+
+def csv_lines(rows: Iterable[Dict], fieldnames: List[str]) -> Iterator[str]:
+    # one small buffer is reused per line, so nothing grows with the number of rows
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames= fieldnames, extrasaction= 'ignore')
+
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({key: _plain(value) for key, value in row.items()})
+
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+
+    # the header of an empty export
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def export_lines(rows: Iterable[Dict], format_: str, fieldnames: List[str]) -> Iterator[str]:
+
+    if format_ == 'csv':
+        return csv_lines(rows, fieldnames)
+
+    return ndjson_lines(rows)
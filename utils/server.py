@@ -1,12 +1,9 @@
 from fastapi import HTTPException, status
-from schemas import (
-    ServerStatusDb,
-    BestServerForNewConfig
-)
+from schemas import BestServerForNewConfig
 from sqlalchemy.orm.session import Session
-from db import db_server, db_domain
+from db import db_domain
 from db.models import DbDomain
-from operator import itemgetter
+from cache.capacity_index import capacity_index
 import numpy as np
 from typing import List, Tuple
 from utils.domain import get_domain_via_server
@@ -14,43 +11,30 @@ import logging
 
 def find_best_server(db: Session, std_dev: int= 1, except_domains_id: List[int] = [], except_servers: List[str] = []) -> BestServerForNewConfig:
 
-    servers = db_server.get_all_server(generate_status= ServerStatusDb.ENABLE, status= ServerStatusDb.ENABLE, db= db)
-    
-    if servers == []:
-        return None
-    
     except_server_via_domain = {domain.server_ip for domain_id in except_domains_id if ( domain := db_domain.get_domain_by_id(domain_id, db)) }
-    except_servers.extend(list(except_server_via_domain))
-    
-    dict_servers = [
-        {
-            'server_ip': server.server_ip,
-            'ssh_port': server.ssh_port,
-            'ssh_accounts_number': server.ssh_accounts_number,
-            'max_users': server.max_users 
-        } for server in servers if server.ssh_accounts_number < server.max_users and \
-                server.server_ip not in except_servers
-                    ]
-    
-    if dict_servers == []:
-        return None
-    
-    sorted_servers = sorted(dict_servers, key=itemgetter('ssh_accounts_number')) 
+    excluded_servers = set(except_servers) | except_server_via_domain
 
     mean = 1  # Mean of the distribution
     num_samples = 1  # Number of samples to select
 
     random_indices = np.random.normal(mean, std_dev, num_samples)
-    random_indices = np.clip(random_indices, 0, len(sorted_servers) - 1)
-    random_indices = np.round(random_indices).astype(int)
-    
-    selected_server = sorted_servers[int(random_indices)]
+    random_index = int(np.round(random_indices[0]))
 
-    return BestServerForNewConfig(**selected_server)
+    # the index clips the rank to the servers that are still available
+    selected_server = capacity_index.select(db, random_index, except_servers= list(excluded_servers))
+
+    if selected_server is None:
+        return None
+
+    server_ip, ssh_port, ssh_accounts_number, max_users = selected_server
+
+    return BestServerForNewConfig(server_ip= server_ip, ssh_port= ssh_port, ssh_accounts_number= ssh_accounts_number, max_users= max_users)
 
 
 def find_server_and_domain(db: Session, logger: logging.Logger, except_servers: List[int]= [], std_dev: int= 1) -> Tuple[BestServerForNewConfig, DbDomain, HTTPException]:
 
+    except_servers = list(except_servers)
+
     while True:
 
         selected_server = find_best_server(db, except_servers= except_servers )
@@ -0,0 +1,109 @@
+from sqlalchemy.orm.session import Session
+from cache.cache_session import (
+    pop_username_number,
+    remove_username_number,
+    get_username_pool_ready,
+    lock_username_pool,
+    fill_username_pool
+)
+from cache.database import get_redis_cache
+from db.database import sessionlocal
+from db import db_ssh_service
+from random import randint, shuffle
+from threading import Thread, Lock
+import logging
+import redis
+
+USERNAME_PREFIX = 'user_'
+USERNAME_MIN_NUMBER = 100_000
+USERNAME_MAX_NUMBER = 999_000
+
+logger = logging.getLogger('username.log')
+
+_fill_lock = Lock()
+_fill_thread = None
+
+
+def init_username_pool(db: Session, cache_db: redis.Redis):
+
+    if not lock_username_pool(cache_db):
+        return False
+
+    used_numbers = set()
+    for username in db_ssh_service.get_all_usernames(db):
+        if username.startswith(USERNAME_PREFIX) and username[len(USERNAME_PREFIX):].isdigit():
+            used_numbers.add(int(username[len(USERNAME_PREFIX):]))
+
+    numbers = [number for number in range(USERNAME_MIN_NUMBER, USERNAME_MAX_NUMBER + 1) if number not in used_numbers]
+    shuffle(numbers)
+    fill_username_pool(numbers, cache_db)
+
+    logger.info(f'[username pool] successfully filled (free: {len(numbers)} -used: {len(used_numbers)})')
+    return True
+
+
+def _fill_username_pool_job():
+
+    db = sessionlocal()
+    try:
+        init_username_pool(db, get_redis_cache().__next__())
+
+    except Exception as e:
+        logger.error(f'[username pool] failed to fill the pool (error: {e})')
+
+    finally:
+        db.close()
+
+
+def start_username_pool_fill():
+    """
+    fill the pool in a background thread, called at startup and whenever a
+    request finds the pool missing or empty; the redis lock keeps it to one
+    fill across all the workers
+    """
+    global _fill_thread
+
+    with _fill_lock:
+        if _fill_thread is not None and _fill_thread.is_alive():
+            return
+
+        _fill_thread = Thread(target= _fill_username_pool_job, daemon= True)
+        _fill_thread.start()
+
+
+def generate_username(db: Session, cache_db: redis.Redis) -> str:
+    """
+    pop a never used username from the shuffled pool in redis (SPOP is atomic,
+    so concurrent requests cant get the same name). until the pool is ready or
+    if redis fails, fall back to random probing, the unique constraint on
+    ssh_service.username is the last guard in both cases.
+    """
+    try:
+        if get_username_pool_ready(cache_db) is not None:
+
+            number = pop_username_number(cache_db)
+            if number is not None:
+                return USERNAME_PREFIX + str(number)
+
+            logger.error('[username pool] the pool is empty, fall back to random username')
+
+        start_username_pool_fill()
+
+    except Exception as e:
+        logger.error(f'[username pool] error (error: {e})')
+
+    while True:
+
+        number = randint(USERNAME_MIN_NUMBER, USERNAME_MAX_NUMBER)
+        username = USERNAME_PREFIX + str(number)
+        if db_ssh_service.get_service_by_username(username, db) is not None:
+            continue
+
+        # take it out of the pool too, so a later SPOP cant hand it out again
+        try:
+            remove_username_number(number, cache_db)
+
+        except Exception as e:
+            logger.error(f'[username pool] failed to remove the fallback number (number: {number} -error: {e})')
+
+        return username